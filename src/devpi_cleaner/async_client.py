@@ -0,0 +1,478 @@
+import asyncio
+import base64
+import contextlib
+import time
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
+
+import httpx
+from devpi_plumber.client import DevpiClientError
+
+from devpi_cleaner.client import RemovalSummary
+from devpi_cleaner.client import is_in_sync
+from devpi_cleaner.packages import Package
+from devpi_cleaner.packages import Release
+from devpi_cleaner.packages import expand_name_pattern
+from devpi_cleaner.packages import group_by_project
+from devpi_cleaner.packages import group_into_releases
+from devpi_cleaner.packages import group_versions
+from devpi_cleaner.packages import has_name_pattern
+from devpi_cleaner.packages import largest_first
+from devpi_cleaner.packages import parse_spec
+from devpi_cleaner.packages import select_releases
+from devpi_cleaner.packages import version_matches
+
+if TYPE_CHECKING:
+    from devpi_cleaner.journal import RemovalJournal
+
+
+async def gather_all(*awaitables: Awaitable[Any]) -> List[Any]:
+    """Run awaitables concurrently like `asyncio.gather`, but only raise the first error once all of them have finished.
+
+    With a plain `gather`, the first error propagates while the other awaitables keep running. They may then still
+    need a client that is closed in the meantime, e.g. to restore the volatility of an index.
+
+    Returns:
+        List[Any]: The results in the order of the awaitables.
+    """
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+def _error_message(response: httpx.Response) -> str:
+    try:
+        return response.json().get("message", response.reason_phrase)
+    except ValueError:
+        return response.text or response.reason_phrase
+
+
+class AsyncDevpiHttpClient:
+    """An asyncio counterpart of `DevpiHttpClient` built on httpx.
+
+    Listings, status probes and removals of any number of indices share one connection pool, so thousands of requests
+    can be in flight without a thread per request. At most `max_connections` requests are sent to the server at the
+    same time, the others wait for a free connection. Use one client per server to get a separate limit per host.
+
+    Args:
+        url (str): The URL of the Devpi server.
+        user (Optional[str]): The user to log in as when entering the context.
+        password (Optional[str]): The password to log in with.
+        client (Optional[httpx.AsyncClient]): The httpx client to use. Defaults to a new one.
+        max_connections (int): The maximal number of requests in flight at the same time.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        client: Optional[httpx.AsyncClient] = None,
+        max_connections: int = 10,
+    ):
+        parts = urlsplit(url)
+        self._server_url = urlunsplit((parts.scheme, parts.netloc, "", "", ""))
+        self._credentials = (user, password)
+        self._user: Optional[str] = None
+        # The latest serial the server has reported. Every change on the server increments it.
+        self._serial: Optional[int] = None
+        if client is None:
+            # Requests queue up for a connection instead of failing after the default pool timeout.
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_connections), timeout=httpx.Timeout(60.0, pool=None)
+            )
+        self._client = client
+        self._client.headers["Accept"] = "application/json"
+        self._connections = asyncio.Semaphore(max_connections)
+
+    async def __aenter__(self) -> "AsyncDevpiHttpClient":
+        user, password = self._credentials
+        if user and password is not None:
+            await self.login(user, password)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Log off and close the underlying httpx client."""
+        self.logoff()
+        await self._client.aclose()
+
+    async def _request(self, method: str, path_or_url: str, **kwargs) -> httpx.Response:
+        url = urljoin(self._server_url + "/", path_or_url)
+        try:
+            async with self._connections:
+                response = await self._client.request(method, url, **kwargs)
+        except httpx.HTTPError as error:
+            raise DevpiClientError(f"{method} {url} failed: {error}") from error
+        serial = response.headers.get("X-Devpi-Serial")
+        if serial is not None and serial.isdigit():
+            self._serial = int(serial)
+        if response.status_code >= 400 and response.status_code != 404:
+            raise DevpiClientError(f"{method} {url}: {response.status_code} {_error_message(response)}")
+        return response
+
+    async def _request_json(self, method: str, path_or_url: str, missing_ok: bool = False, **kwargs) -> Dict[str, Any]:
+        response = await self._request(method, path_or_url, **kwargs)
+        if response.status_code == 404:
+            if missing_ok:
+                return {"result": {}}
+            raise DevpiClientError(f"{method} {response.url}: 404 {_error_message(response)}")
+        return response.json()
+
+    async def login(self, user: str, password: str) -> None:
+        """Log in and authenticate all further requests with the returned token."""
+        result = (await self._request_json("POST", "/+login", json={"user": user, "password": password}))["result"]
+        token = base64.b64encode(f"{user}:{result['password']}".encode()).decode()
+        self._client.headers["X-Devpi-Auth"] = token
+        self._user = user
+
+    def logoff(self) -> None:
+        self._client.headers.pop("X-Devpi-Auth", None)
+        self._user = None
+
+    @property
+    def server_url(self) -> str:
+        return self._server_url
+
+    @property
+    def user(self) -> Optional[str]:
+        """The user currently logged in or None."""
+        return self._user
+
+    async def get_json(self, path: str) -> Dict[str, Any]:
+        return await self._request_json("GET", path)
+
+    async def list_indices(self, user: Optional[str] = None) -> List[str]:
+        """List all indices on the server, optionally restricted to those of a single user.
+
+        Returns:
+            List[str]: The indices in the format `<user>/<index>`.
+        """
+        if user is not None:
+            users = {user: (await self._request_json("GET", f"/{user}"))["result"]}
+        else:
+            users = (await self._request_json("GET", "/"))["result"]
+        return [f"{name}/{index}" for name, config in users.items() for index in config.get("indexes", {})]
+
+    async def list_projects(self, index: str) -> List[str]:
+        return (await self._request_json("GET", f"/{index}"))["result"].get("projects", [])
+
+    async def project_versions(self, index: str, name: str) -> Dict[str, Any]:
+        """Return the versions of a project uploaded to the index itself, keyed by version. Missing projects have none."""
+        return (await self._request_json("GET", f"/{index}/{name}?ignore_bases", missing_ok=True))["result"]
+
+    async def list(self, index: str, spec: str) -> List[str]:
+        """List the URLs of the release files matching a specification that were uploaded to the index itself."""
+        name, specifier = parse_spec(spec)
+        versions = await self.project_versions(index, name)
+        return [
+            urljoin(self._server_url, link["href"])
+            for version, verdata in versions.items()
+            if version_matches(specifier, version)
+            for link in verdata.get("+links", [])
+            if link.get("rel") == "releasefile"
+        ]
+
+    async def file_size(self, url: str) -> Optional[int]:
+        """Return the size of a release file in bytes or None if the server does not tell."""
+        response = await self._request("HEAD", url)
+        length = response.headers.get("Content-Length")
+        if response.status_code == 404 or length is None:
+            return None
+        return int(length)
+
+    async def remove(self, index: str, spec: str) -> None:
+        """Remove releases matching a specification like `devpi remove -y` does.
+
+        A plain project name removes the whole project, a specification with versions removes each matching version.
+        Matching versions are removed concurrently.
+
+        Raises:
+            DevpiClientError: If no release matches a specification.
+        """
+        name, specifier = parse_spec(spec)
+        if not specifier:
+            await self._request_json("DELETE", f"/{index}/{name}")
+            return
+        matching = [
+            version for version in await self.project_versions(index, name) if version_matches(specifier, version)
+        ]
+        if not matching:
+            raise DevpiClientError(f"No releases or distributions found matching '{spec}'.")
+        await gather_all(*(self._request_json("DELETE", f"/{index}/{name}/{version}") for version in matching))
+
+    async def index_config(self, index: str) -> Dict[str, Any]:
+        return (await self._request_json("GET", f"/{index}?no_projects"))["result"]
+
+    async def modify_index(self, index: str, **changes: Any) -> Dict[str, Any]:
+        """Change the configuration of an index and return the resulting one."""
+        patch = [f"{key}={value}" for key, value in changes.items()]
+        return (await self._request_json("PATCH", f"/{index}", json=patch))["result"]
+
+
+async def _list_packages_on_index(
+    client: AsyncDevpiHttpClient,
+    index: str,
+    package_spec: str,
+    only_dev: bool,
+    version_filter: Optional[str],
+    keep_latest: int = 0,
+) -> Set[Release]:
+    """List the packages on a specific index that match the given criteria, like its synchronous counterpart."""
+    specs = [package_spec]
+    if has_name_pattern(package_spec):
+        specs = expand_name_pattern(package_spec, await client.list_projects(index))
+    listings = await gather_all(*(client.list(index, spec) for spec in specs))
+
+    selected_releases = select_releases(
+        group_into_releases(url for urls in listings for url in urls), index, only_dev, version_filter, keep_latest
+    )
+    urls = [url for release in selected_releases for url in release.files]
+    sizes = await gather_all(*(client.file_size(url) for url in urls))
+    files = dict(zip(urls, sizes, strict=True))
+    for release in selected_releases:
+        for url in release.files:
+            release.files[url] = files[url]
+    return selected_releases
+
+
+async def list_packages_by_index(
+    client: AsyncDevpiHttpClient,
+    index_spec: str,
+    package_spec: str,
+    only_dev: bool,
+    version_filter: Optional[str],
+    keep_latest: int = 0,
+) -> Dict[str, Set[Release]]:
+    """List all packages by index that match the given criteria, listing all indices concurrently.
+
+    Args:
+        client (AsyncDevpiHttpClient): The client of the server to list.
+        index_spec (str): The index specification.
+        package_spec (str): The package specification.
+        only_dev (bool): Whether to only include development packages.
+        version_filter (Optional[str]): The regular expression to filter versions.
+        keep_latest (int): The number of latest versions to keep per project.
+
+    Returns:
+        Dict[str, Set[Release]]: A dictionary mapping index names to sets of Release objects.
+    """
+    indices = [index_spec] if "/" in index_spec else await client.list_indices(user=index_spec)
+    listings = await gather_all(
+        *(
+            _list_packages_on_index(client, index, package_spec, only_dev, version_filter, keep_latest)
+            for index in indices
+        )
+    )
+    return dict(zip(indices, listings, strict=True))
+
+
+async def wait_for_sync(
+    client: AsyncDevpiHttpClient,
+    max_replica_lag: float = 60.0,
+    max_queue_size: int = 100,
+    interval: float = 10.0,
+    timeout: float = 1800.0,
+) -> None:
+    """Wait until replicas are in sync and the index queue is short, probing the server status every `interval`.
+
+    Raises:
+        DevpiClientError: If the server has not caught up within `timeout` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not all(is_in_sync((await client.get_json("/+status"))["result"], max_replica_lag, max_queue_size)):
+        if loop.time() >= deadline:
+            raise DevpiClientError(f"Devpi server did not catch up within {timeout} seconds.")
+        await asyncio.sleep(interval)
+
+
+class AsyncSyncThrottle:
+    """Pause removals while a Devpi server does not keep up with them.
+
+    Unlike `SyncThrottle`, it does not adapt a removal rate, as the connection limit of the client already bounds the
+    number of requests in flight. The server status is probed at most once per `check_interval` seconds. While it is
+    unhealthy, all removals wait for `wait_for_sync`.
+
+    Args:
+        client (AsyncDevpiHttpClient): The client of the server to watch.
+        check_interval (float): Minimal number of seconds between two status probes.
+        max_replica_lag (float): Number of seconds replicas may lag behind before removals are paused.
+        max_queue_size (int): Length of the index queue from which on removals are paused.
+        timeout (float): Number of seconds to wait for an unhealthy server before giving up.
+    """
+
+    def __init__(
+        self,
+        client: AsyncDevpiHttpClient,
+        check_interval: float = 10.0,
+        max_replica_lag: float = 60.0,
+        max_queue_size: int = 100,
+        timeout: float = 1800.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._client = client
+        self._check_interval = check_interval
+        self._max_replica_lag = max_replica_lag
+        self._max_queue_size = max_queue_size
+        self._timeout = timeout
+        self._clock = clock
+        self._lock = asyncio.Lock()
+        self._last_check: Optional[float] = None
+
+    async def acquire(self) -> None:
+        """Wait until the next removal may be issued."""
+        async with self._lock:
+            if self._last_check is not None and self._clock() - self._last_check < self._check_interval:
+                return
+            await wait_for_sync(
+                self._client, self._max_replica_lag, self._max_queue_size, self._check_interval, self._timeout
+            )
+            self._last_check = self._clock()
+
+
+@contextlib.asynccontextmanager
+async def volatile_index(
+    client: AsyncDevpiHttpClient, index: str, force: bool, journal: Optional["RemovalJournal"] = None
+) -> AsyncIterator[None]:
+    """Make an index volatile for the duration of the context, like devpi_plumber's `volatile_index`.
+
+    With a journal, the original setting is recorded like `RemovalJournal.volatile_index` does. If an interrupted run
+    already left the index volatile, the setting recorded back then is restored instead of the current one.
+
+    Raises:
+        DevpiClientError: If the index is not volatile and `force` is not set.
+    """
+    is_volatile = journal.original_volatility(index) if journal is not None else None
+    if is_volatile is None:
+        is_volatile = bool((await client.index_config(index)).get("volatile"))
+        if not is_volatile and not force:
+            raise DevpiClientError(f"Index {index} is not volatile.")
+        if journal is not None:
+            journal.made_volatile(index, is_volatile)
+
+    await client.modify_index(index, volatile=True)
+    try:
+        yield
+    finally:
+        await client.modify_index(index, volatile=is_volatile)
+        if journal is not None:
+            journal.restored(index)
+
+
+async def _plan_removals(
+    client: AsyncDevpiHttpClient, index: str, packages: Iterable[Package]
+) -> List[Tuple[str, List[Package]]]:
+    """Group packages into as few removal specifications as possible, like its synchronous counterpart."""
+    by_project = group_by_project(packages)
+
+    async def present(name: str, project_packages: List[Package]) -> Set[str]:
+        if len(project_packages) == 1:
+            return set()
+        return set(await client.project_versions(index, name))
+
+    versions = await gather_all(*(present(name, project) for name, project in by_project.items()))
+    return largest_first([
+        removal
+        for (name, project_packages), present_versions in zip(by_project.items(), versions, strict=True)
+        for removal in group_versions(name, project_packages, present_versions)
+    ])
+
+
+async def remove_packages(
+    client: AsyncDevpiHttpClient,
+    index: str,
+    packages: Iterable[Package],
+    force: bool,
+    throttle: Optional[AsyncSyncThrottle] = None,
+    journal: Optional["RemovalJournal"] = None,
+    callback: Optional[Callable[[Package, Optional[DevpiClientError]], None]] = None,
+) -> RemovalSummary:
+    """Remove packages from a specific index, running all removals concurrently.
+
+    As with the synchronous `remove_packages_concurrently`, the index is made volatile once for the whole batch and a
+    failing removal does not stop the others. How many removals are actually in flight is bounded by the connection
+    limit of the client.
+
+    Args:
+        client (AsyncDevpiHttpClient): The client of the server to remove the packages from.
+        index (str): The index to remove the packages from.
+        packages (Iterable[Package]): The packages to remove. All of them must reside on `index`.
+        force (bool): Whether to temporarily make a non-volatile index volatile.
+        throttle (Optional[AsyncSyncThrottle]): The throttle to pace removals with. Defaults to a new one for `client`.
+        journal (Optional[RemovalJournal]): The journal to record removals and volatility changes in, if any.
+        callback (Optional[Callable]): Called with each package and its error, if any, once its removal has finished.
+
+    Returns:
+        RemovalSummary: The removed and the failed packages.
+    """
+    packages = list(packages)
+    assert all(package.index == index for package in packages)
+    if throttle is None:
+        throttle = AsyncSyncThrottle(client)
+    summary = RemovalSummary()
+
+    async def remove(spec: str, removed: List[Package]) -> None:
+        error: Optional[DevpiClientError] = None
+        try:
+            await throttle.acquire()
+            await client.remove(index, spec)
+        except DevpiClientError as client_error:
+            error = client_error
+        for package in removed:
+            summary.add(package, error)
+            if journal is not None and error is None:
+                journal.removed(package)
+            if callback is not None:
+                callback(package, error)
+
+    async with volatile_index(client, index, force, journal):
+        removals = await _plan_removals(client, index, packages)
+        await gather_all(*(remove(spec, removed) for spec, removed in removals))
+    return summary
+
+
+async def remove_plan(
+    client: AsyncDevpiHttpClient,
+    plan: Iterable[Tuple[str, Set[Release]]],
+    force: bool,
+    throttle: Optional[AsyncSyncThrottle] = None,
+    journal: Optional["RemovalJournal"] = None,
+    callback: Optional[Callable[[Package, Optional[DevpiClientError]], None]] = None,
+) -> RemovalSummary:
+    """Remove the packages of all indices of a plan at the same time. See `remove_packages` for the arguments.
+
+    Returns:
+        RemovalSummary: The removed and the failed packages of all indices.
+    """
+    if throttle is None:
+        throttle = AsyncSyncThrottle(client)
+    summary = RemovalSummary()
+    for index_summary in await gather_all(
+        *(remove_packages(client, index, packages, force, throttle, journal, callback) for index, packages in plan)
+    ):
+        summary.update(index_summary)
+    return summary
+
+
+async def remove_package(client: AsyncDevpiHttpClient, index: str, package: Package, force: bool) -> None:
+    """Remove a single package from a specific index on the Devpi server."""
+    summary = await remove_packages(client, index, [package], force)
+    for _, error in summary.failed:
+        raise error
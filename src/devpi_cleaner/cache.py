@@ -0,0 +1,69 @@
+import json
+import sqlite3
+import threading
+from typing import Any
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+
+
+class CachedListing(NamedTuple):
+    """A cached server response together with what is needed to tell whether it is still current."""
+
+    etag: Optional[str]
+    serial: Optional[int]
+    payload: Dict[str, Any]
+
+
+class ListingCache:
+    """A persistent cache of project listings stored in an SQLite database.
+
+    Entries are keyed by URL and by the user logged in, as listings may differ between users. They remember the HTTP ETag and the Devpi serial of the response they were taken from. The
+    cache does not decide itself whether an entry is still valid. That is up to the client, which can compare the serial
+    with the current one of the server or revalidate the ETag with a conditional request.
+
+    Several caches may share a database file, e.g. when several servers are cleaned at the same time. The database is
+    therefore kept in write-ahead log mode, in which readers do not block the writer, and a writer waits up to `timeout`
+    seconds for another one to finish.
+
+    Args:
+        path (str): The database file. It is created if it does not exist.
+        timeout (float): Number of seconds to wait for a lock held by another connection.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS listing"
+                " (url TEXT, user TEXT, etag TEXT, serial INTEGER, payload TEXT, PRIMARY KEY (url, user))"
+            )
+
+    def __enter__(self) -> "ListingCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def get(self, url: str, user: Optional[str] = None) -> Optional[CachedListing]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT etag, serial, payload FROM listing WHERE url = ? AND user = ?", (url, user or "")
+            ).fetchone()
+        if row is None:
+            return None
+        etag, serial, payload = row
+        return CachedListing(etag, serial, json.loads(payload))
+
+    def put(self, url: str, listing: CachedListing, user: Optional[str] = None) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO listing (url, user, etag, serial, payload) VALUES (?, ?, ?, ?, ?)",
+                # Anonymous listings are stored with an empty user, as NULLs would never conflict with each other.
+                (url, user or "", listing.etag, listing.serial, json.dumps(listing.payload)),
+            )
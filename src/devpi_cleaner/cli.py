@@ -1,28 +1,595 @@
+import asyncio
+import contextlib
 import getpass
 import re
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import ClassVar
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
 from typing import Optional
-from typing import Pattern
 from typing import Set
+from typing import TextIO
+from typing import Tuple
 
 import click
 from devpi_plumber.client import DevpiClient
 from devpi_plumber.client import DevpiClientError
 from tqdm import tqdm
 
-from devpi_cleaner.client import Package
-from devpi_cleaner.client import list_packages_by_index
-from devpi_cleaner.client import remove_package
+from devpi_cleaner.cache import ListingCache
+from devpi_cleaner.client import Release
+from devpi_cleaner.client import RemovalSummary
+from devpi_cleaner.client import SyncThrottle
+from devpi_cleaner.client import iter_packages_by_index
+from devpi_cleaner.client import limit_to_budget
+from devpi_cleaner.client import remove_packages
+from devpi_cleaner.client import remove_packages_concurrently
+from devpi_cleaner.http_client import DevpiHttpClient
+from devpi_cleaner.journal import RemovalJournal
+from devpi_cleaner.journal import load_journal
+from devpi_cleaner.plan import read_plan
+from devpi_cleaner.plan import record_plan
+
+
+def _connect(backend: str, server: str, user: str, password: str, cache_path: Optional[str] = None, jobs: int = 1):
+    """Return a context manager yielding a client for `server` using the given backend."""
+    if backend == "http":
+        return DevpiHttpClient(
+            server,
+            user,
+            password,
+            cache=ListingCache(cache_path) if cache_path else None,
+            max_connections=max(jobs, 10),
+        )
+    return DevpiClient(server, user, password)
+
+
+def _humanize_size(size: int) -> str:
+    """Format a number of bytes with a binary unit prefix."""
+    value = float(size)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if value < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TiB"
+
+
+class ByteSize(click.ParamType):
+    """A number of bytes, optionally with a unit such as `200GiB` or `1.5 TB`."""
+
+    name = "size"
+    _UNITS: ClassVar[Dict[str, int]] = {
+        "": 1,
+        "b": 1,
+        "k": 1024,
+        "kib": 1024,
+        "kb": 1000,
+        "m": 1024**2,
+        "mib": 1024**2,
+        "mb": 1000**2,
+        "g": 1024**3,
+        "gib": 1024**3,
+        "gb": 1000**3,
+        "t": 1024**4,
+        "tib": 1024**4,
+        "tb": 1000**4,
+    }
+    _PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([a-z]*)\s*$", re.IGNORECASE)
+
+    def convert(self, value: Any, param: Optional[click.Parameter], ctx: Optional[click.Context]) -> int:
+        if isinstance(value, int):
+            return value
+        match = self._PATTERN.match(str(value))
+        if match is None or match.group(2).lower() not in self._UNITS:
+            self.fail(f"{value!r} is not a size such as 200GiB.", param, ctx)
+        return int(float(match.group(1)) * self._UNITS[match.group(2).lower()])
+
+
+def _describe(release: Release) -> str:
+    """Describe a release together with the number and total size of its files."""
+    details = f"{release.file_count} files"
+    if release.size is not None:
+        details += f", {_humanize_size(release.size)}"
+    return f"{release} ({details})"
+
+
+def _check_backend_options(backend: str, engine: str, jobs: int, cache_path: Optional[str]) -> None:
+    """Reject options that the chosen backend or engine does not support.
+
+    Raises:
+        click.UsageError: If an option requires another backend or engine.
+    """
+    if engine == "async":
+        if cache_path is not None:
+            raise click.UsageError("--cache is not supported by --engine async.")
+        return
+    if backend == "http":
+        return
+    if jobs > 1:
+        raise click.UsageError("--jobs above 1 requires --backend http.")
+    if cache_path is not None:
+        raise click.UsageError("--cache requires --backend http.")
+
+
+def _collect_servers(servers: Tuple[str, ...], servers_from: Optional[TextIO]) -> List[str]:
+    """Combine the servers given as arguments with those listed in a file, one URL per line.
+
+    Raises:
+        click.UsageError: If no server is given at all.
+    """
+    collected = list(servers)
+    if servers_from is not None:
+        lines = (line.split("#", 1)[0].strip() for line in servers_from)
+        collected.extend(line for line in lines if line)
+    if not collected:
+        raise click.UsageError("Missing server. Pass it as argument or list it in --servers-from.")
+    return collected
+
+
+def _assign_arguments(
+    servers: Tuple[str, ...], index_spec: Optional[str], package_specification: Optional[str], stored_plan: bool
+) -> Tuple[Tuple[str, ...], str, Optional[str]]:
+    """Assign the positional arguments, of which the package specification may be omitted when replaying a plan.
+
+    Click fills the optional arguments from the end. Without a package specification, the index specification ends up
+    in its place and the last server, recognizable by its URL scheme, in the place of the index specification.
+
+    Returns:
+        Tuple[Tuple[str, ...], str, Optional[str]]: The servers, the index and the package specification.
+
+    Raises:
+        click.UsageError: If the index specification is missing, or the package specification without a stored plan.
+    """
+    if stored_plan and package_specification is not None and (index_spec is None or "://" in index_spec):
+        servers = servers if index_spec is None else (*servers, index_spec)
+        index_spec, package_specification = package_specification, None
+    if index_spec is None:
+        raise click.UsageError("Missing argument 'user[/index]'.")
+    if package_specification is None and not stored_plan:
+        raise click.UsageError(
+            "Missing argument 'PACKAGE_SPECIFICATION'. It may only be omitted with --plan-in or --resume."
+        )
+    return servers, index_spec, package_specification
+
+
+def _check_server_options(servers: List[str], backend: str, engine: str, *single_server_options: Any) -> None:
+    """Reject options that cannot be combined with several servers.
+
+    Raises:
+        click.UsageError: If several servers are given together with an option supporting only one.
+    """
+    if len(servers) == 1:
+        return
+    if engine != "async" and backend != "http":
+        raise click.UsageError("Cleaning several servers requires --backend http or --engine async.")
+    if any(option is not None for option in single_server_options):
+        raise click.UsageError("--plan-in, --plan-out and --journal support a single server only.")
+
+
+def _check_budget_options(free_bytes: Optional[int], backend: str, engine: str, resume: bool) -> None:
+    """Reject a byte budget if release sizes are unknown or part of the budget may already have been freed.
+
+    Raises:
+        click.UsageError: If `free_bytes` is given with the cli backend or when resuming.
+    """
+    if free_bytes is None:
+        return
+    if backend != "http" and engine != "async":
+        raise click.UsageError("--free-bytes requires --backend http or --engine async to know release sizes.")
+    if resume:
+        raise click.UsageError("--free-bytes cannot be combined with --resume.")
+
+
+def _check_journal_options(journal_path: Optional[str], resume: bool, plan_in: Optional[TextIO]) -> None:
+    """Reject combinations of options that make no sense when resuming from a journal.
+
+    Raises:
+        click.UsageError: If `resume` is set without a journal or together with a plan to read.
+    """
+    if not resume:
+        return
+    if journal_path is None:
+        raise click.UsageError("--resume requires --journal.")
+    if plan_in is not None:
+        raise click.UsageError("--resume cannot be combined with --plan-in.")
+
+
+def _echo_plan(plan: Iterable[Tuple[str, Set[Release]]]) -> Iterator[Tuple[str, Set[Release]]]:
+    """Print the packages to be deleted from each index of the plan while passing it through.
+
+    Yields:
+        Tuple[str, Set[Release]]: The entries of `plan`, each after it has been printed.
+    """
+    for index, packages in plan:
+        click.echo(f"Packages to be deleted from {index}: ")
+        for package in packages:
+            click.echo(f" * {_describe(package)}")
+        yield index, packages
+
+
+def _restrict_to(plan: Iterable[Tuple[str, Set[Release]]], index_spec: str) -> Iterator[Tuple[str, Set[Release]]]:
+    """Pass a plan through, refusing indices that are not covered by the index specification.
+
+    Yields:
+        Tuple[str, Set[Release]]: The entries of `plan`.
+
+    Raises:
+        click.UsageError: If the plan contains an index not covered by `index_spec`.
+    """
+    for index, releases in plan:
+        if index != index_spec and index.split("/")[0] != index_spec:
+            raise click.UsageError(f"The plan contains index {index}, which is not covered by {index_spec}.")
+        yield index, releases
+
+
+def _remove_serially(
+    client,
+    plan: Iterable[Tuple[str, Set[Release]]],
+    force: bool,
+    throttle: SyncThrottle,
+    journal: Optional[RemovalJournal] = None,
+) -> None:
+    """Remove the packages index by index and one after another, stopping at the first failure."""
+    for index, packages in plan:
+        click.echo(f"Cleaning {index}…")
+        with tqdm(total=len(packages), desc=f"Progress: {index}", unit="package", leave=True) as progress:
+            remove_packages(client, index, packages, force, throttle, journal, lambda *_: progress.update(1))
+
+
+def _remove_concurrently(
+    client,
+    plan: Iterable[Tuple[str, Set[Release]]],
+    force: bool,
+    jobs: int,
+    throttle: SyncThrottle,
+    journal: Optional[RemovalJournal] = None,
+) -> RemovalSummary:
+    """Remove the packages index by index, running up to `jobs` removals of an index at the same time."""
+    summary = RemovalSummary()
+    for index, packages in plan:
+        click.echo(f"Cleaning {index}…")
+        with tqdm(total=len(packages), desc=f"Progress: {index}", unit="package", leave=True) as progress:
+            summary.update(
+                remove_packages_concurrently(
+                    client, index, packages, force, jobs, throttle, lambda *_: progress.update(1), journal
+                )
+            )
+    return summary
+
+
+def _report_server_errors(server_errors: Iterable[Tuple[str, DevpiClientError]]) -> None:
+    """Print why servers could not be cleaned and exit with an error if any could not."""
+    server_errors = list(server_errors)
+    for server, error in server_errors:
+        click.echo(f"Failed to clean {server}: {error}", file=sys.stderr)
+    if server_errors:
+        sys.exit(1)
+
+
+def _report(summary: RemovalSummary, server_errors: Iterable[Tuple[str, DevpiClientError]] = ()) -> None:
+    """Print the summary of a removal run and exit with an error if any removal or the run on any server failed."""
+    click.echo(summary)
+    for package, error in summary.failed:
+        click.echo(f"Failed to remove {package}: {error}", file=sys.stderr)
+    _report_server_errors(server_errors)
+    if summary.failed:
+        sys.exit(1)
+
+
+def _journaled(
+    stack: contextlib.ExitStack, plan: Iterable[Tuple[str, Set[Release]]], journal_path: Optional[str], resume: bool
+) -> Tuple[Optional[RemovalJournal], Iterable[Tuple[str, Set[Release]]]]:
+    """Open the journal, if one is given, for the duration of `stack` and record the plan in it.
+
+    A new journal starts with the whole plan, which is therefore listed completely before the first removal. Should
+    listing fail, the journal lacks its `listed` entry and cannot be resumed, instead of silently skipping the indices
+    not listed yet. When resuming, the plan comes from the journal itself and is not recorded again.
+
+    Returns:
+        Tuple[Optional[RemovalJournal], Iterable[Tuple[str, Set[Release]]]]: The journal and the plan to execute.
+    """
+    if journal_path is None:
+        return None, plan
+    journal = stack.enter_context(RemovalJournal(journal_path, resume=resume))
+    if not resume:
+        plan = list(journal.record_plan(plan))
+    return journal, plan
+
+
+def _execute(
+    client,
+    plan: Iterable[Tuple[str, Set[Release]]],
+    force: bool,
+    jobs: int,
+    throttle: SyncThrottle,
+    journal_path: Optional[str],
+    resume: bool,
+) -> None:
+    """Remove the packages of a plan, recording the progress in a journal if one is given."""
+    with contextlib.ExitStack() as stack:
+        journal, plan = _journaled(stack, plan, journal_path, resume)
+        if jobs > 1:
+            _report(_remove_concurrently(client, plan, force, jobs, throttle, journal))
+        else:
+            _remove_serially(client, plan, force, throttle, journal)
+
+
+def _stored_plan(
+    index_spec: str, plan_in: Optional[TextIO], journal_path: Optional[str], resume: bool
+) -> Optional[Iterable[Tuple[str, Set[Release]]]]:
+    """Return the plan of the journal to resume or the one given with --plan-in, or None if indices must be listed.
+
+    Raises:
+        click.ClickException: If the journal to resume was interrupted before all indices were listed.
+    """
+    if resume and journal_path is not None:
+        state = load_journal(journal_path)
+        if not state.complete:
+            raise click.ClickException(
+                f"The run recorded in {journal_path} was interrupted while listing the indices, before anything was "
+                "removed. Run it again without --resume."
+            )
+        return _restrict_to(state.plan, index_spec)
+    if plan_in is not None:
+        return _restrict_to(read_plan(plan_in), index_spec)
+    return None
+
+
+def _confirm(
+    plan: Iterable[Tuple[str, Set[Release]]], plan_out: Optional[TextIO], dry_run: bool, batch: bool
+) -> Optional[Iterable[Tuple[str, Set[Release]]]]:
+    """Show and record the plan and ask for confirmation.
+
+    Returns:
+        Optional[Iterable[Tuple[str, Set[Release]]]]: The plan to execute or None if nothing is to be removed.
+    """
+    plan = _echo_plan(plan)
+    if plan_out is not None:
+        plan = record_plan(plan, plan_out)
+
+    if dry_run:
+        deque(plan, maxlen=0)
+        return None
+
+    # Without confirmation, indices are cleaned as soon as they have been listed instead of listing all first.
+    if not batch:
+        plan = list(plan)
+        confirmation: str = click.prompt('Enter "yes" to confirm', type=str)
+        if confirmation != "yes":
+            click.echo("Aborting...")
+            return None
+    return plan
+
+
+def _within_budget(
+    plan: Iterable[Tuple[str, Set[Release]]], free_bytes: Optional[int]
+) -> Iterable[Tuple[str, Set[Release]]]:
+    """Limit a plan to the largest releases needed to free `free_bytes`, if given."""
+    return plan if free_bytes is None else limit_to_budget(plan, free_bytes)
+
+
+def _confirm_servers(
+    servers: List[str],
+    plans: List[List[Tuple[str, Set[Release]]]],
+    confirm: Callable[[Iterable[Tuple[str, Set[Release]]]], Optional[Iterable[Tuple[str, Set[Release]]]]],
+) -> bool:
+    """Show the plans of all servers as one and ask for confirmation once.
+
+    Returns:
+        bool: Whether to go ahead with the removal.
+    """
+    aggregated = [
+        (index if len(servers) == 1 else f"{index} on {server}", releases)
+        for server, plan in zip(servers, plans, strict=True)
+        for index, releases in plan
+    ]
+    confirmed = confirm(aggregated)
+    if confirmed is None:
+        return False
+    deque(confirmed, maxlen=0)
+    return True
+
+
+def _on_server(action: Callable[..., Any], server_errors: List[Tuple[str, DevpiClientError]]) -> Callable[..., Any]:
+    """Wrap a step of cleaning a server so that a failure is recorded in `server_errors` instead of raised.
+
+    The wrapped step is called with the server and the results of the earlier steps for that server. It returns None
+    if the step fails or is skipped because an earlier one failed, so that the other servers can go on.
+    """
+
+    def run(server: str, *server_args: Any) -> Any:
+        if any(arg is None for arg in server_args):
+            return None
+        try:
+            return action(*server_args)
+        except DevpiClientError as error:
+            server_errors.append((server, error))
+            return None
+
+    return run
+
+
+def _on_server_async(
+    action: Callable[..., Awaitable[Any]], server_errors: List[Tuple[str, DevpiClientError]]
+) -> Callable[..., Awaitable[Any]]:
+    """Wrap an asynchronous step of cleaning a server like `_on_server` does."""
+
+    async def run(server: str, *server_args: Any) -> Any:
+        if any(arg is None for arg in server_args):
+            return None
+        try:
+            return await action(*server_args)
+        except DevpiClientError as error:
+            server_errors.append((server, error))
+            return None
+
+    return run
+
+
+def _combine(summaries: Iterable[Optional[RemovalSummary]]) -> RemovalSummary:
+    """Combine the summaries of several servers, leaving out those that failed."""
+    combined = RemovalSummary()
+    for summary in summaries:
+        if summary is not None:
+            combined.update(summary)
+    return combined
+
+
+def _clean_servers(
+    servers: List[str],
+    connect: Callable[[str], Any],
+    jobs: int,
+    listing: Dict[str, Any],
+    confirm: Callable[[Iterable[Tuple[str, Set[Release]]]], Optional[Iterable[Tuple[str, Set[Release]]]]],
+    force: bool,
+    sync_check_interval: float,
+    free_bytes: Optional[int],
+) -> None:
+    """Connect to, list and clean several servers at the same time, each from its own thread with its own client.
+
+    The servers are independent of each other. If connecting to, listing or cleaning one of them fails, the others are
+    still cleaned and the error is reported together with their summary at the end.
+    """
+    server_errors: List[Tuple[str, DevpiClientError]] = []
+
+    def on_each_server(action: Callable[..., Any], *args: List[Any]) -> List[Any]:
+        return list(executor.map(_on_server(action, server_errors), servers, *args))
+
+    with contextlib.ExitStack() as stack, ThreadPoolExecutor(max_workers=len(servers)) as executor:
+        lock = threading.Lock()
+
+        def connect_server(server: str) -> Any:
+            connection = connect(server)
+            client = connection.__enter__()
+            with lock:
+                stack.push(connection.__exit__)
+            return client
+
+        def list_server(client) -> List[Tuple[str, Set[Release]]]:
+            return list(_within_budget(iter_packages_by_index(client=client, jobs=jobs, **listing), free_bytes))
+
+        def clean_server(client, plan: List[Tuple[str, Set[Release]]]) -> RemovalSummary:
+            throttle = SyncThrottle(client, check_interval=sync_check_interval)
+            summary = RemovalSummary()
+            for index, packages in plan:
+                summary.update(remove_packages_concurrently(client, index, packages, force, jobs, throttle))
+            return summary
+
+        clients = on_each_server(connect_server, servers)
+        plans = on_each_server(list_server, clients)
+        # A server that could not be listed has nothing to clean.
+        if not _confirm_servers(servers, [plan or [] for plan in plans], confirm):
+            _report_server_errors(server_errors)
+            return
+
+        click.echo(f"Cleaning {len(servers)} servers…")
+        summary = _combine(on_each_server(clean_server, clients, plans))
+    _report(summary, server_errors)
+
+
+async def _list_async(
+    async_client,
+    client,
+    plan: Optional[Iterable[Tuple[str, Set[Release]]]],
+    listing: Dict[str, Any],
+    free_bytes: Optional[int],
+) -> List[Tuple[str, Set[Release]]]:
+    """List the plan of a server with the asyncio engine, unless a stored plan is given."""
+    if plan is not None:
+        return list(_within_budget(plan, free_bytes))
+    server_plan = await async_client.list_packages_by_index(client, **listing)
+    return list(_within_budget(server_plan.items(), free_bytes))
+
+
+def _clean_async(
+    servers: List[str],
+    user: str,
+    password: str,
+    jobs: int,
+    plan: Optional[Iterable[Tuple[str, Set[Release]]]],
+    listing: Dict[str, Any],
+    confirm: Callable[[Iterable[Tuple[str, Set[Release]]]], Optional[Iterable[Tuple[str, Set[Release]]]]],
+    force: bool,
+    sync_check_interval: float,
+    journal_path: Optional[str],
+    resume: bool,
+    free_bytes: Optional[int],
+) -> None:
+    """List and clean the indices of all servers with the asyncio engine, with up to `jobs` requests in flight each.
+
+    A plan and a journal can only be given for a single server. As with the threads of `_clean_servers`, a server that
+    fails does not stop the others. Its error is reported together with their summary at the end.
+
+    Raises:
+        click.UsageError: If httpx is not installed.
+    """
+    try:
+        from devpi_cleaner import async_client
+    except ImportError as error:
+        raise click.UsageError("--engine async requires httpx. Install devpi-cleaner[async].") from error
+
+    server_errors: List[Tuple[str, DevpiClientError]] = []
+
+    async def on_each_server(action: Callable[..., Awaitable[Any]], *args: List[Any]) -> List[Any]:
+        run = _on_server_async(action, server_errors)
+        return await async_client.gather_all(*(run(*server_args) for server_args in zip(servers, *args, strict=True)))
+
+    async def clean() -> Optional[RemovalSummary]:
+        async with contextlib.AsyncExitStack() as async_stack:
+
+            async def connect_server(server: str) -> Any:
+                return await async_stack.enter_async_context(
+                    async_client.AsyncDevpiHttpClient(server, user, password, max_connections=jobs)
+                )
+
+            def list_server(client) -> Awaitable[List[Tuple[str, Set[Release]]]]:
+                return _list_async(async_client, client, plan, listing, free_bytes)
+
+            clients = await on_each_server(connect_server, servers)
+            plans = await on_each_server(list_server, clients)
+            # A server that could not be listed has nothing to clean.
+            listed = [server_plan or [] for server_plan in plans]
+            if not _confirm_servers(servers, listed, confirm):
+                return None
+
+            with contextlib.ExitStack() as stack:
+                journal = None
+                if plans[0] is not None:
+                    journal, plans[0] = _journaled(stack, plans[0], journal_path, resume)
+                click.echo(f"Cleaning {sum(len(server_plan) for server_plan in listed)} indices…")
+                total = sum(len(packages) for server_plan in listed for _, packages in server_plan)
+                with tqdm(total=total, desc="Progress", unit="package", leave=True) as progress:
+
+                    def clean_server(client, server_plan: List[Tuple[str, Set[Release]]]) -> Awaitable[RemovalSummary]:
+                        throttle = async_client.AsyncSyncThrottle(client, check_interval=sync_check_interval)
+                        return async_client.remove_plan(
+                            client, server_plan, force, throttle, journal, lambda *_: progress.update(1)
+                        )
+
+                    return _combine(await on_each_server(clean_server, clients, plans))
+
+    summary = asyncio.run(clean())
+    if summary is None:
+        _report_server_errors(server_errors)
+    else:
+        _report(summary, server_errors)
 
 
 @click.command()
-@click.argument("server")
-@click.argument("index_spec", metavar="user[/index]")
-@click.argument("package_specification")
+@click.argument("servers", metavar="[SERVER]...", nargs=-1)
+@click.argument("index_spec", metavar="user[/index]", required=False)
+@click.argument("package_specification", required=False)
 @click.option(
     "--keep-latest",
-    help="Number of latest versions to retain after applying filters. Older versions beyond this count will be removed.",
+    help="Number of latest versions to retain per project after applying filters. Older versions beyond this count will be removed.",
     default=3,
 )
 @click.option("--batch", is_flag=True, help="Assume yes on confirmation questions.")
@@ -35,10 +602,80 @@ from devpi_cleaner.client import remove_package
     "--login", help="The user name to user for authentication. Defaults to the user of the indices to operate on."
 )
 @click.option("--password", help="The password with which to authenticate.")
+@click.option(
+    "--servers-from",
+    metavar="PATH",
+    type=click.File("r"),
+    help="Also clean the servers listed in PATH, one URL per line. Several servers are listed and cleaned at the same time, each with its own --jobs and throttle.",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["cli", "http"]),
+    default="cli",
+    help="How to talk to the server: by invoking the devpi command line client or via its HTTP API directly. Defaults to cli.",
+)
+@click.option(
+    "--cache",
+    "cache_path",
+    metavar="PATH",
+    type=click.Path(dir_okay=False),
+    help="SQLite file in which to cache listings between runs. Only indices that changed are listed again. Requires the http backend.",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["sync", "async"]),
+    default="sync",
+    help="How to run requests: from threads using the chosen backend, or all from a single asyncio event loop via the HTTP API. The async engine lists all indices first and requires httpx. Defaults to sync.",
+)
+@click.option(
+    "--jobs",
+    metavar="N",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of indices to list and removals to run concurrently per server. Values above 1 require the http backend and also let listing continue while an index is cleaned. With --engine async, the number of requests in flight per server. Defaults to 1.",
+)
+@click.option(
+    "--free-bytes",
+    metavar="SIZE",
+    type=ByteSize(),
+    help="Only remove the largest of the selected releases until SIZE bytes, e.g. 200GiB, are freed on each server. Requires the http backend or the async engine.",
+)
+@click.option("--dry-run", is_flag=True, help="Only show the packages that would be deleted.")
+@click.option(
+    "--plan-out",
+    metavar="PATH",
+    type=click.File("w"),
+    help="Write the packages to be deleted to PATH as JSON lines, e.g. for review in combination with --dry-run.",
+)
+@click.option(
+    "--plan-in",
+    metavar="PATH",
+    type=click.File("r"),
+    help="Delete the packages from a plan written with --plan-out instead of listing the indices again. The package specification may then be omitted.",
+)
+@click.option(
+    "--sync-check-interval",
+    metavar="SECONDS",
+    type=float,
+    default=10.0,
+    help="Minimal interval between checks of replica lag and index queue. Removals are slowed down while either is too high. Defaults to 10.",
+)
+@click.option(
+    "--journal",
+    "journal_path",
+    metavar="PATH",
+    type=click.Path(dir_okay=False),
+    help="Record the plan and every completed removal in PATH, so that an interrupted run can be resumed. All indices are listed before the first removal. An existing journal is overwritten unless --resume is given.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue the run recorded in the journal given with --journal instead of listing the indices again. Indices left volatile by the interrupted run are restored.",
+)
 def clean_devpi_packages(
-    server: str,
-    index_spec: str,
-    package_specification: str,
+    servers: Tuple[str, ...],
+    index_spec: Optional[str],
+    package_specification: Optional[str],
     keep_latest: Optional[int],
     batch: bool,
     dev_only: bool,
@@ -46,39 +683,82 @@ def clean_devpi_packages(
     force: bool,
     password: Optional[str],
     login: Optional[str],
+    servers_from: Optional[TextIO],
+    backend: str,
+    cache_path: Optional[str],
+    engine: str,
+    jobs: int,
+    free_bytes: Optional[int],
+    dry_run: bool,
+    plan_out: Optional[TextIO],
+    plan_in: Optional[TextIO],
+    sync_check_interval: float,
+    journal_path: Optional[str],
+    resume: bool,
 ) -> None:
+    servers, index_spec, package_specification = _assign_arguments(
+        servers, index_spec, package_specification, stored_plan=plan_in is not None or resume
+    )
+    server_urls = _collect_servers(servers, servers_from)
+    _check_server_options(server_urls, backend, engine, plan_in, plan_out, journal_path)
+    _check_backend_options(backend, engine, jobs, cache_path)
+    _check_journal_options(journal_path, resume, plan_in)
+    _check_budget_options(free_bytes, backend, engine, resume)
+
     login_user: str = login if login else index_spec.split("/")[0]
     if password is None:
         password = getpass.getpass()
 
+    listing: Dict[str, Any] = {
+        "index_spec": index_spec,
+        "package_spec": package_specification,
+        "only_dev": dev_only,
+        "version_filter": version_filter,
+        "keep_latest": keep_latest,
+    }
+
+    def confirm(plan: Iterable[Tuple[str, Set[Release]]]) -> Optional[Iterable[Tuple[str, Set[Release]]]]:
+        return _confirm(plan, plan_out, dry_run, batch)
+
     try:
-        with DevpiClient(server, login_user, password) as client:
-            version_filter_pattern: Optional[Pattern[str]] = re.compile(version_filter) if version_filter else None
-            packages_by_index: Dict[str, Set[Package]] = list_packages_by_index(
-                client=client,
-                index_spec=index_spec,
-                package_spec=package_specification,
-                only_dev=dev_only,
-                version_filter=version_filter_pattern,
-                keep_latest=keep_latest,
+        if engine == "async":
+            plan = _stored_plan(index_spec, plan_in, journal_path, resume)
+            _clean_async(
+                server_urls,
+                login_user,
+                password,
+                jobs,
+                plan,
+                listing,
+                confirm,
+                force,
+                sync_check_interval,
+                journal_path,
+                resume,
+                free_bytes,
             )
-
-            for index, packages in packages_by_index.items():
-                click.echo(f"Packages to be deleted from {index}: ")
-                for package in packages:
-                    click.echo(f" * {package}")
-
-            if not batch:
-                confirmation: str = click.prompt('Enter "yes" to confirm', type=str)
-                if confirmation != "yes":
-                    click.echo("Aborting...")
-                    return
-
-            for index, packages in packages_by_index.items():
-                click.echo(f"Cleaning {index}…")
-                # Explicitly marks package iterator with progress bar
-                for package in tqdm(list(packages), desc=f"Progress: {index}", unit="package", leave=True):
-                    remove_package(client, index, package, force)
+            return
+        if len(server_urls) > 1:
+            _clean_servers(
+                server_urls,
+                lambda server: _connect(backend, server, login_user, password, cache_path, jobs),
+                jobs,
+                listing,
+                confirm,
+                force,
+                sync_check_interval,
+                free_bytes,
+            )
+            return
+        with _connect(backend, server_urls[0], login_user, password, cache_path, jobs) as client:
+            plan = _stored_plan(index_spec, plan_in, journal_path, resume)
+            if plan is None:
+                plan = iter_packages_by_index(client=client, jobs=jobs, **listing)
+            plan = confirm(_within_budget(plan, free_bytes))
+            if plan is None:
+                return
+            throttle = SyncThrottle(client, check_interval=sync_check_interval)
+            _execute(client, plan, force, jobs, throttle, journal_path, resume)
     except DevpiClientError as client_error:
         click.echo(client_error, file=sys.stderr)
         sys.exit(1)
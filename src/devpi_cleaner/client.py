@@ -1,92 +1,76 @@
-import re
+import logging
+import threading
 import time
-from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from itertools import chain
+from itertools import islice
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
-from typing import Pattern
 from typing import Set
 from typing import Tuple
 
+from devpi_plumber.client import DevpiClientError
 from devpi_plumber.client import volatile_index
-from packaging.version import Version
 from tenacity import retry
 from tenacity import retry_if_result
 from tenacity import stop_after_delay
 from tenacity import wait_fixed
 
-_TAR_GZ_END = ".tar.gz"
-_TAR_BZ2_END = ".tar.bz2"
-_ZIP_END = ".zip"
-_WHL_END = ".whl"
-_EGG_END = ".egg"
+from devpi_cleaner.packages import Package
+from devpi_cleaner.packages import Release
+from devpi_cleaner.packages import expand_name_pattern
+from devpi_cleaner.packages import group_by_project
+from devpi_cleaner.packages import group_into_releases
+from devpi_cleaner.packages import group_versions
+from devpi_cleaner.packages import has_name_pattern
+from devpi_cleaner.packages import known_size
+from devpi_cleaner.packages import largest_first
+from devpi_cleaner.packages import select_releases
 
-PACKAGE_EXTENSIONS = (_TAR_GZ_END, _TAR_BZ2_END, _ZIP_END, _EGG_END)
+if TYPE_CHECKING:
+    from devpi_cleaner.journal import RemovalJournal
 
 
-def _extract_name_and_version(filename: str) -> Tuple[str, str]:
-    """Extract the package name and version from a filename.
+def _fill_in_sizes(client, releases: Iterable[Release]) -> None:
+    """Look up the sizes of the releases' files if the client is able to, all of them in a single batch."""
+    file_sizes = getattr(client, "file_sizes", None)
+    if file_sizes is None:
+        return
+    releases = list(releases)
+    sizes = file_sizes([url for release in releases for url in release.files])
+    for release in releases:
+        for url in release.files:
+            release.files[url] = sizes.get(url)
+
+
+def _expand_package_spec(client, index: str, package_spec: str) -> List[str]:
+    """Resolve a glob pattern in the project name of a package specification against the projects of an index.
 
     Args:
-        filename (str): The name of the package file.
+        client: The Devpi client instance.
+        index (str): The index whose projects to match.
+        package_spec (str): The package specification, e.g. `delete_*<1.0`.
 
     Returns:
-        Tuple[str, str]: A tuple containing the package name and version.
-
-    Raises:
-        NotImplementedError: If the package type is unknown.
+        List[str]: One specification per matching project, with the version constraints of the original one. A
+            specification without glob pattern is returned unchanged without asking the server.
     """
-    path = Path(filename)
-    if path.suffix in (_WHL_END, _EGG_END):
-        parts = path.stem.split("-")[:2]
-        if len(parts) != 2:
-            raise NotImplementedError(f"Cannot extract name and version from {filename}.")
-        return tuple(parts)  # noqa: return-value
-
-    parts = filename.rsplit("-", 1)
-    if len(parts) < 2 or not parts[1][0].isdigit():
-        parts = filename.split("-")
-        name = "-".join(parts[:-2])
-        version_and_ext = "-".join(parts[-2:])
-    else:
-        name, version_and_ext = parts
-
-    for extension in PACKAGE_EXTENSIONS:
-        if version_and_ext.endswith(extension):
-            return name, version_and_ext[: -len(extension)]
-
-    raise NotImplementedError(f"Unknown package type. Cannot extract version from {filename}.")
-
-
-class Package:
-    def __init__(self, package_url: str):
-        # example URL http://localhost:2414/user/index1/+f/45b/301745c6d8bbf/delete_me-0.1.tar.gz
-        parts = package_url.rsplit("/", 6)
-        self.index = f"{parts[1]}/{parts[2]}"
-        self.name, self.version = _extract_name_and_version(parts[-1])
-
-    def __str__(self) -> str:
-        return f"{self.name} {self.version} on {self.index}"
-
-    @property
-    def is_dev_package(self) -> bool:
-        return ".dev" in self.version
-
-    def __eq__(self, other: object) -> bool:
-        if not isinstance(other, Package):
-            return False
-        return self.index == other.index and self.name == other.name and self.version == other.version
-
-    def __ne__(self, other: object) -> bool:
-        return not self.__eq__(other)
-
-    def __hash__(self) -> int:
-        return hash((self.index, self.name, self.version))
+    if not has_name_pattern(package_spec):
+        return [package_spec]
+    return expand_name_pattern(package_spec, client.get_json(f"/{index}")["result"].get("projects", []))
 
 
 def _list_packages_on_index(
     client, index: str, package_spec: str, only_dev: bool, version_filter: Optional[str], keep_latest: int = 0
-) -> Set[Package]:
+) -> Set[Release]:
     """List all packages on a specific index that match the given criteria.
 
     Args:
@@ -95,31 +79,23 @@ def _list_packages_on_index(
         package_spec (str): The package specification.
         only_dev (bool): Whether to only include development packages.
         version_filter (Optional[str]): The regular expression to filter versions.
-        keep_latest (int): The maximum number of the latest packages to keep.
+        keep_latest (int): The number of latest versions to keep per project.
 
     Returns:
-        Set[Package]: A set of Package objects that match the criteria.
+        Set[Release]: A set of Release objects that match the criteria.
     """
-    version_filter_pattern: Optional[Pattern[str]] = re.compile(version_filter) if version_filter else None
-
-    def selector(package: Package) -> bool:
-        return (
-            package.index == index
-            and (not only_dev or package.is_dev_package)
-            and (version_filter_pattern is None or version_filter_pattern.search(package.version))
+    # Only list the index's own files. Inherited ones are not removable from it and would be listed again for every
+    # index sharing the same base.
+    all_releases = group_into_releases(
+        chain.from_iterable(
+            client.list("--index", index, "--all", "--ignore-bases", spec)
+            for spec in _expand_package_spec(client, index, package_spec)
         )
+    )
 
-    client.use(index)
-
-    all_packages = {
-        Package(package_url)
-        for package_url in client.list("--index", index, "--all", package_spec)
-        if package_url.startswith(("http://", "https://"))
-    }
-
-    sorted_packages = sorted((p for p in all_packages if selector(p)), key=lambda p: Version(p.version), reverse=True)
-
-    return set(sorted_packages[max(keep_latest, 0) :])
+    selected_releases = select_releases(all_releases, index, only_dev, version_filter, keep_latest)
+    _fill_in_sizes(client, selected_releases)
+    return selected_releases
 
 
 def _get_indices(client, index_spec: str) -> List[str]:
@@ -136,9 +112,77 @@ def _get_indices(client, index_spec: str) -> List[str]:
     return [index_spec] if len(spec_parts) > 1 else client.list_indices(user=index_spec)
 
 
+def iter_packages_by_index(
+    client,
+    index_spec: str,
+    package_spec: str,
+    only_dev: bool,
+    version_filter: Optional[str],
+    keep_latest: int = 0,
+    jobs: int = 1,
+) -> Iterator[Tuple[str, Set[Release]]]:
+    """Yield the packages matching the given criteria index by index as soon as each index has been listed.
+
+    Indices are only listed as the results are consumed, so at most a few indices' packages are held in memory at any
+    time. With `jobs` of 1, each index is listed only once the consumer has finished with the previous one, so listing
+    and the consumer's work do not overlap. This keeps clients that are not thread-safe, such as the devpi command line
+    wrapper, on a single thread. With `jobs` above 1, up to that many indices are listed concurrently, the next listing
+    already runs while the consumer acts on an index, and results are yielded in the order in which the listings
+    finish. The client must then be safe to use from several threads.
+
+    Args:
+        client: The Devpi client instance.
+        index_spec (str): The index specification.
+        package_spec (str): The package specification.
+        only_dev (bool): Whether to only include development packages.
+        version_filter (Optional[str]): The regular expression to filter versions.
+        keep_latest (int): The number of latest versions to keep per project.
+        jobs (int): The maximal number of indices to list at the same time.
+
+    Yields:
+        Tuple[str, Set[Release]]: An index name and the set of matching Release objects on it.
+    """
+    indices = _get_indices(client=client, index_spec=index_spec)
+
+    def list_index(index: str) -> Tuple[str, Set[Release]]:
+        return index, _list_packages_on_index(
+            client=client,
+            index=index,
+            package_spec=package_spec,
+            only_dev=only_dev,
+            version_filter=version_filter,
+            keep_latest=keep_latest,
+        )
+
+    if jobs <= 1:
+        yield from map(list_index, indices)
+        return
+
+    # Only keep `jobs` listings in flight so that results do not pile up while the consumer is busy removing. The next
+    # listing is started before a result is handed out, so listing continues while the consumer processes it.
+    remaining = iter(indices)
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        pending = {executor.submit(list_index, index) for index in islice(remaining, jobs)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for index in islice(remaining, 1):
+                    pending.add(executor.submit(list_index, index))
+                yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def list_packages_by_index(
-    client, index_spec: str, package_spec: str, only_dev: bool, version_filter: Optional[str], keep_latest: int = 0
-) -> Dict[str, Set[Package]]:
+    client,
+    index_spec: str,
+    package_spec: str,
+    only_dev: bool,
+    version_filter: Optional[str],
+    keep_latest: int = 0,
+    jobs: int = 1,
+) -> Dict[str, Set[Release]]:
     """List all packages by index that match the given criteria.
 
     Args:
@@ -147,22 +191,56 @@ def list_packages_by_index(
         package_spec (str): The package specification.
         only_dev (bool): Whether to only include development packages.
         version_filter (Optional[str]): The regular expression to filter versions.
-        keep_latest (int): The maximum number of the latest packages to keep.
+        keep_latest (int): The number of latest versions to keep per project.
+        jobs (int): The maximal number of indices to list at the same time.
 
     Returns:
-        Dict[str, Set[Package]]: A dictionary mapping index names to sets of Package objects.
+        Dict[str, Set[Release]]: A dictionary mapping index names to sets of Release objects.
     """
-    return {
-        index: _list_packages_on_index(
+    return dict(
+        iter_packages_by_index(
             client=client,
-            index=index,
+            index_spec=index_spec,
             package_spec=package_spec,
             only_dev=only_dev,
             version_filter=version_filter,
             keep_latest=keep_latest,
+            jobs=jobs,
         )
-        for index in _get_indices(client=client, index_spec=index_spec)
-    }
+    )
+
+
+def limit_to_budget(plan: Iterable[Tuple[str, Set[Release]]], free_bytes: int) -> List[Tuple[str, Set[Release]]]:
+    """Reduce a plan to the largest releases needed to free a number of bytes.
+
+    Releases of all indices of the plan are taken largest first until their total size reaches `free_bytes`, so as few
+    releases as possible are removed. Releases of unknown size are only taken once all others do not suffice. As the
+    plan only contains releases selected for removal, the version based criteria still apply.
+
+    Args:
+        plan (Iterable[Tuple[str, Set[Release]]]): The releases to remove grouped by index.
+        free_bytes (int): The number of bytes to free.
+
+    Returns:
+        List[Tuple[str, Set[Release]]]: The indices with releases to remove, the index freeing the most bytes first.
+    """
+    plan = list(plan)
+    candidates = sorted(
+        (release for _, releases in plan for release in releases),
+        key=lambda r: (r.size is not None, known_size(r)),
+        reverse=True,
+    )
+    selected: Set[Release] = set()
+    freed = 0
+    for release in candidates:
+        if freed >= free_bytes:
+            break
+        selected.add(release)
+        freed += known_size(release)
+
+    limited = [(index, releases & selected) for index, releases in plan]
+    limited.sort(key=lambda entry: sum(known_size(release) for release in entry[1]), reverse=True)
+    return [(index, releases) for index, releases in limited if releases]
 
 
 def get_index_queue_size(metrics: List[Tuple[str, ...]]) -> int:
@@ -189,24 +267,293 @@ def _should_retry(result: tuple) -> bool:
     return not (last_in_sync_ok and queue_size_ok)
 
 
-@retry(stop=stop_after_delay(1800), wait=wait_fixed(10), retry=retry_if_result(_should_retry))
-def wait_for_sync(client) -> tuple[bool, bool]:
-    """Check synchronization status and return tuple of conditions."""
-    status = client.get_json("/+status")["result"]
+def _check_sync(client, max_replica_lag: float = 60.0, max_queue_size: int = 100) -> tuple[bool, bool]:
+    """Probe the server status once and return whether replicas and the index queue are within their limits."""
+    return is_in_sync(client.get_json("/+status")["result"], max_replica_lag, max_queue_size)
+
+
+def is_in_sync(status: Dict[str, Any], max_replica_lag: float, max_queue_size: int) -> tuple[bool, bool]:
+    """Return whether replicas and the index queue are within their limits according to a server status."""
     current_time = time.time()
 
     last_in_sync = float(status.get("replica-in-sync-at", current_time))
-    last_in_sync_ok = last_in_sync > current_time - 60
+    last_in_sync_ok = last_in_sync > current_time - max_replica_lag
 
     metrics = status.get("metrics", [])
-    queue_size_ok = get_index_queue_size(metrics) < 100
+    queue_size_ok = get_index_queue_size(metrics) < max_queue_size
 
     return last_in_sync_ok, queue_size_ok
 
 
+@retry(stop=stop_after_delay(1800), wait=wait_fixed(10), retry=retry_if_result(_should_retry))
+def wait_for_sync(client) -> tuple[bool, bool]:
+    """Check synchronization status and return tuple of conditions."""
+    return _check_sync(client)
+
+
+class SyncThrottle:
+    """Rate limit removals based on how well a Devpi server keeps up with them.
+
+    The server status is probed at most once per `check_interval` seconds. While replicas are in sync and the Whoosh
+    index queue is short, removals run at full speed. Once either goes over its threshold, removals are limited by a
+    token bucket. Its rate is halved on every unhealthy probe and doubled on every healthy one until the limit is lifted
+    again. If the server is still unhealthy at `min_rate`, removals pause until it has caught up.
+
+    Args:
+        client: The Devpi client instance.
+        check_interval (float): Minimal number of seconds between two status probes.
+        max_replica_lag (float): Number of seconds replicas may lag behind before removals are slowed down.
+        max_queue_size (int): Length of the index queue from which on removals are slowed down.
+        max_rate (float): Removals per second at which throttling kicks in and above which it is lifted again.
+        min_rate (float): Removals per second below which removals pause until the server has caught up.
+        timeout (float): Number of seconds to wait for an unhealthy server before giving up.
+    """
+
+    def __init__(
+        self,
+        client,
+        check_interval: float = 10.0,
+        max_replica_lag: float = 60.0,
+        max_queue_size: int = 100,
+        max_rate: float = 10.0,
+        min_rate: float = 0.1,
+        timeout: float = 1800.0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self._client = client
+        self._check_interval = check_interval
+        self._max_replica_lag = max_replica_lag
+        self._max_queue_size = max_queue_size
+        self._max_rate = max_rate
+        self._min_rate = min_rate
+        self._timeout = timeout
+        self._clock = clock
+        self._sleep = sleep
+
+        self._lock = threading.Lock()
+        self._rate: Optional[float] = None
+        self._tokens = 0.0
+        self._last_check: Optional[float] = None
+        self._last_refill = clock()
+
+    @property
+    def rate(self) -> Optional[float]:
+        """The current limit in removals per second or None if removals are not limited."""
+        return self._rate
+
+    def _is_healthy(self) -> bool:
+        return all(_check_sync(self._client, self._max_replica_lag, self._max_queue_size))
+
+    def _wait_until_healthy(self) -> None:
+        deadline = self._clock() + self._timeout
+        while not self._is_healthy():
+            if self._clock() >= deadline:
+                raise DevpiClientError(f"Devpi server did not catch up within {self._timeout} seconds.")
+            self._sleep(self._check_interval)
+
+    def _probe(self) -> None:
+        self._last_check = self._clock()
+        if self._is_healthy():
+            if self._rate is not None:
+                self._rate *= 2
+                if self._rate >= self._max_rate:
+                    self._rate = None
+        elif self._rate is None:
+            self._rate = self._max_rate / 2
+            self._tokens = 0.0
+        elif self._rate > self._min_rate:
+            self._rate = max(self._rate / 2, self._min_rate)
+        else:
+            self._wait_until_healthy()
+            self._last_check = self._clock()
+        self._last_refill = self._clock()
+
+    def acquire(self) -> None:
+        """Block until the next removal may be issued.
+
+        Concurrent callers reserve their slots one after another, so the rate applies to all of them together. The
+        wait for a slot happens outside of the lock, only a pause for an unhealthy server blocks all callers.
+        """
+        with self._lock:
+            delay = self._reserve()
+        if delay > 0:
+            self._sleep(delay)
+
+    def _reserve(self) -> float:
+        """Take a token from the bucket and return the number of seconds to wait until it becomes available."""
+        if self._last_check is None or self._clock() - self._last_check >= self._check_interval:
+            self._probe()
+
+        if self._rate is None:
+            return 0.0
+
+        now = self._clock()
+        self._tokens = min(self._tokens + (now - self._last_refill) * self._rate, max(self._rate, 1.0))
+        self._last_refill = now
+        # The balance may go negative: each caller waits for the tokens reserved by the ones before it.
+        self._tokens -= 1
+        return max(-self._tokens, 0.0) / self._rate
+
+
+def _project_versions(client, index: str, name: str) -> Set[str]:
+    """Return the versions of a project on an index without inherited ones, or an empty set if they are unknown."""
+    try:
+        return set(client.get_json(f"/{index}/{name}?ignore_bases")["result"])
+    except DevpiClientError as error:
+        logging.warning("Failed to look up the versions of %s on %s, removing them one by one: %s", name, index, error)
+        return set()
+
+
+def _plan_removals(client, index: str, packages: Iterable[Package]) -> List[Tuple[str, List[Package]]]:
+    """Group packages into as few removal specifications as possible.
+
+    A project of which every version on the index is to be removed is removed as a whole with a single call. Of other
+    projects, each run of adjacent versions is removed with one version range, unless the range would match a version
+    that is to be kept. The versions on the index are looked up when removing rather than taken from the plan, so that
+    versions uploaded after the plan was made are never removed. Removals freeing the most bytes come first.
+
+    Args:
+        client: The Devpi client instance.
+        index (str): The index to remove the packages from.
+        packages (Iterable[Package]): The packages to remove.
+
+    Returns:
+        List[Tuple[str, List[Package]]]: The specifications to pass to `remove`, each with the packages it removes.
+    """
+    removals: List[Tuple[str, List[Package]]] = []
+    for name, project_packages in group_by_project(packages).items():
+        # Looking up a project's versions only pays off if more than one of them is to be removed.
+        present = _project_versions(client, index, name) if len(project_packages) > 1 else set()
+        removals.extend(group_versions(name, project_packages, present))
+    return largest_first(removals)
+
+
+def remove_packages(
+    client,
+    index: str,
+    packages: Iterable[Package],
+    force: bool,
+    throttle: Optional[SyncThrottle] = None,
+    journal: Optional["RemovalJournal"] = None,
+    callback: Optional[Callable[[Package, Optional[DevpiClientError]], None]] = None,
+) -> None:
+    """Remove packages from a specific index on the Devpi server.
+
+    The index is made volatile once for the whole batch and its original setting is restored afterwards, even if the
+    removal is interrupted or fails. Packages are removed with as few calls as possible, see `_plan_removals`.
+
+    Args:
+        client: The Devpi client instance.
+        index (str): The index to remove the packages from.
+        packages (Iterable[Package]): The packages to remove. All of them must reside on `index`.
+        force (bool): Whether to temporarily make a non-volatile index volatile.
+        throttle (Optional[SyncThrottle]): The throttle to pace removals with. Defaults to a new one for `client`.
+        journal (Optional[RemovalJournal]): The journal to record removals and volatility changes in, if any.
+        callback (Optional[Callable]): Called with each package and None once it has been removed.
+    """
+    packages = list(packages)
+    assert all(package.index == index for package in packages)
+    if throttle is None:
+        throttle = SyncThrottle(client)
+
+    with volatile_index(client, index, force) if journal is None else journal.volatile_index(client, index, force):
+        for spec, removed in _plan_removals(client, index, packages):
+            throttle.acquire()
+            client.remove("--index", index, spec)
+            for package in removed:
+                if journal is not None:
+                    journal.removed(package)
+                if callback is not None:
+                    callback(package, None)
+
+
+class RemovalSummary:
+    """The outcome of removing a set of packages, with errors collected per package instead of aborting."""
+
+    def __init__(self) -> None:
+        self.removed: List[Package] = []
+        self.failed: List[Tuple[Package, DevpiClientError]] = []
+
+    def add(self, package: Package, error: Optional[DevpiClientError] = None) -> None:
+        if error is None:
+            self.removed.append(package)
+        else:
+            self.failed.append((package, error))
+
+    def update(self, other: "RemovalSummary") -> None:
+        self.removed.extend(other.removed)
+        self.failed.extend(other.failed)
+
+    def __str__(self) -> str:
+        return f"Removed {len(self.removed)} package versions, {len(self.failed)} failed."
+
+
+def remove_packages_concurrently(
+    client,
+    index: str,
+    packages: Iterable[Package],
+    force: bool,
+    jobs: int,
+    throttle: Optional[SyncThrottle] = None,
+    callback: Optional[Callable[[Package, Optional[DevpiClientError]], None]] = None,
+    journal: Optional["RemovalJournal"] = None,
+) -> RemovalSummary:
+    """Remove packages from a specific index using a bounded pool of worker threads.
+
+    As with `remove_packages`, the index is made volatile once for the whole batch and packages are removed with as few
+    calls as possible. Unlike it, a failing removal does not stop the others. Failures are collected in the returned
+    summary instead. The client must be safe to use from several threads, which the HTTP backend is but the devpi
+    command line wrapper is not.
+
+    Args:
+        client: The Devpi client instance.
+        index (str): The index to remove the packages from.
+        packages (Iterable[Package]): The packages to remove. All of them must reside on `index`.
+        force (bool): Whether to temporarily make a non-volatile index volatile.
+        jobs (int): The maximal number of removals in flight at the same time.
+        throttle (Optional[SyncThrottle]): The throttle to pace removals with. Defaults to a new one for `client`.
+        callback (Optional[Callable]): Called with each package and its error, if any, once its removal has finished.
+        journal (Optional[RemovalJournal]): The journal to record removals and volatility changes in, if any.
+
+    Returns:
+        RemovalSummary: The removed and the failed packages.
+    """
+    packages = list(packages)
+    assert all(package.index == index for package in packages)
+    if throttle is None:
+        throttle = SyncThrottle(client)
+    summary = RemovalSummary()
+    lock = threading.Lock()
+
+    def remove(spec: str, removed: List[Package]) -> None:
+        error: Optional[DevpiClientError] = None
+        try:
+            throttle.acquire()
+            client.remove("--index", index, spec)
+        except DevpiClientError as client_error:
+            error = client_error
+        with lock:
+            for package in removed:
+                summary.add(package, error)
+                if journal is not None and error is None:
+                    journal.removed(package)
+                if callback is not None:
+                    callback(package, error)
+
+    with volatile_index(client, index, force) if journal is None else journal.volatile_index(client, index, force):
+        executor = ThreadPoolExecutor(max_workers=max(jobs, 1))
+        try:
+            removals = _plan_removals(client, index, packages)
+            for future in [executor.submit(remove, spec, removed) for spec, removed in removals]:
+                future.result()
+        finally:
+            # Do not start further removals once interrupted, but let running ones finish before restoring volatility.
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    return summary
+
+
 def remove_package(client, index: str, package: Package, force: bool) -> None:
-    """Remove multiple packages from a specific index on the Devpi server."""
-    with volatile_index(client, index, force):
-        assert package.index == index
-        wait_for_sync(client)
-        client.remove("--index", package.index, f"{package.name}=={package.version}")
+    """Remove a single package from a specific index on the Devpi server."""
+    remove_packages(client, index, [package], force)
@@ -0,0 +1,291 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
+
+import requests
+from devpi_plumber.client import DevpiClientError
+from requests.adapters import HTTPAdapter
+
+from devpi_cleaner.cache import CachedListing
+from devpi_cleaner.cache import ListingCache
+from devpi_cleaner.packages import parse_spec
+from devpi_cleaner.packages import version_matches
+
+
+def _parse_args(args: Tuple[str, ...]) -> Tuple[Optional[str], Set[str], List[str]]:
+    """Split devpi command line style arguments into the `--index` option, the other flags and the positional ones."""
+    index = None
+    flags = set()
+    remaining = []
+    iterator = iter(args)
+    for arg in iterator:
+        if arg == "--index":
+            index = next(iterator)
+        elif arg.startswith("--index="):
+            index = arg.split("=", 1)[1]
+        elif arg.startswith("-"):
+            flags.add(arg)
+        else:
+            remaining.append(arg)
+    return index, flags, remaining
+
+
+def _error_message(response: requests.Response) -> str:
+    try:
+        return response.json().get("message", response.reason)
+    except ValueError:
+        return response.text or response.reason
+
+
+def _response_serial(response: requests.Response) -> Optional[int]:
+    """Return the serial the server was at when it answered, None if it did not tell."""
+    serial = response.headers.get("X-Devpi-Serial")
+    return int(serial) if serial is not None and serial.isdigit() else None
+
+
+def _format_value(value: Any) -> str:
+    if isinstance(value, (list, tuple)):
+        return ",".join(str(item) for item in value)
+    return str(value)
+
+
+class DevpiHttpClient:
+    """A client talking to the Devpi REST API directly instead of invoking the devpi command line client.
+
+    It mirrors the subset of `devpi_plumber.client.DevpiCommandWrapper` that the cleaner relies on, so it can be passed
+    wherever a plumber client is expected. All requests go through a single keep-alive session, which is authenticated
+    with the token obtained from a single login.
+
+    Args:
+        url (str): The URL of the Devpi server, optionally including an index.
+        user (Optional[str]): The user to log in as when entering the context.
+        password (Optional[str]): The password to log in with.
+        session (Optional[requests.Session]): The session to use. Defaults to a new one.
+        cache (Optional[ListingCache]): A persistent cache for project listings, per user. Cached listings are reused as
+            long as the server's serial has not changed since they were fetched, or if the server confirms their ETag.
+        max_connections (int): The number of connections kept open to the server. Should be at least the number of
+            threads sharing the client. Ignored if `session` is given.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        session: Optional[requests.Session] = None,
+        cache: Optional[ListingCache] = None,
+        max_connections: int = 10,
+    ):
+        parts = urlsplit(url)
+        self._server_url = urlunsplit((parts.scheme, parts.netloc, "", "", ""))
+        self._url = url
+        self._credentials = (user, password)
+        self._user: Optional[str] = None
+        self._cache = cache
+        # The latest serial the server has reported. Every change on the server increments it.
+        self._serial: Optional[int] = None
+        self._max_connections = max_connections
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self._session = session
+        self._session.headers["Accept"] = "application/json"
+
+    def __enter__(self) -> "DevpiHttpClient":
+        user, password = self._credentials
+        if user and password is not None:
+            self.login(user, password)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Log off and close the underlying session and cache."""
+        self.logoff()
+        self._session.close()
+        if self._cache is not None:
+            self._cache.close()
+
+    def _request(self, method: str, path_or_url: str, **kwargs) -> requests.Response:
+        url = urljoin(self._server_url + "/", path_or_url)
+        try:
+            response = self._session.request(method, url, **kwargs)
+        except requests.RequestException as error:
+            raise DevpiClientError(f"{method} {url} failed: {error}") from error
+        serial = _response_serial(response)
+        if serial is not None:
+            self._serial = serial
+        if response.status_code >= 400 and response.status_code != 404:
+            raise DevpiClientError(f"{method} {url}: {response.status_code} {_error_message(response)}")
+        return response
+
+    def _request_json(self, method: str, path_or_url: str, missing_ok: bool = False, **kwargs) -> Dict[str, Any]:
+        response = self._request(method, path_or_url, **kwargs)
+        if response.status_code == 404:
+            if missing_ok:
+                return {"result": {}}
+            raise DevpiClientError(f"{method} {response.url}: 404 {_error_message(response)}")
+        return response.json()
+
+    def _get_listing(self, path: str) -> Dict[str, Any]:
+        """GET a listing, answering it from the cache if possible. A missing listing is returned as empty."""
+        if self._cache is None:
+            return self._request_json("GET", path, missing_ok=True)
+
+        url = urljoin(self._server_url + "/", path)
+        cached = self._cache.get(url, self._user)
+        if cached is not None and cached.serial is not None and cached.serial == self._serial:
+            return cached.payload
+
+        headers = {"If-None-Match": cached.etag} if cached is not None and cached.etag else {}
+        response = self._request("GET", path, headers=headers)
+        # The shared serial may already have been advanced by concurrent removals, which this listing does not reflect.
+        serial = _response_serial(response)
+        if response.status_code == 304 and cached is not None:
+            self._cache.put(url, cached._replace(serial=serial), self._user)
+            return cached.payload
+        if response.status_code == 404:
+            return {"result": {}}
+        payload = response.json()
+        self._cache.put(url, CachedListing(response.headers.get("ETag"), serial, payload), self._user)
+        return payload
+
+    def login(self, user: str, password: str) -> None:
+        """Log in and authenticate all further requests with the returned token."""
+        result = self._request_json("POST", "/+login", json={"user": user, "password": password})["result"]
+        token = base64.b64encode(f"{user}:{result['password']}".encode()).decode()
+        self._session.headers["X-Devpi-Auth"] = token
+        self._user = user
+
+    def logoff(self) -> None:
+        self._session.headers.pop("X-Devpi-Auth", None)
+        self._user = None
+
+    def use(self, *args: str) -> None:
+        self._url = urljoin(self._server_url, "/".join(args))
+
+    @property
+    def server_url(self) -> str:
+        return self._server_url
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    @property
+    def user(self) -> Optional[str]:
+        """The user currently logged in or None."""
+        return self._user
+
+    def get_json(self, path: str) -> Dict[str, Any]:
+        return self._request_json("GET", path)
+
+    def list_indices(self, user: Optional[str] = None) -> List[str]:
+        """List all indices on the server, optionally restricted to those of a single user.
+
+        Returns:
+            List[str]: The indices in the format `<user>/<index>`.
+        """
+        if user is not None:
+            users = {user: self._request_json("GET", f"/{user}")["result"]}
+        else:
+            users = self._request_json("GET", "/")["result"]
+        return [f"{name}/{index}" for name, config in users.items() for index in config.get("indexes", {})]
+
+    def _iter_release_links(self, index: str, spec: str, ignore_bases: bool) -> Iterator[Dict[str, Any]]:
+        name, specifier = parse_spec(spec)
+        versions = self._get_listing(f"/{index}/{name}?ignore_bases" if ignore_bases else f"/{index}/{name}")["result"]
+        for version, verdata in versions.items():
+            if not version_matches(specifier, version):
+                continue
+            for data in (verdata, *verdata.get("+shadowing", [])):
+                for link in data.get("+links", []):
+                    if link.get("rel") == "releasefile":
+                        yield link
+
+    def file_size(self, url: str) -> Optional[int]:
+        """Return the size of a release file in bytes or None if the server does not tell."""
+        response = self._request("HEAD", url)
+        length = response.headers.get("Content-Length")
+        if response.status_code == 404 or length is None:
+            return None
+        return int(length)
+
+    def file_sizes(self, urls: Iterable[str]) -> Dict[str, Optional[int]]:
+        """Return the sizes of several release files, asking for up to `max_connections` of them at the same time.
+
+        Returns:
+            Dict[str, Optional[int]]: The size in bytes per URL or None if the server does not tell.
+        """
+        urls = list(urls)
+        if len(urls) <= 1:
+            return {url: self.file_size(url) for url in urls}
+        with ThreadPoolExecutor(max_workers=min(self._max_connections, len(urls))) as executor:
+            return dict(zip(urls, executor.map(self.file_size, urls), strict=True))
+
+    def list(self, *args: str) -> List[str]:
+        """List the release file URLs matching a specification like `devpi list --all` does.
+
+        Args:
+            *args (str): The arguments as passed to `devpi list`, e.g. `--index user/index --all delete_me<=0.2`. With
+                `--ignore-bases`, only files uploaded to the index itself are listed.
+
+        Returns:
+            List[str]: The URLs of the matching release files.
+        """
+        index, flags, specs = _parse_args(args)
+        index = index or urlsplit(self._url).path.strip("/")
+        ignore_bases = "--ignore-bases" in flags
+        return [
+            urljoin(self._server_url, link["href"])
+            for spec in specs
+            for link in self._iter_release_links(index, spec, ignore_bases)
+        ]
+
+    def remove(self, *args: str) -> None:
+        """Remove releases matching a specification like `devpi remove -y` does.
+
+        A plain project name removes the whole project, a specification with versions removes each matching version.
+
+        Raises:
+            DevpiClientError: If no release matches a specification.
+        """
+        index, _, specs = _parse_args(args)
+        index = index or urlsplit(self._url).path.strip("/")
+        for spec in specs:
+            name, specifier = parse_spec(spec)
+            if not specifier:
+                self._request_json("DELETE", f"/{index}/{name}")
+                continue
+            versions = self._request_json("GET", f"/{index}/{name}?ignore_bases")["result"]
+            matching = [version for version in versions if version_matches(specifier, version)]
+            if not matching:
+                raise DevpiClientError(f"No releases or distributions found matching '{spec}'.")
+            for version in matching:
+                self._request_json("DELETE", f"/{index}/{name}/{version}")
+
+    def modify_index(self, index: str, *args: str, **kwargs: Any) -> str:
+        """Show or modify the configuration of an index like `devpi index` does.
+
+        Returns:
+            str: The resulting configuration, one `key=value` pair per line.
+        """
+        changes = list(args) + [f"{key}={value}" for key, value in kwargs.items()]
+        if changes:
+            config = self._request_json("PATCH", f"/{index}", json=changes)["result"]
+        else:
+            config = self._request_json("GET", f"/{index}?no_projects")["result"]
+        return "\n".join([f"{index}:"] + [f"  {key}={_format_value(value)}" for key, value in config.items()])
@@ -0,0 +1,185 @@
+import contextlib
+import json
+import os
+import threading
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import TextIO
+from typing import Tuple
+
+from devpi_plumber.client import volatile_index
+
+from devpi_cleaner.client import Package
+from devpi_cleaner.client import Release
+from devpi_cleaner.plan import dump_release
+from devpi_cleaner.plan import load_release
+
+
+class JournalState(NamedTuple):
+    """What is left to do according to the journal of an interrupted run."""
+
+    plan: List[Tuple[str, Set[Release]]]
+    volatility: Dict[str, bool]
+    # Whether all indices had been listed. Otherwise, the plan lacks the indices that were not listed yet.
+    complete: bool
+
+
+def load_journal(path: str) -> JournalState:
+    """Replay a journal to find the releases not removed yet and the indices whose volatility still needs restoring.
+
+    Indices that were made volatile but never restored are part of the returned plan, even if no releases are left on
+    them, so that resuming restores their original setting.
+
+    Args:
+        path (str): The journal file.
+
+    Returns:
+        JournalState: The remaining plan in its original order, the original volatility of unrestored indices and
+            whether the plan was recorded completely.
+    """
+    planned: Dict[str, Dict[Package, Release]] = {}
+    volatility: Dict[str, bool] = {}
+    complete = False
+    with open(path, encoding="utf-8") as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete if the run was killed while writing it.
+                continue
+            event = entry["event"]
+            if event == "planned":
+                release = load_release(line)
+                planned.setdefault(release.index, {})[release] = release
+            elif event == "listed":
+                complete = True
+            elif event == "removed":
+                planned.get(entry["index"], {}).pop(Release(entry["index"], entry["name"], entry["version"]), None)
+            elif event == "volatile":
+                volatility.setdefault(entry["index"], entry["original"])
+            elif event == "restored":
+                volatility.pop(entry["index"], None)
+
+    plan = [(index, set(releases.values())) for index, releases in planned.items() if releases or index in volatility]
+    return JournalState(plan, volatility, complete)
+
+
+class RemovalJournal:
+    """An append-only journal of a cleaning run from which an interrupted run can be resumed.
+
+    It records the planned releases, followed by a `listed` entry once the plan is complete, every completed removal and every change of an index's volatility as JSON lines
+    with an `event` field. Planned releases are written in the format of `dump_release`. Entries are flushed to disk in
+    batches of `sync_every`. Volatility changes are flushed immediately, as losing them would leave indices volatile for
+    good.
+
+    The journal file is opened when entering the journal as a context manager and closed when leaving it.
+
+    Args:
+        path (str): The journal file.
+        resume (bool): Whether to continue an existing journal instead of starting a new one.
+        sync_every (int): The number of entries after which the journal is flushed to disk.
+    """
+
+    def __init__(self, path: str, resume: bool = False, sync_every: int = 100):
+        self._path = path
+        self._resume = resume
+        self._file: Optional[TextIO] = None
+        self._lock = threading.Lock()
+        self._sync_every = sync_every
+        self._unsynced = 0
+        self._volatility: Dict[str, bool] = {}
+
+    def __enter__(self) -> "RemovalJournal":
+        if self._resume:
+            self._volatility = load_journal(self._path).volatility
+        self._file = open(self._path, "a" if self._resume else "w", encoding="utf-8")
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def _stream(self) -> TextIO:
+        if self._file is None:
+            raise RuntimeError("The journal is not open. Use it as a context manager.")
+        return self._file
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is None:
+                return
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    def _sync(self) -> None:
+        self._stream.flush()
+        os.fsync(self._stream.fileno())
+        self._unsynced = 0
+
+    def _append(self, entry: dict, sync: bool = False) -> None:
+        with self._lock:
+            self._stream.write(json.dumps(entry) + "\n")
+            self._unsynced += 1
+            if sync or self._unsynced >= self._sync_every:
+                self._sync()
+
+    def original_volatility(self, index: str) -> Optional[bool]:
+        """Return the volatility an index had before an interrupted run changed it, or None if it was not changed."""
+        return self._volatility.get(index)
+
+    def record_plan(self, plan: Iterable[Tuple[str, Set[Release]]]) -> Iterator[Tuple[str, Set[Release]]]:
+        """Record each entry of a plan while passing the plan through, and mark the plan as complete at its end.
+
+        Yields:
+            Tuple[str, Set[Release]]: The entries of `plan`, each after it has been recorded.
+        """
+        for index, releases in plan:
+            for release in releases:
+                self._append(dict(json.loads(dump_release(release)), event="planned"))
+            with self._lock:
+                self._sync()
+            yield index, releases
+        self._append({"event": "listed"}, sync=True)
+
+    def removed(self, package: Package) -> None:
+        self._append({"event": "removed", "index": package.index, "name": package.name, "version": package.version})
+
+    def made_volatile(self, index: str, original: bool) -> None:
+        self._volatility.setdefault(index, original)
+        self._append({"event": "volatile", "index": index, "original": original}, sync=True)
+
+    def restored(self, index: str) -> None:
+        self._volatility.pop(index, None)
+        self._append({"event": "restored", "index": index}, sync=True)
+
+    @contextlib.contextmanager
+    def volatile_index(self, client, index: str, force: bool) -> Iterator[None]:
+        """Make an index volatile with devpi_plumber's `volatile_index` and record it for an interrupted run.
+
+        The original setting is recorded before it is changed. If an interrupted run already left the index volatile,
+        the setting recorded back then is restored afterwards instead of the current, temporary one.
+
+        Args:
+            client: The Devpi client instance.
+            index (str): The index to make volatile.
+            force (bool): Whether to temporarily make a non-volatile index volatile.
+
+        Yields:
+            None: While the index is volatile.
+        """
+        original = self._volatility.get(index)
+        if original is None:
+            self.made_volatile(index, "volatile=True" in client.modify_index(index))
+        try:
+            with volatile_index(client, index, force_volatile=force or original is not None):
+                yield
+        finally:
+            if original is not None:
+                client.modify_index(index, volatile=original)
+            self.restored(index)
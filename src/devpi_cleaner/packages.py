@@ -0,0 +1,331 @@
+import fnmatch
+import heapq
+import operator
+import re
+import sys
+from collections import defaultdict
+from itertools import groupby
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Pattern
+from typing import Set
+from typing import Tuple
+
+from devpi_plumber.client import DevpiClientError
+from packaging.requirements import InvalidRequirement
+from packaging.requirements import Requirement
+from packaging.specifiers import SpecifierSet
+from packaging.utils import canonicalize_name
+from packaging.version import InvalidVersion
+from packaging.version import Version
+
+_TAR_GZ_END = ".tar.gz"
+_TAR_BZ2_END = ".tar.bz2"
+_ZIP_END = ".zip"
+_WHL_END = ".whl"
+_EGG_END = ".egg"
+
+PACKAGE_EXTENSIONS = (_TAR_GZ_END, _TAR_BZ2_END, _ZIP_END, _EGG_END)
+
+# Splits a package specification like `delete_*<=0.2` into the project name (pattern) and its version constraints.
+_SPEC_NAME_PATTERN = re.compile(r"^\s*([^<>=!~;,\s]+)(.*)$", re.DOTALL)
+# The wildcards of a glob pattern: `*`, `?` and character classes like `[a-c]` or `[!_]` as understood by fnmatch.
+_GLOB_WILDCARD = re.compile(r"[*?]|\[!?\]?[^\]]*\]")
+
+
+def _extract_name_and_version(filename: str) -> Tuple[str, str]:
+    """Extract the package name and version from a filename.
+
+    Args:
+        filename (str): The name of the package file.
+
+    Returns:
+        Tuple[str, str]: A tuple containing the package name and version.
+
+    Raises:
+        NotImplementedError: If the package type is unknown.
+    """
+    stem, _, suffix = filename.rpartition(".")
+    if f".{suffix}" in (_WHL_END, _EGG_END):
+        parts = stem.split("-")[:2]
+        if len(parts) != 2:
+            raise NotImplementedError(f"Cannot extract name and version from {filename}.")
+        return tuple(parts)  # noqa: return-value
+
+    parts = filename.rsplit("-", 1)
+    if len(parts) < 2 or not parts[1][0].isdigit():
+        parts = filename.split("-")
+        name = "-".join(parts[:-2])
+        version_and_ext = "-".join(parts[-2:])
+    else:
+        name, version_and_ext = parts
+
+    for extension in PACKAGE_EXTENSIONS:
+        if version_and_ext.endswith(extension):
+            return name, version_and_ext[: -len(extension)]
+
+    raise NotImplementedError(f"Unknown package type. Cannot extract version from {filename}.")
+
+
+class Package:
+    # Listings can yield hundreds of thousands of packages, so keep instances small. Index and project names repeat for
+    # every file and are interned to share a single string each.
+    __slots__ = ("_parsed_version", "index", "name", "version")
+
+    def __init__(self, package_url: str):
+        # example URL http://localhost:2414/user/index1/+f/45b/301745c6d8bbf/delete_me-0.1.tar.gz
+        parts = package_url.rsplit("/", 6)
+        name, version = _extract_name_and_version(parts[-1])
+        self._set_identity(f"{parts[1]}/{parts[2]}", name, version)
+
+    def _set_identity(self, index: str, name: str, version: str) -> None:
+        self.index = sys.intern(index)
+        self.name = sys.intern(name)
+        self.version = version
+        self._parsed_version: Optional[Version] = None
+
+    def __str__(self) -> str:
+        return f"{self.name} {self.version} on {self.index}"
+
+    @property
+    def is_dev_package(self) -> bool:
+        return ".dev" in self.version
+
+    @property
+    def parsed_version(self) -> Version:
+        """The version parsed according to PEP 440, computed on first access."""
+        if self._parsed_version is None:
+            self._parsed_version = Version(self.version)
+        return self._parsed_version
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Package):
+            return False
+        return self.index == other.index and self.name == other.name and self.version == other.version
+
+    def __ne__(self, other: object) -> bool:
+        return not self.__eq__(other)
+
+    def __hash__(self) -> int:
+        return hash((self.index, self.name, self.version))
+
+
+class Release(Package):
+    """All files of one version of a project on an index.
+
+    A release compares equal to any `Package` with the same index, name and version, so it can stand in for one. It is
+    also the unit of removal: removing it removes all of its files at once.
+    """
+
+    __slots__ = ("files",)
+
+    def __init__(self, index: str, name: str, version: str):
+        # Unlike a package, a release is not created from the URL of one of its files.
+        self._set_identity(index, name, version)
+        self.files: Dict[str, Optional[int]] = {}
+
+    @classmethod
+    def from_package(cls, package: Package) -> "Release":
+        return cls(package.index, package.name, package.version)
+
+    def add_file(self, url: str, size: Optional[int] = None) -> None:
+        """Record a file of this release together with its size in bytes, if known."""
+        self.files[url] = size
+
+    @property
+    def file_count(self) -> int:
+        return len(self.files)
+
+    @property
+    def size(self) -> Optional[int]:
+        """The total size of all files in bytes or None if the size of any file is unknown."""
+        if any(size is None for size in self.files.values()):
+            return None
+        return sum(size for size in self.files.values() if size is not None)
+
+
+def group_into_releases(package_urls: Iterable[str]) -> Set[Release]:
+    """Group release file URLs into one Release per index, name and version."""
+    releases: Dict[Package, Release] = {}
+    for package_url in package_urls:
+        if not package_url.startswith(("http://", "https://")):
+            continue
+        package = Package(package_url)
+        release = releases.get(package)
+        if release is None:
+            release = Release.from_package(package)
+            releases[release] = release
+        release.add_file(package_url)
+    return set(releases.values())
+
+
+def parse_spec(spec: str) -> Tuple[str, SpecifierSet]:
+    """Split a requirement specification such as `delete_me<=0.2` into project name and version specifier.
+
+    Args:
+        spec (str): The requirement specification.
+
+    Returns:
+        Tuple[str, SpecifierSet]: The project name and the version specifier.
+
+    Raises:
+        DevpiClientError: If the specification cannot be parsed.
+    """
+    try:
+        requirement = Requirement(spec)
+    except InvalidRequirement as error:
+        raise DevpiClientError(f"Invalid package specification {spec}: {error}") from error
+    return requirement.name, requirement.specifier
+
+
+def version_matches(specifier: SpecifierSet, version: str) -> bool:
+    """Return whether a version satisfies a specifier, including pre-releases. Invalid versions never do."""
+    if not specifier:
+        return True
+    try:
+        return specifier.contains(version, prereleases=True)
+    except InvalidVersion:
+        return False
+
+
+def has_name_pattern(package_spec: str) -> bool:
+    """Return whether the project name of a package specification is a glob pattern."""
+    match = _SPEC_NAME_PATTERN.match(package_spec)
+    return match is not None and any(character in match.group(1) for character in "*?[")
+
+
+def _compile_name_pattern(name_pattern: str) -> Pattern[str]:
+    """Compile a glob pattern to match canonicalized project names.
+
+    Only the literal parts of the pattern are canonicalized. Character classes are merely lower-cased, as rewriting the
+    separators in them could turn a class like `[a_z]` into the range `[a-z]`. A class containing a separator also
+    matches `-`, the only separator left in canonicalized names.
+    """
+    parts: List[str] = []
+    position = 0
+    for wildcard in _GLOB_WILDCARD.finditer(name_pattern):
+        parts.append(canonicalize_name(name_pattern[position : wildcard.start()]))
+        token = wildcard.group().lower()
+        if token.startswith("[") and any(separator in token[1:-1] for separator in "._"):
+            token = f"{token[:-1]}-]"
+        parts.append(token)
+        position = wildcard.end()
+    parts.append(canonicalize_name(name_pattern[position:]))
+    return re.compile(fnmatch.translate("".join(parts)))
+
+
+def expand_name_pattern(package_spec: str, projects: Iterable[str]) -> List[str]:
+    """Return one specification per project matching the glob pattern in the project name of `package_spec`."""
+    match = _SPEC_NAME_PATTERN.match(package_spec)
+    assert match is not None
+    name_pattern, constraints = match.groups()
+    name_regex = _compile_name_pattern(name_pattern)
+    return [f"{project}{constraints}" for project in projects if name_regex.match(canonicalize_name(project))]
+
+
+def _drop_latest_per_project(releases: Iterable[Release], keep_latest: int) -> Set[Release]:
+    """Return all releases except for the `keep_latest` latest versions of each project.
+
+    Args:
+        releases (Iterable[Release]): The candidate releases.
+        keep_latest (int): The number of latest versions to retain per project.
+
+    Returns:
+        Set[Release]: The releases to remove.
+    """
+    if keep_latest <= 0:
+        return set(releases)
+
+    by_project: Dict[str, List[Release]] = defaultdict(list)
+    for release in releases:
+        by_project[canonicalize_name(release.name)].append(release)
+
+    to_remove: Set[Release] = set()
+    for project_releases in by_project.values():
+        to_remove.update(project_releases)
+        to_remove.difference_update(
+            heapq.nlargest(keep_latest, project_releases, key=operator.attrgetter("parsed_version"))
+        )
+    return to_remove
+
+
+def select_releases(
+    releases: Iterable[Release], index: str, only_dev: bool, version_filter: Optional[str], keep_latest: int
+) -> Set[Release]:
+    """Select the releases to remove from those listed on an index.
+
+    Args:
+        releases (Iterable[Release]): The releases listed on the index.
+        index (str): The index. Releases inherited from other indices are never selected.
+        only_dev (bool): Whether to only select development versions.
+        version_filter (Optional[str]): A regular expression the versions to select must match.
+        keep_latest (int): The number of latest versions to retain per project.
+
+    Returns:
+        Set[Release]: The releases to remove.
+    """
+    version_filter_pattern: Optional[Pattern[str]] = re.compile(version_filter) if version_filter else None
+
+    def selector(package: Package) -> bool:
+        return (
+            package.index == index
+            and (not only_dev or package.is_dev_package)
+            and (version_filter_pattern is None or version_filter_pattern.search(package.version))
+        )
+
+    return _drop_latest_per_project((r for r in releases if selector(r)), keep_latest)
+
+
+def known_size(package: Package) -> int:
+    """Return the total size in bytes of the files of a release whose size is known, or 0 for a plain package."""
+    if not isinstance(package, Release):
+        return 0
+    return sum(size for size in package.files.values() if size is not None)
+
+
+def group_by_project(packages: Iterable[Package]) -> Dict[str, List[Package]]:
+    """Group packages by the name of their project."""
+    by_project: Dict[str, List[Package]] = defaultdict(list)
+    for package in packages:
+        by_project[package.name].append(package)
+    return by_project
+
+
+def group_versions(name: str, packages: List[Package], present: Set[str]) -> List[Tuple[str, List[Package]]]:
+    """Group the versions of a project into removal specifications, given all versions present on the index."""
+    planned = {package.version: package for package in packages}
+    single_removals = [(f"{name}=={version}", [package]) for version, package in planned.items()]
+    if not present:
+        return single_removals
+    if present <= planned.keys():
+        return [(name, packages)]
+    try:
+        candidates = sorted(present | planned.keys(), key=Version)
+    except InvalidVersion:
+        return single_removals
+
+    removals: List[Tuple[str, List[Package]]] = []
+    for is_planned, group in groupby(candidates, key=lambda version: version in planned):
+        run = list(group)
+        if not is_planned:
+            continue
+        version_range = f">={run[0]},<={run[-1]}"
+        # Whether a range matches pre-releases depends on how the server evaluates it, so runs containing any are
+        # removed version by version. Ranges also compare by release segment, so e.g. a local version may fall into a
+        # range even though it sorts after. Pre-releases to keep are considered matched to stay on the safe side.
+        if (
+            len(run) > 1
+            and not any(Version(version).is_prerelease for version in run)
+            and set(SpecifierSet(version_range).filter(candidates, prereleases=True)) == set(run)
+        ):
+            removals.append((f"{name}{version_range}", [planned[version] for version in run]))
+        else:
+            removals.extend((f"{name}=={version}", [planned[version]]) for version in run)
+    return removals
+
+
+def largest_first(removals: List[Tuple[str, List[Package]]]) -> List[Tuple[str, List[Package]]]:
+    """Order removals by the number of bytes they free, so space is freed as fast as possible."""
+    return sorted(removals, key=lambda removal: sum(known_size(package) for package in removal[1]), reverse=True)
@@ -0,0 +1,80 @@
+import json
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import Set
+from typing import TextIO
+from typing import Tuple
+
+from devpi_cleaner.client import Release
+
+
+def dump_release(release: Release) -> str:
+    """Serialize a release into a single JSON line.
+
+    Args:
+        release (Release): The release to serialize.
+
+    Returns:
+        str: The JSON document without trailing newline.
+    """
+    return json.dumps({
+        "index": release.index,
+        "name": release.name,
+        "version": release.version,
+        "files": [{"url": url, "size": size} for url, size in release.files.items()],
+    })
+
+
+def load_release(line: str) -> Release:
+    """Deserialize a release from a JSON line as written by `dump_release`.
+
+    Args:
+        line (str): The JSON document.
+
+    Returns:
+        Release: The release described by the document.
+    """
+    document = json.loads(line)
+    release = Release(document["index"], document["name"], document["version"])
+    for file in document.get("files", []):
+        release.add_file(file["url"], file.get("size"))
+    return release
+
+
+def record_plan(plan: Iterable[Tuple[str, Set[Release]]], stream: TextIO) -> Iterator[Tuple[str, Set[Release]]]:
+    """Write each entry of a plan to a stream as JSON lines while passing the plan through.
+
+    Every release is written as soon as its index has been listed, so a plan can be written while it is executed.
+
+    Args:
+        plan (Iterable[Tuple[str, Set[Release]]]): The releases to remove grouped by index.
+        stream (TextIO): The stream to write to.
+
+    Yields:
+        Tuple[str, Set[Release]]: The entries of `plan`, each after it has been written.
+    """
+    for index, releases in plan:
+        for release in sorted(releases, key=lambda r: (r.name, r.version)):
+            stream.write(dump_release(release) + "\n")
+        stream.flush()
+        yield index, releases
+
+
+def read_plan(stream: TextIO) -> Iterator[Tuple[str, Set[Release]]]:
+    """Read a plan written by `record_plan`.
+
+    Args:
+        stream (TextIO): The stream to read from.
+
+    Yields:
+        Tuple[str, Set[Release]]: The releases to remove grouped by index, in the order in which each index first
+            appears. Releases of an index are combined even if the lines of several indices are interleaved, e.g. in
+            a plan that was edited or concatenated from several files.
+    """
+    releases_by_index: Dict[str, Set[Release]] = {}
+    for line in stream:
+        if line.strip():
+            release = load_release(line)
+            releases_by_index.setdefault(release.index, set()).add(release)
+    yield from releases_by_index.items()
@@ -4,13 +4,35 @@
 from __future__ import division
 from __future__ import print_function
 
+import asyncio
 import collections
+import concurrent.futures
+import contextlib
+import csv
+import getpass
+import hashlib
+import heapq
+import importlib
+import json
 import logging
+import mmap
+import operator
 import os
 import os.path as path
+import pathlib
+import posixpath
+import shutil
+import sqlite3
 import sys
+import threading
+import time
+from itertools import islice
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
 
 import click
+from click.core import ParameterSource
+from tqdm import tqdm
 
 
 def files_directory(directory):
@@ -51,13 +73,16 @@ def extract_name_and_version(filename):
 
 
 class Artefact(object):
-    def __init__(self, dirpath, filename):
+    def __init__(self, dirpath, filename, size=None, name_and_version=None):
         self.dirpath = dirpath
         self.filename = filename
+        self._size = size
         path_components = self.dirpath.split(os.sep)
         self.user = path_components[-5]
         self.index = path_components[-4]
-        (self.name, self.version) = extract_name_and_version(filename)
+        # Devpi stores uploads below directories named after the start of their hash, e.g. `+f/45b/301745c6d8bbf`.
+        self.content_hash = "/".join([*path_components[-2:], filename]) if path_components[-3] == "+f" else None
+        (self.name, self.version) = name_and_version or extract_name_and_version(filename)
 
     @property
     def path(self):
@@ -65,41 +90,722 @@ class Artefact(object):
 
     @property
     def size(self):
-        """Get the artefact's size in bytes."""
-        return path.getsize(self.path)
+        """The artefact's size in bytes."""
+        if self._size is None:
+            self._size = path.getsize(self.path)
+        return self._size
+
+
+def scan_directory(directory):
+    """List the files with their sizes and the subdirectories of a directory in a single pass.
+
+    The sizes are taken from the directory entries, which on most platforms saves a separate `stat` call per file.
+    Unreadable directories are treated as empty, just like `os.walk` does.
+
+    Returns:
+        tuple: A list of `(filename, size)` pairs and a list of subdirectory paths.
+    """
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file():
+                        files.append((entry.name, entry.stat().st_size))
+                except OSError:
+                    logging.debug("Failed to stat %s - ignoring.", entry.path)
+    except OSError:
+        logging.debug("Failed to scan %s - ignoring.", directory)
+    return files, subdirectories
+
+
+class SizeIndex(object):
+    """A persistent index of directory listings that allows later scans to skip unchanged directories.
+
+    For every directory it stores the modification time together with the sizes of the files and the names of the
+    subdirectories in it. A directory whose modification time is unchanged is not listed again, its contents are taken
+    from the index instead. As the modification time only reflects changes of a directory's direct entries, its
+    subdirectories are still checked, but this costs a single `stat` per directory instead of one per file.
+
+    Directories modified shortly before a scan started are not trusted, as further changes within the same clock tick
+    would not be visible in their modification time.
+
+    Args:
+        filename (str): The database file. It is created if it does not exist.
+        commit_every (int): The number of updated directories after which changes are committed.
+    """
+
+    _RACY_NS = 2 * 10**9
+
+    def __init__(self, filename, commit_every=1000):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER, listing TEXT)"
+        )
+        self._commit_every = commit_every
+        self._uncommitted = 0
+        self._trusted_before_ns = time.time_ns() - self._RACY_NS
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+    def scan(self, directory):
+        """List a directory like `scan_directory` does, reusing the indexed listing if the directory is unchanged."""
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            logging.debug("Failed to scan %s - ignoring.", directory)
+            with self._lock:
+                self._forget(directory)
+            return [], []
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT mtime_ns, listing FROM directories WHERE path = ?", (directory,)
+            ).fetchone()
+        old_listing = json.loads(row[1]) if row is not None else None
+        if row is not None and row[0] == mtime_ns:
+            files, subdirectories = old_listing["files"], old_listing["subdirectories"]
+            return [tuple(file) for file in files], [path.join(directory, name) for name in subdirectories]
+
+        files, subdirectories = scan_directory(directory)
+        listing = {"files": files, "subdirectories": [path.basename(subdirectory) for subdirectory in subdirectories]}
+        with self._lock:
+            if old_listing is not None:
+                for vanished in set(old_listing["subdirectories"]) - set(listing["subdirectories"]):
+                    self._forget(path.join(directory, vanished))
+            self._connection.execute(
+                "INSERT OR REPLACE INTO directories (path, mtime_ns, listing) VALUES (?, ?, ?)",
+                (directory, mtime_ns if mtime_ns < self._trusted_before_ns else None, json.dumps(listing)),
+            )
+            self._changed()
+        return files, subdirectories
+
+    def _forget(self, directory):
+        """Remove a directory and everything below it from the index."""
+        prefix = path.join(directory, "")
+        # All paths starting with the prefix sort between it and the prefix with its last character incremented.
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        self._connection.execute(
+            "DELETE FROM directories WHERE path = ? OR (path >= ? AND path < ?)", (directory, prefix, upper)
+        )
+        self._changed()
+
+    def _changed(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self._connection.commit()
+            self._uncommitted = 0
+
+
+def walk_files(directory, jobs=8, progress=None, size_index=None):
+    """Find all files below a directory.
+
+    Directories are scanned by a pool of `jobs` threads so that the latency of the file system is overlapped. At most
+    a few directories per thread are scanned at the same time, so memory does not grow with the size of the tree. The
+    files are yielded in no particular order.
+
+    Args:
+        directory (str): The directory to search.
+        jobs (int): The number of directories to scan concurrently.
+        progress (callable): Called with the number of files of each directory scanned.
+        size_index (SizeIndex): An index from which the listings of unchanged directories are taken.
+
+    Yields:
+        tuple: The directory, name and size in bytes of each file.
+    """
+    scan = size_index.scan if size_index is not None else scan_directory
+    pending = collections.deque([directory])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        while pending or running:
+            while pending and len(running) < 4 * jobs:
+                dirpath = pending.popleft()
+                running[executor.submit(scan, dirpath)] = dirpath
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                dirpath = running.pop(future)
+                files, subdirectories = future.result()
+                pending.extend(subdirectories)
+                if progress is not None:
+                    progress(len(files))
+                for filename, size in files:
+                    yield dirpath, filename, size
+
+
+def find_artefacts(directory, jobs=8, progress=None, size_index=None):
+    """Find all artefacts below a directory, see `walk_files`.
+
+    Yields:
+        Artefact: The artefacts found, with their sizes already known.
+    """
+    for dirpath, filename, size in walk_files(directory, jobs, progress, size_index):
+        try:
+            yield Artefact(dirpath, filename, size)
+        except (ValueError, NotImplementedError):
+            logging.exception("Failed to process %s/%s - ignoring.", dirpath, filename)
+
+
+def _connect_read_only(database):
+    return sqlite3.connect(pathlib.Path(database).absolute().as_uri() + "?mode=ro", uri=True)
+
+
+def _read_file_entries(database, loads, keynames=("STAGEFILE",)):
+    """Stream the file entries of all indices from Devpi's database.
+
+    Devpi keeps the current state of every key in the `kv` table, which points to the changelog entry that last changed
+    it. A single query joins both, ordered by serial, so that each changelog entry only needs to be decoded once. The
+    database is opened read-only and may be in use by the running server.
+
+    Args:
+        database (str): The database file.
+        loads (callable): Decodes a changelog entry of the database.
+        keynames (tuple): The kinds of keys to read, by default the files uploaded to indices.
+
+    Yields:
+        tuple: The path of each file relative to the file store and the metadata Devpi stores for it.
+    """
+    connection = _connect_read_only(database)
+    try:
+        rows = connection.execute(
+            "SELECT kv.key, kv.serial, changelog.data FROM kv JOIN changelog ON changelog.serial = kv.serial"
+            " WHERE kv.keyname IN (SELECT value FROM json_each(?)) ORDER BY kv.serial",
+            (json.dumps(keynames),),
+        )
+        decoded_serial, changes = None, None
+        for relpath, serial, data in rows:
+            if serial != decoded_serial:
+                decoded_serial, (changes, _) = serial, loads(bytes(data))
+            _, _, entry = changes[relpath]
+            # Deleted files keep their key, but without metadata.
+            if entry:
+                yield relpath, entry
+    finally:
+        connection.close()
+
+
+def _read_file_entry(connection, relpath, loads, keynames=("STAGEFILE",)):
+    """Look up the metadata Devpi currently stores for a single file.
+
+    Returns:
+        dict: The metadata of the file, None if no index refers to it.
+    """
+    row = connection.execute(
+        "SELECT changelog.data FROM kv JOIN changelog ON changelog.serial = kv.serial"
+        " WHERE kv.key = ? AND kv.keyname IN (SELECT value FROM json_each(?))",
+        (relpath, json.dumps(keynames)),
+    ).fetchone()
+    if row is None:
+        return None
+    changes, _ = loads(bytes(row[0]))
+    _, _, entry = changes[relpath]
+    return entry or None
+
+
+def _database_artefact(files_dir, relpath, entry):
+    dirpath, filename = path.split(path.join(files_dir, *relpath.split("/")))
+    try:
+        size = os.stat(path.join(dirpath, filename)).st_size
+    except OSError:
+        logging.warning("Failed to find %s in the file store - ignoring.", relpath)
+        return None
+    name_and_version = (entry["project"], entry["version"]) if entry.get("project") and entry.get("version") else None
+    try:
+        return Artefact(dirpath, filename, size, name_and_version)
+    except (ValueError, NotImplementedError):
+        logging.exception("Failed to process %s - ignoring.", relpath)
+        return None
+
+
+def _devpi_server_loads():
+    # devpi-server is not a dependency, it is only available when run with the server's Python.
+    return importlib.import_module("devpi_server.fileutil").loads
+
+
+def find_database_artefacts(directory, jobs=8, progress=None, loads=None):
+    """Find the artefacts of all indices as recorded in Devpi's database instead of walking the file store.
+
+    Names and versions are taken from the metadata Devpi recorded on upload, so files with names that cannot be
+    parsed are found as well. Devpi does not record file sizes, so they are still read from the file store, by `jobs`
+    threads at a time, but without listing any of its directories.
+
+    Args:
+        directory (str): The data directory of the Devpi server.
+        jobs (int): The number of file sizes to read concurrently.
+        progress (callable): Called with the number of artefacts of each batch read.
+        loads (callable): Decodes a changelog entry of the database. Defaults to the decoder of devpi-server.
+
+    Yields:
+        Artefact: The artefacts found, with their sizes already known.
+    """
+    if loads is None:
+        loads = _devpi_server_loads()
+    files_dir = files_directory(directory)
+    entries = _read_file_entries(path.join(directory, ".sqlite"), loads)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while batch := list(islice(entries, 64 * jobs)):
+            artefacts = [
+                artefact
+                for artefact in executor.map(lambda item: _database_artefact(files_dir, *item), batch)
+                if artefact is not None
+            ]
+            if progress is not None:
+                progress(len(artefacts))
+            yield from artefacts
+
+
+async def _map_bounded(function, items, jobs):
+    """Await `function` for each of the items with at most `jobs` of them running at a time.
+
+    Unlike gathering all of them at once, this only ever creates `jobs` tasks, however many items there are.
+
+    Returns:
+        list: The results, in the order of the items.
+    """
+    from devpi_cleaner.async_client import gather_all
+
+    items = list(items)
+    results = [None] * len(items)
+    positions = iter(range(len(items)))
+
+    async def work():
+        # The workers share the iterator, each taking the next item once it is done with the previous one.
+        for position in positions:
+            results[position] = await function(items[position])
+
+    await gather_all(*(work() for _ in range(min(jobs, len(items)))))
+    return results
+
+
+async def _list_remote_project(client, index, name, jobs, emit):
+    versions = await client.project_versions(index, name)
+    urls = [
+        (version, urljoin(client.server_url + "/", link["href"]))
+        for version, verdata in versions.items()
+        for link in verdata.get("+links", [])
+        if link.get("rel") == "releasefile"
+    ]
+    # Devpi's JSON API does not include file sizes, only a HEAD request for the file tells.
+    sizes = await _map_bounded(lambda item: client.file_size(item[1]), urls, jobs)
+    for (version, url), size in zip(urls, sizes, strict=True):
+        if size is None:
+            logging.warning("Failed to get the size of %s - ignoring.", url)
+            continue
+        dirpath, filename = posixpath.split(urlsplit(url).path)
+        await emit(Artefact(path.join(*dirpath.split("/")), filename, size, (name, version)))
+
+
+async def _list_remote_artefacts(url, user, password, jobs, emit):
+    from devpi_cleaner.async_client import AsyncDevpiHttpClient
+
+    async with AsyncDevpiHttpClient(url, user, password, max_connections=jobs) as client:
+        users = (await client.get_json("/"))["result"]
+        indices = [
+            "{}/{}".format(name, index)
+            for name, config in users.items()
+            for index, index_config in config.get("indexes", {}).items()
+            # Mirrors would list all projects of the mirrored index, without owning any of their files.
+            if index_config.get("type") != "mirror"
+        ]
+        projects = await _map_bounded(client.list_projects, indices, jobs)
+        await _map_bounded(
+            lambda item: _list_remote_project(client, *item, jobs, emit),
+            ((index, name) for index, names in zip(indices, projects, strict=True) for name in names),
+            jobs,
+        )
 
 
-def find_artefacts(directory):
-    for dirpath, _, filenames in os.walk(directory):
-        for filename in filenames:
+def find_remote_artefacts(url, user=None, password=None, jobs=8, progress=None, buffer_size=10000):
+    """Find the artefacts uploaded to all indices of a Devpi server through its HTTP API.
+
+    All indices and projects are listed from an event loop in a background thread, with at most `jobs` projects and
+    `jobs` requests in flight over a shared pool of connections. The artefacts found are handed over through an
+    `asyncio.Queue` of `buffer_size` entries, so listing pauses while the consumer falls behind without blocking the
+    event loop. Listing is cancelled and the thread is joined if the consumer stops early. Mirror indices are skipped.
+
+    Args:
+        url (str): The URL of the Devpi server.
+        user (str): The user to log in as. The server is accessed anonymously if it is None.
+        password (str): The password with which to log in.
+        jobs (int): The maximal number of requests in flight.
+        progress (callable): Called with 1 for each artefact found.
+        buffer_size (int): The number of artefacts found but not yet consumed.
+
+    Yields:
+        Artefact: The artefacts found, with their sizes already known.
+
+    Raises:
+        DevpiClientError: If the server cannot be queried.
+    """
+    loop = asyncio.new_event_loop()
+    found = asyncio.Queue(maxsize=buffer_size)
+    finished = object()
+
+    async def produce():
+        try:
+            await _list_remote_artefacts(url, user, password, jobs, found.put)
+        except Exception as error:
+            await found.put(error)
+        await found.put(finished)
+
+    listing = loop.create_task(produce())
+    # The loop keeps running after the listing is complete, until the consumer has taken all artefacts from the queue.
+    producer = threading.Thread(target=loop.run_forever, name="devpi-listing", daemon=True)
+    producer.start()
+    try:
+        while (item := asyncio.run_coroutine_threadsafe(found.get(), loop).result()) is not finished:
+            if isinstance(item, Exception):
+                raise item
+            if progress is not None:
+                progress(1)
+            yield item
+    finally:
+        # Cancelling does nothing once the listing is complete, but stops one waiting for room in the queue otherwise.
+        loop.call_soon_threadsafe(listing.cancel)
+        loop.call_soon_threadsafe(loop.stop)
+        producer.join()
+        # Let a cancelled listing close its connections before the loop is closed.
+        with contextlib.suppress(asyncio.CancelledError):
+            loop.run_until_complete(listing)
+        loop.close()
+
+
+# Files uploaded to indices and files cached by mirrors.
+_FILE_KEYNAMES = ("STAGEFILE", "PYPIFILE_NOMD5")
+
+
+def find_orphans(directory, jobs=8, progress=None, loads=None, min_age=3600):
+    """Find files in the file store that no index refers to any more.
+
+    All files referenced by Devpi's database are read into a set first, then the file store is walked and every file
+    is looked up in that set. Files younger than `min_age` seconds are never reported, as an upload in progress writes
+    its file before recording it in the database.
+
+    Args:
+        directory (str): The data directory of the Devpi server.
+        jobs (int): The number of directories to scan concurrently.
+        progress (callable): Called with the number of files of each directory scanned.
+        loads (callable): Decodes a changelog entry of the database. Defaults to the decoder of devpi-server.
+        min_age (float): The age in seconds a file needs to have to be reported.
+
+    Yields:
+        tuple: The path relative to the file store and the size in bytes of each orphaned file.
+    """
+    if loads is None:
+        loads = _devpi_server_loads()
+    database = path.join(directory, ".sqlite")
+    referenced = {relpath for relpath, _ in _read_file_entries(database, loads, _FILE_KEYNAMES)}
+    files_dir = files_directory(path.abspath(directory))
+    newest = time.time() - min_age
+    for dirpath, filename, size in walk_files(files_dir, jobs, progress):
+        filepath = path.join(dirpath, filename)
+        relpath = "/".join(path.relpath(filepath, files_dir).split(os.sep))
+        if relpath in referenced:
+            continue
+        try:
+            if os.stat(filepath).st_mtime > newest:
+                continue
+        except OSError:
+            continue
+        yield relpath, size
+
+
+def quarantine(directory, orphans, quarantine_directory, loads=None, min_age=3600):
+    """Move orphaned files out of the file store while passing them through.
+
+    The files keep their path relative to the file store, so they can be moved back should they turn out to be needed.
+    Just before each move, the file is looked up in Devpi's database and its age is checked once more, as an index may
+    have started to refer to it since the orphans were found. Files that are referred to, too young or gone by then are
+    skipped.
+
+    Args:
+        directory (str): The data directory of the Devpi server.
+        orphans (Iterable[tuple]): The paths relative to the file store and the sizes of the files to move.
+        quarantine_directory (str): The directory to move the files to.
+        loads (callable): Decodes a changelog entry of the database. Defaults to the decoder of devpi-server.
+        min_age (float): The age in seconds a file needs to have to be moved.
+
+    Yields:
+        tuple: The entries of `orphans`, each after its file has been moved.
+    """
+    if loads is None:
+        loads = _devpi_server_loads()
+    files_dir = files_directory(directory)
+    with contextlib.closing(_connect_read_only(path.join(directory, ".sqlite"))) as connection:
+        for relpath, size in orphans:
+            source = path.join(files_dir, *relpath.split("/"))
+            target = path.join(quarantine_directory, *relpath.split("/"))
             try:
-                yield Artefact(dirpath, filename)
-            except (ValueError, NotImplemented):
-                logging.exception("Failed to process %s/%s – ignoring.", dirpath, filename)
+                if os.stat(source).st_mtime > time.time() - min_age:
+                    logging.info("Skipping %s, it has been changed in the meantime.", relpath)
+                    continue
+                if _read_file_entry(connection, relpath, loads, _FILE_KEYNAMES) is not None:
+                    logging.info("Skipping %s, an index refers to it again.", relpath)
+                    continue
+                os.makedirs(path.dirname(target), exist_ok=True)
+                shutil.move(source, target)
+            except FileNotFoundError:
+                logging.warning("Failed to find %s in the file store - skipping.", relpath)
+                continue
+            logging.debug("Moved %s to %s.", relpath, target)
+            yield relpath, size
+
+
+def generate_orphans_report(orphans, top=None, output_format="text", stream=None):
+    total = [0]
+
+    def count(items):
+        for relpath, size in items:
+            total[0] += size
+            yield (relpath,), size
+
+    items = count(orphans)
+    if top is not None:
+        items = heapq.nlargest(top, items, key=operator.itemgetter(1))
+    write_report(items, ("path",), "{0}", output_format, stream)
+    if output_format == "text":
+        write_report([(("Orphaned in total",), total[0])], (), "{0}", stream=stream)
+
+
+def collect_size_information(directory, jobs=8, progress=None, size_index=None):
+    base_dir = files_directory(path.abspath(directory))
+
+    artefacts = find_artefacts(base_dir, jobs=jobs, progress=progress, size_index=size_index)
 
+    return artefacts
 
-def collect_size_information(directory):
-    base_dir = files_directory(directory)
 
-    artefacts = find_artefacts(base_dir)
+def file_type(filename):
+    if filename.endswith(".whl"):
+        return "wheel"
+    elif filename.endswith(_EGG_END):
+        return "egg"
+    elif filename.endswith(_DOC_ZIP_END):
+        return "docs"
+    elif filename.endswith((_TAR_GZ_END, _TAR_BZ2_END, _ZIP_END)):
+        return "sdist"
+    else:
+        return "other"
 
-    return artefacts
 
+Grouping = collections.namedtuple("Grouping", ["fields", "key", "description"])
 
-def generate_report(artefacts):
-    size_by_package = collections.defaultdict(int)
+GROUPINGS = {
+    "package": Grouping(("user", "name"), lambda a: (a.user, a.name), "{1} on {0}"),
+    "index": Grouping(("user", "index"), lambda a: (a.user, a.index), "{0}/{1}"),
+    "version": Grouping(("user", "name", "version"), lambda a: (a.user, a.name, a.version), "{1} {2} on {0}"),
+    "type": Grouping(("type",), lambda a: (file_type(a.filename),), "{0}"),
+}
 
-    for artefact in artefacts:
-        size_by_package[artefact.user, artefact.name] += artefact.size
+REPORT_FORMATS = ("text", "json", "ndjson", "csv")
 
-    packages_sorted_by_size = sorted(size_by_package.items(), key=lambda x: x[1], reverse=True)
 
-    for package, size in packages_sorted_by_size:
-        print(
-            "{package_desc:<60}: {size:>10}B".format(
-                package_desc="{1} on {0}".format(*package), size=humanize_binary(size)
-            )
+class SizeAggregator(object):
+    """Sums up sizes by key while keeping at most a fixed number of keys in memory.
+
+    Once more than `max_keys` keys have been added, the sums are moved into a temporary SQLite database on disk and
+    merged with the sums already there. Memory use therefore does not grow with the number of keys, for example when
+    summing up the sizes of millions of versions.
+
+    Args:
+        max_keys (int): The number of keys to keep in memory.
+    """
+
+    def __init__(self, max_keys=100000):
+        self._max_keys = max_keys
+        self._sizes = collections.defaultdict(int)
+        self._connection = None
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+
+    def add(self, key, size):
+        self._sizes[key] += size
+        if len(self._sizes) > self._max_keys:
+            self._spill()
+
+    def _spill(self):
+        if self._connection is None:
+            # An empty filename opens a private database in a temporary file that is deleted when it is closed.
+            self._connection = sqlite3.connect("")
+            self._connection.execute("CREATE TABLE sizes (key TEXT PRIMARY KEY, size INTEGER)")
+        self._connection.executemany(
+            "INSERT INTO sizes (key, size) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET size = size + excluded.size",
+            ((json.dumps(key), size) for key, size in self._sizes.items()),
+        )
+        self._sizes.clear()
+
+    def largest(self, count=None):
+        """Get the keys with the largest sums, largest first.
+
+        Args:
+            count (int): The number of keys to return. All keys are returned if it is None.
+
+        Returns:
+            Iterable[tuple]: The keys and their sums.
+        """
+        if self._connection is None:
+            if count is None:
+                return sorted(self._sizes.items(), key=operator.itemgetter(1), reverse=True)
+            return heapq.nlargest(count, self._sizes.items(), key=operator.itemgetter(1))
+        self._spill()
+        rows = self._connection.execute(
+            "SELECT key, size FROM sizes ORDER BY size DESC LIMIT ?", (-1 if count is None else count,)
         )
+        return ((tuple(json.loads(key)), size) for key, size in rows)
+
+
+def write_report(items, fields, description, output_format="text", stream=None):
+    """Write the sizes of a report as text, as a JSON array, as JSON lines or as CSV.
+
+    Args:
+        items (Iterable[tuple]): The keys and their sizes in bytes.
+        fields (tuple): The names of the parts of the keys.
+        description (str): The format string describing a key in text reports.
+        output_format (str): One of `REPORT_FORMATS`.
+        stream (TextIO): The stream to write to. Defaults to stdout.
+    """
+    stream = stream or sys.stdout
+    if output_format == "text":
+        for key, size in items:
+            print(
+                "{package_desc:<60}: {size:>10}B".format(
+                    package_desc=description.format(*key), size=humanize_binary(size)
+                ),
+                file=stream,
+            )
+        return
+
+    rows = (dict(zip(fields, key, strict=True), size=size) for key, size in items)
+    if output_format == "csv":
+        writer = csv.DictWriter(stream, fieldnames=[*fields, "size"])
+        writer.writeheader()
+        writer.writerows(rows)
+    elif output_format == "ndjson":
+        for row in rows:
+            stream.write(json.dumps(row) + "\n")
+    else:
+        # Written row by row, so that the whole report never needs to be in memory.
+        stream.write("[")
+        for position, row in enumerate(rows):
+            stream.write((",\n" if position else "\n") + json.dumps(row))
+        stream.write("\n]\n")
+
+
+def generate_report(artefacts, group_by="package", top=None, output_format="text", stream=None, max_keys=100000):
+    """Report the total size of the artefacts by package, index, version or file type, largest first.
+
+    Args:
+        artefacts (Iterable[Artefact]): The artefacts to report on.
+        group_by (str): One of the keys of `GROUPINGS`.
+        top (int): The number of largest entries to report. All are reported if it is None.
+        output_format (str): One of `REPORT_FORMATS`.
+        stream (TextIO): The stream to write to. Defaults to stdout.
+        max_keys (int): The number of entries to keep in memory while summing up.
+    """
+    grouping = GROUPINGS[group_by]
+    with contextlib.closing(SizeAggregator(max_keys)) as sizes:
+        for artefact in artefacts:
+            sizes.add(grouping.key(artefact), artefact.size)
+
+        write_report(sizes.largest(top), grouping.fields, grouping.description, output_format, stream)
+
+
+def hash_file(filename):
+    """Compute the SHA-256 hex digest of a file by mapping it into memory instead of reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        if os.fstat(file.fileno()).st_size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                digest.update(content)
+    return digest.hexdigest()
+
+
+def _hash_files(paths, jobs):
+    """Compute the content hashes of files, by `jobs` threads at a time.
+
+    Returns:
+        list: The content hash of each file, in the order of `paths`.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(hash_file, paths))
+
+
+def find_duplicates(artefacts, jobs=8):
+    """Find the bytes that could be reclaimed by keeping a single copy of every file content.
+
+    Devpi stores each upload below directories named after its hash, so copies of the same file on several indices,
+    for example after pushing a release from a staging index, are found without reading their contents. The first copy
+    of each of these files is recorded in a temporary SQLite database on disk, so memory use does not grow with the
+    size of the file store.
+
+    Files stored differently can only be copies if they share their size with another file. Those are hashed, together
+    with the first copies of hash addressed files of the same size, which are kept in favour of them.
+
+    Args:
+        artefacts (Iterable[Artefact]): The artefacts to check.
+        jobs (int): The number of files to hash concurrently.
+
+    Returns:
+        dict: The number of bytes taken up by extra copies, by project name.
+    """
+    unaddressed = []
+    duplicate_bytes = collections.defaultdict(int)
+    # An empty filename opens a private database in a temporary file that is deleted when it is closed.
+    with contextlib.closing(sqlite3.connect("")) as first_copies:
+        first_copies.execute("CREATE TABLE copies (key TEXT PRIMARY KEY, size INTEGER, path TEXT)")
+        for artefact in artefacts:
+            if artefact.content_hash is None:
+                unaddressed.append(artefact)
+            elif not first_copies.execute(
+                "INSERT INTO copies (key, size, path) VALUES (?, ?, ?) ON CONFLICT (key) DO NOTHING",
+                (artefact.content_hash, artefact.size, artefact.path),
+            ).rowcount:
+                duplicate_bytes[artefact.name] += artefact.size
+
+        unaddressed_sizes = collections.Counter(artefact.size for artefact in unaddressed)
+        first_copies.execute("CREATE INDEX copies_by_size ON copies (size)")
+        same_sized = [
+            row
+            for size in unaddressed_sizes
+            for row in first_copies.execute("SELECT size, path FROM copies WHERE size = ?", (size,))
+        ]
+
+    addressed_sizes = {size for size, _ in same_sized}
+    first_seen = set(_hash_files([file_path for _, file_path in same_sized], jobs))
+    candidates = [
+        artefact for artefact in unaddressed if unaddressed_sizes[artefact.size] > 1 or artefact.size in addressed_sizes
+    ]
+    for artefact, content_hash in zip(
+        candidates, _hash_files([artefact.path for artefact in candidates], jobs), strict=True
+    ):
+        if content_hash in first_seen:
+            duplicate_bytes[artefact.name] += artefact.size
+        else:
+            first_seen.add(content_hash)
+    return duplicate_bytes
+
+
+def generate_duplicates_report(artefacts, jobs=8, top=None, output_format="text", stream=None):
+    duplicate_bytes = find_duplicates(artefacts, jobs)
+
+    largest = heapq.nlargest(top or len(duplicate_bytes), duplicate_bytes.items(), key=operator.itemgetter(1))
+    write_report((((name,), size) for name, size in largest), ("name",), "{0}", output_format, stream)
+    if output_format == "text":
+        write_report([(("Reclaimable in total",), sum(duplicate_bytes.values()))], (), "{0}", stream=stream)
 
 
 def assert_devpi_data_dir(directory):
@@ -123,18 +829,185 @@ def filter_non_dev_versions(artefacts):
     return (artefact for artefact in artefacts if ".dev" in artefact.version)
 
 
-@click.command(description="Find heavy packages on Devpi")
-@click.argument("devpi_directory", type=click.Path(exists=True, file_okay=False))
+def _check_report_options(orphans, duplicates, size_index, only_dev):
+    """Check that no option is given that the chosen report would ignore.
+
+    Orphans are files without an index, so neither their versions nor the grouping of packages applies to them, and
+    they are found by walking the whole file store. Duplicates are always reported by project.
+
+    Raises:
+        click.UsageError: If an option would be ignored.
+    """
+    group_by = click.get_current_context().get_parameter_source("group_by") != ParameterSource.DEFAULT
+    if orphans:
+        ignored = [
+            option
+            for option, given in (("--size-index", size_index), ("--only-dev", only_dev), ("--group-by", group_by))
+            if given
+        ]
+        if ignored:
+            raise click.UsageError("--orphans cannot be combined with {}.".format(", ".join(ignored)))
+    if duplicates and group_by:
+        raise click.UsageError("--duplicates cannot be combined with --group-by.")
+
+
+def _check_orphan_options(devpi_directory, source, orphans, duplicates, quarantine_directory, top):
+    """Check that the options fit the search for orphaned files.
+
+    Raises:
+        click.UsageError: If the options do not fit together.
+    """
+    if quarantine_directory and not orphans:
+        raise click.UsageError("--quarantine requires --orphans.")
+    if not orphans:
+        return
+    if duplicates:
+        raise click.UsageError("--orphans and --duplicates cannot be combined.")
+    if quarantine_directory and top is not None:
+        # Every orphan is moved, so the report needs to list all of them.
+        raise click.UsageError("--quarantine and --top cannot be combined.")
+    if source == "server":
+        raise click.UsageError("--orphans requires access to the data directory.")
+    if quarantine_directory:
+        files_dir = path.realpath(files_directory(devpi_directory))
+        target = path.realpath(quarantine_directory)
+        if path.commonpath([files_dir, target]) == files_dir:
+            raise click.UsageError("--quarantine needs to be outside of Devpi's file store.")
+
+
+def _check_source_options(devpi_directory, source, size_index, login, orphans):
+    """Check that the options fit the source of the artefacts and prepare what is needed to read from it.
+
+    Returns:
+        callable: The decoder of Devpi's database if it needs to be read, e.g. to find orphans, None otherwise.
+
+    Raises:
+        click.UsageError: If the options do not fit the source or a requirement of the source is not installed.
+    """
+    if source != "files" and size_index:
+        raise click.UsageError("--size-index is only supported by --source files.")
+    if source != "server" and login:
+        raise click.UsageError("--login is only supported by --source server.")
+    if source == "server":
+        try:
+            importlib.import_module("devpi_cleaner.async_client")
+        except ImportError as error:
+            raise click.UsageError("--source server requires httpx. Install devpi-cleaner[async].") from error
+        return None
+
+    click.Path(exists=True, file_okay=False).convert(devpi_directory, None, click.get_current_context())
+    assert_devpi_data_dir(devpi_directory)
+    if source == "database" or orphans:
+        try:
+            return _devpi_server_loads()
+        except ImportError as error:
+            option = "--orphans" if orphans else "--source database"
+            raise click.UsageError(
+                "{} requires devpi-server. Run it with the server's Python.".format(option)
+            ) from error
+    return None
+
+
+@click.command(help="Find heavy packages on Devpi")
+@click.argument("devpi_directory", metavar="DEVPI_DIRECTORY|URL")
 @click.option("-v", "--verbose", is_flag=True, help="Show debug information.")
 @click.option("--only-dev", is_flag=True, help="Find only development versions as specified by PEP440.")
-def get_devpi_package_stats(devpi_directory, verbose, only_dev):
-    """Analyze a Devpi server's data directory to find large packages."""
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="Number of directories to scan or requests to send in parallel.",
+)
+@click.option(
+    "--size-index",
+    type=click.Path(dir_okay=False),
+    help="Remember directory listings in this file so that later runs only list changed directories.",
+)
+@click.option(
+    "--source",
+    type=click.Choice(["files", "database", "server"]),
+    default="files",
+    show_default=True,
+    help="Find artefacts by walking the file store, by reading Devpi's database or by querying the server at URL.",
+)
+@click.option("--login", help="The user to log in as with --source server. Defaults to anonymous access.")
+@click.option("--password", help="The password with which to log in.")
+@click.option(
+    "--duplicates", is_flag=True, help="Report the bytes taken up by extra copies of the same file, by project."
+)
+@click.option("--orphans", is_flag=True, help="Report files in the file store that no index refers to any more.")
+@click.option(
+    "--quarantine",
+    "quarantine_directory",
+    type=click.Path(file_okay=False),
+    help="Move the orphaned files into this directory.",
+)
+@click.option(
+    "--group-by",
+    type=click.Choice(list(GROUPINGS)),
+    default="package",
+    show_default=True,
+    help="Report sizes by package, index, version or file type. Not supported by --duplicates and --orphans.",
+)
+@click.option("--top", type=click.IntRange(min=1), help="Only report the given number of largest entries.")
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(REPORT_FORMATS),
+    default="text",
+    show_default=True,
+    help="Write the report as text, as a JSON array, as JSON lines or as CSV.",
+)
+def get_devpi_package_stats(
+    devpi_directory,
+    verbose,
+    only_dev,
+    jobs,
+    size_index,
+    source,
+    login,
+    password,
+    duplicates,
+    orphans,
+    quarantine_directory,
+    group_by,
+    top,
+    output_format,
+):
+    """Analyze a Devpi server's data directory or the server itself to find large packages."""
     logging.basicConfig(format="%(message)s", level=logging.DEBUG if verbose else logging.INFO)
 
-    assert_devpi_data_dir(devpi_directory)
-    size_info = collect_size_information(devpi_directory)
-
-    if only_dev:
-        size_info = filter_non_dev_versions(size_info)
-
-    generate_report(size_info)
+    _check_report_options(orphans, duplicates, size_index, only_dev)
+    loads = _check_source_options(devpi_directory, source, size_index, login, orphans)
+    _check_orphan_options(devpi_directory, source, orphans, duplicates, quarantine_directory, top)
+    if login and password is None:
+        password = getpass.getpass()
+    # Progress goes to stderr and is only shown on a terminal, so the report on stdout stays clean.
+    with contextlib.ExitStack() as stack:
+        progress = stack.enter_context(tqdm(desc="Scanning", unit=" files", disable=None))
+        if orphans:
+            found = find_orphans(devpi_directory, jobs=jobs, progress=progress.update, loads=loads)
+            if quarantine_directory:
+                found = quarantine(devpi_directory, found, quarantine_directory, loads=loads)
+            generate_orphans_report(found, top=top, output_format=output_format)
+            return
+        if source == "server":
+            size_info = find_remote_artefacts(devpi_directory, login, password, jobs=jobs, progress=progress.update)
+        elif source == "database":
+            size_info = find_database_artefacts(devpi_directory, jobs=jobs, progress=progress.update, loads=loads)
+        else:
+            index = stack.enter_context(SizeIndex(size_index)) if size_index else None
+            size_info = collect_size_information(devpi_directory, jobs=jobs, progress=progress.update, size_index=index)
+
+        if only_dev:
+            size_info = filter_non_dev_versions(size_info)
+
+        if duplicates:
+            generate_duplicates_report(size_info, jobs=jobs, top=top, output_format=output_format)
+        else:
+            generate_report(size_info, group_by=group_by, top=top, output_format=output_format)
+
+
+if __name__ == "__main__":
+    get_devpi_package_stats()
@@ -0,0 +1,184 @@
+# coding=utf-8
+
+import asyncio
+import json
+import unittest
+
+import httpx
+from devpi_plumber.client import DevpiClientError
+
+from devpi_cleaner.async_client import AsyncDevpiHttpClient
+from devpi_cleaner.async_client import AsyncSyncThrottle
+from devpi_cleaner.async_client import list_packages_by_index
+from devpi_cleaner.async_client import remove_packages
+from devpi_cleaner.async_client import remove_plan
+from devpi_cleaner.async_client import wait_for_sync
+from devpi_cleaner.client import Package
+from test_http_client import SERVER
+from test_http_client import FakeDevpiSession
+from test_http_client import FakeResponse
+
+
+def _transport(session: FakeDevpiSession) -> httpx.MockTransport:
+    """Serve the fake Devpi server of the synchronous client's tests through httpx."""
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        session.headers = request.headers
+        payload = json.loads(request.content) if request.content else None
+        response = session.request(request.method, str(request.url), json=payload)
+        if request.method == "HEAD":
+            return httpx.Response(response.status_code, headers=response.headers)
+        return httpx.Response(response.status_code, json=response.json(), headers=response.headers)
+
+    return httpx.MockTransport(handle)
+
+
+class AsyncDevpiHttpClientTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.session = FakeDevpiSession()
+        self.client = AsyncDevpiHttpClient(
+            SERVER, "user", "secret", client=httpx.AsyncClient(transport=_transport(self.session))
+        )
+
+    async def test_login_failure(self):
+        client = AsyncDevpiHttpClient(
+            SERVER, "user", "wrong", client=httpx.AsyncClient(transport=_transport(self.session))
+        )
+        with self.assertRaises(DevpiClientError):
+            async with client:
+                pass
+
+    async def test_lists_all_indices(self):
+        async with self.client as client:
+            packages_by_index = await list_packages_by_index(client, "user", "delete_me", False, None)
+
+        self.assertDictEqual(
+            {
+                "user/index1": {
+                    Package(f"{SERVER}/user/index1/+f/45b/301745c6d8bbf/delete_me-0.1.tar.gz"),
+                    Package(f"{SERVER}/user/index1/+f/45b/301745c6d8bbf/delete_me-0.2.tar.gz"),
+                },
+                "user/index2": {Package(f"{SERVER}/user/index2/+f/45b/301745c6d8bbf/delete_me-0.3.dev1.tar.gz")},
+            },
+            packages_by_index,
+        )
+        (release,) = (release for release in packages_by_index["user/index2"])
+        self.assertIsNotNone(release.size)
+
+    async def test_lists_glob_patterns(self):
+        async with self.client as client:
+            packages_by_index = await list_packages_by_index(client, "user/index2", "delete*", False, None)
+
+        self.assertSetEqual(
+            {"delete_me", "delete_me_too"}, {release.name for release in packages_by_index["user/index2"]}
+        )
+
+    async def test_removes_plan(self):
+        async with self.client as client:
+            plan = await list_packages_by_index(client, "user", "delete_me", False, None)
+            finished = []
+            summary = await remove_plan(
+                client, plan.items(), True, callback=lambda package, _: finished.append(package)
+            )
+
+        self.assertEqual(3, len(summary.removed))
+        self.assertListEqual([], summary.failed)
+        self.assertCountEqual([package for packages in plan.values() for package in packages], finished)
+        self.assertNotIn("delete_me", self.session.projects["user/index1"])
+        self.assertDictEqual({}, self.session.projects["user/index2"]["delete_me"])
+        self.assertFalse(self.session.indices["user/index1"]["volatile"])
+        self.assertTrue(self.session.indices["user/index2"]["volatile"])
+
+    async def test_refuses_non_volatile_index(self):
+        package = Package(f"{SERVER}/user/index1/+f/45b/301745c6d8bbf/delete_me-0.1.tar.gz")
+        async with self.client as client:
+            with self.assertRaises(DevpiClientError):
+                await remove_packages(client, "user/index1", [package], False)
+
+        self.assertIn("0.1", self.session.projects["user/index1"]["delete_me"])
+
+    async def test_restores_other_indices_if_one_fails(self):
+        self.session.indices["user/index2"]["volatile"] = False
+        route = self.session._route
+
+        def failing_route(method: str, url: str, json) -> FakeResponse:
+            if method == "GET" and "/user/index1/delete_me" in url:
+                return self.session._respond(url, 500, message="boom")
+            return route(method, url, json)
+
+        self.session._route = failing_route
+        handle = _transport(self.session).handler
+
+        async def slow_handle(request: httpx.Request) -> httpx.Response:
+            # Keep the removal from user/index2 in flight until user/index1 has failed.
+            if request.method == "DELETE":
+                await asyncio.sleep(0.05)
+            return handle(request)
+
+        client = AsyncDevpiHttpClient(
+            SERVER, "user", "secret", client=httpx.AsyncClient(transport=httpx.MockTransport(slow_handle))
+        )
+        plan = [
+            (
+                "user/index1",
+                {Package(f"{SERVER}/user/index1/+f/45b/301745c6d8bbf/delete_me-0.{minor}.tar.gz") for minor in (1, 2)},
+            ),
+            ("user/index2", {Package(f"{SERVER}/user/index2/+f/45b/301745c6d8bbf/delete_me-0.3.dev1.tar.gz")}),
+        ]
+
+        with self.assertRaises(DevpiClientError):
+            async with client:
+                await remove_plan(client, plan, True)
+
+        self.assertFalse(self.session.indices["user/index1"]["volatile"])
+        self.assertFalse(self.session.indices["user/index2"]["volatile"])
+        self.assertDictEqual({}, self.session.projects["user/index2"]["delete_me"])
+
+    async def test_collects_errors_per_package(self):
+        package = Package(f"{SERVER}/user/index1/+f/45b/301745c6d8bbf/delete_me-0.9.tar.gz")
+        async with self.client as client:
+            summary = await remove_packages(client, "user/index1", [package], True)
+
+        self.assertListEqual([package], [failed for failed, _ in summary.failed])
+        self.assertFalse(self.session.indices["user/index1"]["volatile"])
+
+
+class WaitForSyncTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.session = FakeDevpiSession()
+        self.client = AsyncDevpiHttpClient(SERVER, client=httpx.AsyncClient(transport=_transport(self.session)))
+        self.statuses = [
+            {"metrics": [["devpi_web_whoosh_index_queue_size", "gauge", 500]]},
+            {"metrics": [["devpi_web_whoosh_index_queue_size", "gauge", 5]]},
+        ]
+        route = self.session._route
+
+        def status_route(method, url, json):
+            if url.endswith("/+status"):
+                return self.session._respond(
+                    url, 200, self.statuses[0] if len(self.statuses) == 1 else self.statuses.pop(0)
+                )
+            return route(method, url, json)
+
+        self.session._route = status_route
+
+    async def test_waits_until_queue_is_short(self):
+        await wait_for_sync(self.client, interval=0)
+
+        self.assertEqual(1, len(self.statuses))
+
+    async def test_gives_up_after_timeout(self):
+        self.statuses = self.statuses[:1]
+
+        with self.assertRaises(DevpiClientError):
+            await wait_for_sync(self.client, interval=0, timeout=0)
+
+    async def test_throttle_probes_once_per_interval(self):
+        self.statuses = self.statuses[1:]
+        throttle = AsyncSyncThrottle(self.client, check_interval=60, clock=lambda: 0.0)
+
+        await throttle.acquire()
+        await throttle.acquire()
+
+        probes = [url for _, url in self.session.requests if url.endswith("/+status")]
+        self.assertEqual(1, len(probes))
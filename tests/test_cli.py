@@ -0,0 +1,349 @@
+# coding=utf-8
+
+import functools
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import httpx
+from click.testing import CliRunner
+from devpi_plumber.client import DevpiClientError
+from devpi_plumber.client import DevpiCommandWrapper
+
+from devpi_cleaner.cli import clean_devpi_packages
+from test_async_client import _transport
+from test_http_client import FakeDevpiSession
+
+
+class CommandLineTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.plan_path = os.path.join(directory.name, "plan.jsonl")
+
+    def test_concurrent_removal_requires_http_backend(self):
+        result = CliRunner().invoke(
+            clean_devpi_packages, ["http://localhost:2414", "user", "delete_me", "--password", "", "--jobs", "4"]
+        )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--backend http", result.output)
+
+    def test_async_engine_does_not_support_cache(self):
+        result = CliRunner().invoke(
+            clean_devpi_packages,
+            ["http://localhost:2414", "user", "delete_me", "--password", "", "--engine", "async", "--cache", "x"],
+        )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--engine async", result.output)
+
+    def test_byte_budget_requires_sizes(self):
+        result = CliRunner().invoke(
+            clean_devpi_packages,
+            ["http://localhost:2414", "user", "delete_me", "--password", "", "--free-bytes", "200GiB"],
+        )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--free-bytes requires", result.output)
+
+    def test_byte_budget_must_be_a_size(self):
+        result = CliRunner().invoke(
+            clean_devpi_packages,
+            ["http://localhost:2414", "user", "delete_me", "--password", "", "--free-bytes", "lots"],
+        )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("'lots' is not a size", result.output)
+
+    def test_dry_run_writes_plan_that_can_be_replayed(self):
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.list_indices.return_value = ["user/index1"]
+        devpi_client.list.return_value = [
+            "http://localhost:2414/user/index1/+f/313/8642d2b43a764/delete_me-0.1.tar.gz",
+            "http://localhost:2414/user/index1/+f/313/8642d2b43a765/delete_me-0.2.tar.gz",
+        ]
+        devpi_client.modify_index.return_value = "volatile=True"
+        devpi_client.get_json.return_value = {"result": {}}
+        runner = CliRunner()
+
+        with patch("devpi_cleaner.cli._connect") as connect:
+            connect.return_value.__enter__.return_value = devpi_client
+            arguments = ["http://localhost:2414", "user", "delete_me", "--password", "", "--keep-latest", "0"]
+
+            result = runner.invoke(clean_devpi_packages, [*arguments, "--dry-run", "--plan-out", self.plan_path])
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertIn("delete_me 0.1 on user/index1", result.output)
+            devpi_client.remove.assert_not_called()
+
+            devpi_client.list.reset_mock()
+            result = runner.invoke(clean_devpi_packages, [*arguments, "--batch", "--plan-in", self.plan_path])
+            self.assertEqual(0, result.exit_code, result.output)
+            devpi_client.list.assert_not_called()
+            self.assertEqual(2, devpi_client.remove.call_count)
+
+    def test_replays_plan_without_package_specification(self):
+        with open(self.plan_path, "w") as plan:
+            plan.write('{"index": "user/index1", "name": "delete_me", "version": "0.1", "files": []}\n')
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.modify_index.return_value = "volatile=True"
+        devpi_client.get_json.return_value = {"result": {}}
+
+        with patch("devpi_cleaner.cli._connect") as connect:
+            connect.return_value.__enter__.return_value = devpi_client
+            result = CliRunner().invoke(
+                clean_devpi_packages,
+                ["http://localhost:2414", "user", "--password", "", "--batch", "--plan-in", self.plan_path],
+            )
+
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual("http://localhost:2414", connect.call_args[0][1])
+        devpi_client.remove.assert_called_once_with("--index", "user/index1", "delete_me==0.1")
+
+    def test_package_specification_is_required_without_plan(self):
+        result = CliRunner().invoke(clean_devpi_packages, ["http://localhost:2414", "user", "--password", ""])
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("PACKAGE_SPECIFICATION", result.output)
+
+    def test_resumes_from_journal(self):
+        journal_path = os.path.join(os.path.dirname(self.plan_path), "journal.jsonl")
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.list_indices.return_value = ["user/index1"]
+        devpi_client.list.return_value = [
+            "http://localhost:2414/user/index1/+f/313/8642d2b43a764/delete_me-0.1.tar.gz",
+            "http://localhost:2414/user/index1/+f/313/8642d2b43a765/delete_me-0.2.tar.gz",
+        ]
+        devpi_client.modify_index.return_value = "volatile=True"
+        devpi_client.get_json.return_value = {"result": {}}
+        devpi_client.remove.side_effect = [None, DevpiClientError("interrupted")]
+        runner = CliRunner()
+
+        with patch("devpi_cleaner.cli._connect") as connect:
+            connect.return_value.__enter__.return_value = devpi_client
+            arguments = ["http://localhost:2414", "user", "delete_me", "--password", "", "--keep-latest", "0"]
+
+            result = runner.invoke(clean_devpi_packages, [*arguments, "--batch", "--journal", journal_path])
+            self.assertEqual(1, result.exit_code, result.output)
+            removed = devpi_client.remove.call_args_list[0]
+
+            devpi_client.reset_mock(side_effect=True)
+            result = runner.invoke(clean_devpi_packages, [*arguments, "--batch", "--journal", journal_path, "--resume"])
+            self.assertEqual(0, result.exit_code, result.output)
+            devpi_client.list.assert_not_called()
+            devpi_client.remove.assert_called_once()
+            self.assertNotEqual(removed, devpi_client.remove.call_args)
+
+    def test_does_not_resume_after_interrupted_listing(self):
+        journal_path = os.path.join(os.path.dirname(self.plan_path), "journal.jsonl")
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.list_indices.return_value = ["user/a", "user/b"]
+        devpi_client.list.side_effect = [
+            ["http://localhost:2414/user/a/+f/313/8642d2b43a764/delete_me-0.1.tar.gz"],
+            DevpiClientError("interrupted"),
+        ]
+        devpi_client.modify_index.return_value = "volatile=True"
+        devpi_client.get_json.return_value = {"result": {}}
+        runner = CliRunner()
+
+        with patch("devpi_cleaner.cli._connect") as connect:
+            connect.return_value.__enter__.return_value = devpi_client
+            arguments = ["http://localhost:2414", "user", "delete_me", "--password", "", "--keep-latest", "0"]
+
+            result = runner.invoke(clean_devpi_packages, [*arguments, "--batch", "--journal", journal_path])
+            self.assertEqual(1, result.exit_code, result.output)
+            devpi_client.remove.assert_not_called()
+
+            result = runner.invoke(clean_devpi_packages, [*arguments, "--batch", "--journal", journal_path, "--resume"])
+            self.assertEqual(1, result.exit_code, result.output)
+            self.assertIn("interrupted while listing the indices", result.output)
+            devpi_client.remove.assert_not_called()
+
+    def test_resume_requires_journal(self):
+        result = CliRunner().invoke(
+            clean_devpi_packages, ["http://localhost:2414", "user", "delete_me", "--password", "", "--resume"]
+        )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--journal", result.output)
+
+    def test_cleans_several_servers(self):
+        clients = {}
+        for server in ("http://eu.example.com", "http://us.example.com"):
+            devpi_client = Mock(spec=DevpiCommandWrapper)
+            devpi_client.list_indices.return_value = ["user/index1"]
+            devpi_client.list.return_value = [f"{server}/user/index1/+f/313/8642d2b43a764/delete_me-0.1.tar.gz"]
+            devpi_client.modify_index.return_value = "volatile=True"
+            devpi_client.get_json.return_value = {"result": {}}
+            clients[server] = devpi_client
+        servers_path = os.path.join(os.path.dirname(self.plan_path), "servers.txt")
+        with open(servers_path, "w") as servers_file:
+            servers_file.write("# Regional servers\nhttp://us.example.com\n\n")
+
+        with patch("devpi_cleaner.cli._connect") as connect:
+            connect.side_effect = lambda backend, server, *args: Mock(
+                __enter__=Mock(return_value=clients[server]), __exit__=Mock(return_value=None)
+            )
+            result = CliRunner().invoke(
+                clean_devpi_packages,
+                [
+                    "http://eu.example.com",
+                    "user",
+                    "delete_me",
+                    "--password",
+                    "",
+                    "--keep-latest",
+                    "0",
+                    "--backend",
+                    "http",
+                    "--batch",
+                    "--servers-from",
+                    servers_path,
+                ],
+            )
+
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn("user/index1 on http://us.example.com", result.output)
+        self.assertIn("Removed 2 package versions, 0 failed.", result.output)
+        for devpi_client in clients.values():
+            devpi_client.remove.assert_called_once_with("--index", "user/index1", "delete_me==0.1")
+
+    def test_cleans_other_servers_if_one_fails(self):
+        clients = {}
+        for server in ("http://eu.example.com", "http://us.example.com"):
+            devpi_client = Mock(spec=DevpiCommandWrapper)
+            devpi_client.list_indices.return_value = ["user/index1"]
+            devpi_client.list.return_value = [f"{server}/user/index1/+f/313/8642d2b43a764/delete_me-0.1.tar.gz"]
+            devpi_client.modify_index.return_value = "volatile=True"
+            devpi_client.get_json.return_value = {"result": {}}
+            clients[server] = devpi_client
+        clients["http://eu.example.com"].modify_index.side_effect = DevpiClientError("Index is locked.")
+
+        with patch("devpi_cleaner.cli._connect") as connect:
+            connect.side_effect = lambda backend, server, *args: Mock(
+                __enter__=Mock(return_value=clients[server]), __exit__=Mock(return_value=None)
+            )
+            result = CliRunner().invoke(
+                clean_devpi_packages,
+                [
+                    "http://eu.example.com",
+                    "http://us.example.com",
+                    "user",
+                    "delete_me",
+                    "--password",
+                    "",
+                    "--keep-latest",
+                    "0",
+                    "--backend",
+                    "http",
+                    "--batch",
+                ],
+            )
+
+        self.assertEqual(1, result.exit_code, result.output)
+        self.assertIn("Removed 1 package versions, 0 failed.", result.output)
+        self.assertIn("Failed to clean http://eu.example.com: Index is locked.", result.stderr)
+        clients["http://us.example.com"].remove.assert_called_once_with("--index", "user/index1", "delete_me==0.1")
+
+    def test_cleans_other_servers_if_login_fails(self):
+        us_client = Mock(spec=DevpiCommandWrapper)
+        us_client.list_indices.return_value = ["user/index1"]
+        us_client.list.return_value = ["http://us.example.com/user/index1/+f/313/8642d2b43a764/delete_me-0.1.tar.gz"]
+        us_client.modify_index.return_value = "volatile=True"
+        us_client.get_json.return_value = {"result": {}}
+        connections = {
+            "http://eu.example.com": Mock(__enter__=Mock(side_effect=DevpiClientError("401 unauthorized"))),
+            "http://us.example.com": Mock(__enter__=Mock(return_value=us_client), __exit__=Mock(return_value=None)),
+        }
+
+        with patch("devpi_cleaner.cli._connect") as connect:
+            connect.side_effect = lambda backend, server, *args: connections[server]
+            result = CliRunner().invoke(
+                clean_devpi_packages,
+                [
+                    "http://eu.example.com",
+                    "http://us.example.com",
+                    "user",
+                    "delete_me",
+                    "--password",
+                    "",
+                    "--keep-latest",
+                    "0",
+                    "--backend",
+                    "http",
+                    "--batch",
+                ],
+            )
+
+        self.assertEqual(1, result.exit_code, result.output)
+        self.assertIn("Removed 1 package versions, 0 failed.", result.output)
+        self.assertIn("Failed to clean http://eu.example.com: 401 unauthorized", result.stderr)
+        us_client.remove.assert_called_once_with("--index", "user/index1", "delete_me==0.1")
+
+    def test_async_engine_cleans_other_servers_if_one_fails(self):
+        sessions = {"eu.example.com": FakeDevpiSession(), "us.example.com": FakeDevpiSession()}
+        sessions["eu.example.com"]._login = lambda url, json: sessions["eu.example.com"]._respond(
+            url, 401, message="no"
+        )
+        handlers = {host: _transport(session).handler for host, session in sessions.items()}
+        # The fake server links its files on localhost, and only the server in the US gets as far as reading them.
+        handlers["localhost"] = handlers["us.example.com"]
+        transport = httpx.MockTransport(lambda request: handlers[request.url.host](request))
+
+        with patch("httpx.AsyncClient", functools.partial(httpx.AsyncClient, transport=transport)):
+            result = CliRunner().invoke(
+                clean_devpi_packages,
+                [
+                    "http://eu.example.com",
+                    "http://us.example.com",
+                    "user/index1",
+                    "delete_me",
+                    "--password",
+                    "secret",
+                    "--keep-latest",
+                    "0",
+                    "--engine",
+                    "async",
+                    "--force",
+                    "--batch",
+                ],
+            )
+
+        self.assertEqual(1, result.exit_code, result.output)
+        self.assertIn("Removed 2 package versions, 0 failed.", result.output)
+        self.assertIn("Failed to clean http://eu.example.com: ", result.stderr)
+        self.assertNotIn("delete_me", sessions["us.example.com"].projects["user/index1"])
+        self.assertNotIn("DELETE", {method for method, _ in sessions["eu.example.com"].requests})
+
+    def test_several_servers_require_http(self):
+        result = CliRunner().invoke(
+            clean_devpi_packages,
+            ["http://eu.example.com", "http://us.example.com", "user", "delete_me", "--password", ""],
+        )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--backend http", result.output)
+
+    def test_plan_must_match_index_specification(self):
+        with open(self.plan_path, "w") as plan:
+            plan.write('{"index": "other/index1", "name": "delete_me", "version": "0.1", "files": []}\n')
+
+        with patch("devpi_cleaner.cli._connect"):
+            result = CliRunner().invoke(
+                clean_devpi_packages,
+                [
+                    "http://localhost:2414",
+                    "user",
+                    "delete_me",
+                    "--password",
+                    "",
+                    "--batch",
+                    "--plan-in",
+                    self.plan_path,
+                ],
+            )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("other/index1", result.output)
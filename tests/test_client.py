@@ -7,11 +7,18 @@ from unittest.mock import call
 from ddt import data
 from ddt import ddt
 from ddt import unpack
+from devpi_plumber.client import DevpiClientError
 from devpi_plumber.client import DevpiCommandWrapper
+from packaging.version import Version
 
 from devpi_cleaner.client import Package
+from devpi_cleaner.client import Release
+from devpi_cleaner.client import SyncThrottle
+from devpi_cleaner.client import iter_packages_by_index
+from devpi_cleaner.client import limit_to_budget
 from devpi_cleaner.client import list_packages_by_index
 from devpi_cleaner.client import remove_packages
+from devpi_cleaner.client import remove_packages_concurrently
 
 
 @ddt
@@ -150,6 +157,17 @@ class TestPackage(unittest.TestCase):
         package = Package(url)
         self.assertEqual(exp_str, str(package))
 
+    def test_compact_representation(self):
+        sdist = Package("http://localhost:2414/user/index1/+f/45b/301745c6d8bbf/delete_me-0.1.tar.gz")
+        wheel = Package("http://localhost:2414/user/index1/+f/c22/cdec16d5ddc3a/delete_me-0.1-py2.py3-none-any.whl")
+
+        self.assertFalse(hasattr(sdist, "__dict__"))
+        self.assertIs(sdist.index, wheel.index)
+        self.assertIs(sdist.name, wheel.name)
+        self.assertEqual({sdist}, {sdist, wheel})
+        self.assertIs(sdist.parsed_version, sdist.parsed_version)
+        self.assertEqual(Version("0.1"), sdist.parsed_version)
+
     def test_unknown_format(self):
         # Add more invalid extension cases
         invalid_urls = [
@@ -260,7 +278,8 @@ class ListTests(unittest.TestCase):
                 ]
             ],
             {"user/index1": {Package("http://localhost:2414/user/index1/+f/bab/f9b37c9d0d192/delete_me-0.2a1.tar.gz")}},
-        )(
+        ),
+        (
             "user",
             "dummy",
             False,
@@ -309,15 +328,78 @@ class ListTests(unittest.TestCase):
         expected_calls = []
         if "/" in index_arg:
             # Single index call
-            expected_calls.append(call("--index", index_arg, "--all", package_name))
+            expected_calls.append(call("--index", index_arg, "--all", "--ignore-bases", package_name))
         else:
             # Multiple indices calls
             for index in indices:
-                expected_calls.append(call("--index", index, "--all", package_name))
+                expected_calls.append(call("--index", index, "--all", "--ignore-bases", package_name))
 
         devpi_client.list.assert_has_calls(expected_calls, any_order=False)
+        # Listing runs concurrently, so it must not switch the index the shared client is using.
+        devpi_client.use.assert_not_called()
+
+    def test_keeps_latest_versions_per_project(self):
+        def list_project(*args):
+            name = args[-1]
+            return [
+                f"http://localhost:2414/user/index1/+f/313/8642d2b43a764/{name}-{version}.tar.gz"
+                for version in ("0.1", "0.10", "0.9", "0.2")
+            ]
+
+        devpi_client = Mock()
+        devpi_client.get_json.return_value = {"result": {"projects": ["delete_me", "keep_me", "other"]}}
+        devpi_client.list.side_effect = list_project
+
+        packages = list_packages_by_index(devpi_client, "user/index1", "*_me", False, None, keep_latest=2)
+
+        devpi_client.get_json.assert_called_once_with("/user/index1")
+        self.assertEqual(2, devpi_client.list.call_count)
+        self.assertSetEqual(
+            {
+                Package(f"http://localhost:2414/user/index1/+f/313/8642d2b43a764/{name}-{version}.tar.gz")
+                for name in ("delete_me", "keep_me")
+                for version in ("0.1", "0.2")
+            },
+            packages["user/index1"],
+        )
+
+    @data(
+        ("DELETE_*", ["delete_me", "Delete.Me.Too"]),
+        ("delete[._]me*", ["delete_me", "Delete.Me.Too"]),
+        ("delete[a_z]*", ["delete_me", "Delete.Me.Too", "deletea", "deletez"]),
+        ("Delete?", ["deletea", "deletey", "deletez"]),
+    )
+    @unpack
+    def test_matches_canonicalized_project_names(self, pattern: str, expected_projects: list):
+        devpi_client = Mock()
+        devpi_client.get_json.return_value = {
+            "result": {"projects": ["delete_me", "Delete.Me.Too", "deletea", "deletey", "deletez"]}
+        }
+        devpi_client.list.return_value = []
+
+        list_packages_by_index(devpi_client, "user/index1", f"{pattern}<2.0", False, None)
+
+        listed_specs = [args[-1] for args, _ in devpi_client.list.call_args_list]
+        self.assertListEqual([f"{project}<2.0" for project in expected_projects], listed_specs)
+
+    def test_lists_indices_lazily(self):
+        devpi_client = Mock()
+        devpi_client.list_indices.return_value = ["user/eins", "user/zwei"]
+        devpi_client.list.side_effect = [
+            ["http://dummy-server/user/eins/+f/70e/3bc67b3194143/dummy-1.0.tar.gz"],
+            ["http://dummy-server/user/zwei/+f/70e/3bc67b3194144/dummy-2.0.tar.gz"],
+        ]
 
+        plan = iter_packages_by_index(devpi_client, "user", "dummy", False, None)
 
+        index, _ = next(plan)
+        self.assertEqual("user/eins", index)
+        self.assertEqual(1, devpi_client.list.call_count)
+        self.assertEqual("user/zwei", next(plan)[0])
+        self.assertEqual(2, devpi_client.list.call_count)
+
+
+@ddt
 class RemovalTests(unittest.TestCase):
     def test_remove(self):
         packages = [
@@ -332,6 +414,110 @@ class RemovalTests(unittest.TestCase):
 
         self.assertEqual(2, devpi_client.remove.call_count)
 
+    def test_removes_each_release_once(self):
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.list_indices.return_value = ["user/index1"]
+        devpi_client.list.return_value = [
+            "http://localhost:2414/user/index1/+f/313/8642d2b43a764/delete_me-0.2.tar.gz",
+            "http://localhost:2414/user/index1/+f/70e/3bc67b3194143/delete_me-0.2-py2.py3-none-any.whl",
+            "http://localhost:2414/user/index1/+f/70e/3bc67b3194144/delete_me-0.2-cp312-cp312-manylinux_2_17_x86_64.whl",
+        ]
+        devpi_client.modify_index.return_value = "volatile=True"
+        devpi_client.get_json.return_value = {"result": {}}
+
+        (release,) = list_packages_by_index(devpi_client, "user", "delete_me", False, None)["user/index1"]
+        self.assertEqual(3, release.file_count)
+        self.assertIsNone(release.size)
+
+        remove_packages(devpi_client, "user/index1", [release], False)
+        devpi_client.remove.assert_called_once_with("--index", "user/index1", "delete_me==0.2")
+
+    def test_toggles_volatility_once_per_index(self):
+        packages = [
+            Package(f"http://localhost:2414/user/index1/+f/313/8642d2b43a764/delete_me-0.{minor}.tar.gz")
+            for minor in range(10)
+        ]
+
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.modify_index.return_value = "volatile=False"
+        devpi_client.get_json.return_value = {"result": {}}
+        remove_packages(devpi_client, "user/index1", packages, True)
+
+        self.assertEqual(10, devpi_client.remove.call_count)
+        self.assertListEqual(
+            [call("user/index1"), call("user/index1", volatile=True), call("user/index1", volatile=False)],
+            devpi_client.modify_index.call_args_list,
+        )
+
+    def test_restores_volatility_on_interrupt(self):
+        packages = [Package("http://localhost:2414/user/index1/+f/313/8642d2b43a764/delete_me-0.2.tar.gz")]
+
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.modify_index.return_value = "volatile=False"
+        devpi_client.get_json.return_value = {"result": {}}
+        devpi_client.remove.side_effect = KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            remove_packages(devpi_client, "user/index1", packages, True)
+
+        devpi_client.modify_index.assert_called_with("user/index1", volatile=False)
+
+    @data(
+        # Every version on the index is removed
+        (["0.1", "0.2", "0.3"], ["0.1", "0.2", "0.3"], ["delete_me"]),
+        # Adjacent versions are removed with a range
+        (["0.1", "0.2", "0.3", "1.0"], ["0.1", "0.2", "0.3"], ["delete_me>=0.1,<=0.3"]),
+        # Versions to keep split the range
+        (["0.1", "0.2", "0.3", "0.4"], ["0.1", "0.2", "0.4"], ["delete_me>=0.1,<=0.2", "delete_me==0.4"]),
+        # A local version sorting after the range would still match it
+        (["1.0", "1.0+local", "1.1"], ["1.0", "1.1"], ["delete_me==1.0", "delete_me==1.1"]),
+        # Unknown versions on the index
+        ([], ["0.1", "0.2"], ["delete_me==0.1", "delete_me==0.2"]),
+        # Whether a range matches pre-releases depends on the server
+        (
+            ["0.1", "0.2.dev1", "0.2", "1.0"],
+            ["0.1", "0.2.dev1", "0.2"],
+            ["delete_me==0.1", "delete_me==0.2.dev1", "delete_me==0.2"],
+        ),
+        # A pre-release to keep splits the range
+        (["0.1", "0.2rc1", "0.2", "1.0"], ["0.1", "0.2"], ["delete_me==0.1", "delete_me==0.2"]),
+    )
+    @unpack
+    def test_removes_versions_in_bulk(self, versions_on_index, versions_to_remove, expected_specs):
+        packages = [
+            Package(f"http://localhost:2414/user/index1/+f/313/8642d2b43a764/delete_me-{version}.tar.gz")
+            for version in versions_to_remove
+        ]
+
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.modify_index.return_value = "volatile=True"
+        devpi_client.get_json.return_value = {"result": {version: {} for version in versions_on_index}}
+        removed = []
+        remove_packages(
+            devpi_client, "user/index1", packages, False, callback=lambda package, _: removed.append(package)
+        )
+
+        devpi_client.get_json.assert_any_call("/user/index1/delete_me?ignore_bases")
+        self.assertCountEqual(
+            [call("--index", "user/index1", spec) for spec in expected_specs], devpi_client.remove.call_args_list
+        )
+        self.assertCountEqual(packages, removed)
+
+    def test_removes_versions_one_by_one_if_they_cannot_be_looked_up(self):
+        packages = [
+            Package(f"http://localhost:2414/user/index1/+f/313/8642d2b43a764/delete_me-0.{minor}.tar.gz")
+            for minor in range(2)
+        ]
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.modify_index.return_value = "volatile=True"
+        devpi_client.get_json.side_effect = DevpiClientError("unavailable")
+
+        with self.assertLogs(level="WARNING") as logs:
+            remove_packages(devpi_client, "user/index1", packages, False, throttle=Mock(spec=SyncThrottle))
+
+        self.assertIn("unavailable", logs.output[0])
+        self.assertEqual(2, devpi_client.remove.call_count)
+
     def test_aborts_if_package_on_wrong_index(self):
         packages = [Package("http://localhost:2414/user/index2/+f/313/8642d2b43a764/delete_me-0.2.tar.gz")]
 
@@ -342,3 +528,153 @@ class RemovalTests(unittest.TestCase):
             remove_packages(devpi_client, "user/index1", packages, False)
 
         self.assertLess(devpi_client.remove.call_count, 1)
+
+
+class ConcurrentRemovalTests(unittest.TestCase):
+    def test_collects_errors_per_package(self):
+        packages = [
+            Package(f"http://localhost:2414/user/index1/+f/313/8642d2b43a764/delete_me-0.{minor}.tar.gz")
+            for minor in range(10)
+        ]
+
+        def remove(*args):
+            if args[-1] == "delete_me==0.3":
+                raise DevpiClientError("boom")
+
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.modify_index.return_value = "volatile=False"
+        devpi_client.get_json.return_value = {"result": {}}
+        devpi_client.remove.side_effect = remove
+        finished = []
+        summary = remove_packages_concurrently(
+            devpi_client, "user/index1", packages, True, jobs=4, callback=lambda package, _: finished.append(package)
+        )
+
+        self.assertEqual(10, devpi_client.remove.call_count)
+        self.assertEqual(9, len(summary.removed))
+        self.assertListEqual([packages[3]], [package for package, _ in summary.failed])
+        self.assertCountEqual(packages, finished)
+        self.assertEqual(3, devpi_client.modify_index.call_count)
+        devpi_client.modify_index.assert_called_with("user/index1", volatile=False)
+
+
+def _sized_release(index: str, version: str, *sizes) -> Release:
+    release = Release(index, "delete_me", version)
+    for number, size in enumerate(sizes):
+        release.add_file(f"http://localhost:2414/{index}/+f/313/8642d2b43a76{number}/delete_me-{version}.tar.gz", size)
+    return release
+
+
+class BudgetTests(unittest.TestCase):
+    def setUp(self):
+        self.small = _sized_release("user/index1", "0.1", 100)
+        self.large = _sized_release("user/index1", "0.2", 600, 400)
+        self.unknown = _sized_release("user/index2", "0.1", None)
+        self.medium = _sized_release("user/index2", "0.2", 500)
+        self.plan = [("user/index1", {self.small, self.large}), ("user/index2", {self.unknown, self.medium})]
+
+    def test_takes_largest_releases_until_budget_is_met(self):
+        self.assertListEqual(
+            [("user/index1", {self.large}), ("user/index2", {self.medium})], limit_to_budget(self.plan, 1001)
+        )
+
+    def test_takes_releases_of_unknown_size_last(self):
+        self.assertListEqual(
+            [("user/index1", {self.large, self.small}), ("user/index2", {self.medium, self.unknown})],
+            limit_to_budget(self.plan, 10_000),
+        )
+
+    def test_removes_largest_releases_first(self):
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.modify_index.return_value = "volatile=True"
+        devpi_client.get_json.return_value = {"result": {"0.1": {}, "0.1.1": {}, "0.2": {}}}
+        packages = [self.small, self.large]
+
+        remove_packages(devpi_client, "user/index1", packages, False)
+
+        self.assertListEqual(
+            [call("--index", "user/index1", "delete_me==0.2"), call("--index", "user/index1", "delete_me==0.1")],
+            devpi_client.remove.call_args_list,
+        )
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _status(queue_size: int) -> dict:
+    return {"result": {"metrics": [("devpi_web_whoosh_index_queue_size", "gauge", str(queue_size))]}}
+
+
+class SyncThrottleTests(unittest.TestCase):
+    def test_healthy_server_is_not_throttled(self):
+        clock = FakeClock()
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.get_json.return_value = _status(0)
+        throttle = SyncThrottle(devpi_client, check_interval=10, clock=clock, sleep=clock.sleep)
+
+        for _ in range(100):
+            throttle.acquire()
+
+        self.assertIsNone(throttle.rate)
+        self.assertListEqual([], clock.sleeps)
+        self.assertEqual(1, devpi_client.get_json.call_count)
+
+    def test_backs_off_and_recovers(self):
+        clock = FakeClock()
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.get_json.side_effect = [_status(500), _status(500), _status(0), _status(0)]
+        throttle = SyncThrottle(devpi_client, check_interval=10, max_rate=8, clock=clock, sleep=clock.sleep)
+
+        throttle.acquire()
+        self.assertEqual(4, throttle.rate)
+        clock.now += 10
+        throttle.acquire()
+        self.assertEqual(2, throttle.rate)
+        self.assertGreater(sum(clock.sleeps), 0)
+        clock.now += 10
+        throttle.acquire()
+        self.assertEqual(4, throttle.rate)
+        clock.now += 10
+        throttle.acquire()
+        self.assertIsNone(throttle.rate)
+
+    def test_pauses_at_minimal_rate(self):
+        clock = FakeClock()
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.get_json.side_effect = [_status(500), _status(500), _status(500), _status(0)]
+        throttle = SyncThrottle(devpi_client, check_interval=10, max_rate=2, min_rate=1, clock=clock, sleep=clock.sleep)
+
+        throttle.acquire()
+        clock.now += 10
+        throttle.acquire()
+
+        self.assertEqual(4, devpi_client.get_json.call_count)
+        self.assertIn(10, clock.sleeps)
+
+    def test_waits_outside_of_lock(self):
+        clock = FakeClock()
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.get_json.return_value = _status(500)
+        lock_held = []
+
+        def sleep(seconds: float) -> None:
+            lock_held.append(throttle._lock.locked())
+            clock.sleep(seconds)
+
+        throttle = SyncThrottle(devpi_client, check_interval=10, max_rate=8, clock=clock, sleep=sleep)
+
+        throttle.acquire()
+        throttle.acquire()
+
+        self.assertListEqual([False, False], lock_held)
+        self.assertListEqual([0.25, 0.25], clock.sleeps)
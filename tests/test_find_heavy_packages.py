@@ -0,0 +1,479 @@
+# coding=utf-8
+
+import contextlib
+import csv
+import functools
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import Mock
+from unittest.mock import patch
+from urllib.parse import urlsplit
+
+import httpx
+from click.testing import CliRunner
+from devpi_plumber.client import DevpiClientError
+
+from devpi_cleaner.utils import find_heavy_packages
+from devpi_cleaner.utils.find_heavy_packages import SizeAggregator
+from devpi_cleaner.utils.find_heavy_packages import SizeIndex
+from devpi_cleaner.utils.find_heavy_packages import collect_size_information
+from devpi_cleaner.utils.find_heavy_packages import find_artefacts
+from devpi_cleaner.utils.find_heavy_packages import find_database_artefacts
+from devpi_cleaner.utils.find_heavy_packages import find_duplicates
+from devpi_cleaner.utils.find_heavy_packages import find_orphans
+from devpi_cleaner.utils.find_heavy_packages import find_remote_artefacts
+from devpi_cleaner.utils.find_heavy_packages import generate_report
+from devpi_cleaner.utils.find_heavy_packages import get_devpi_package_stats
+from devpi_cleaner.utils.find_heavy_packages import hash_file
+from devpi_cleaner.utils.find_heavy_packages import quarantine
+from devpi_cleaner.utils.find_heavy_packages import scan_directory
+from test_async_client import _transport
+from test_http_client import SERVER
+from test_http_client import FakeDevpiSession
+
+
+def _add_file(directory, user, index, filename, size, hash_dirs=("+f", "45b", "301745c6d8bbf")):
+    dirpath = os.path.join(directory, "+files", user, index, *hash_dirs)
+    os.makedirs(dirpath, exist_ok=True)
+    with open(os.path.join(dirpath, filename), "wb") as file:
+        file.write(b"x" * size)
+    return dirpath
+
+
+class DevpiDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        _add_file(self.directory, "user", "index1", "delete_me-0.1.tar.gz", 100)
+        _add_file(self.directory, "user", "index1", "delete_me-0.2.dev1-py3-none-any.whl", 200, ("+f", "a01", "b02"))
+        _add_file(self.directory, "user", "index2", "keep_me-1.0.zip", 300)
+
+
+class FindArtefactsTests(DevpiDirectoryTestCase):
+    def test_scan_directory(self):
+        dirpath = os.path.join(self.directory, "+files", "user", "index1", "+f", "45b", "301745c6d8bbf")
+
+        files, subdirectories = scan_directory(dirpath)
+
+        self.assertEqual([("delete_me-0.1.tar.gz", 100)], files)
+        self.assertEqual([], subdirectories)
+
+    def test_scan_missing_directory(self):
+        self.assertEqual(([], []), scan_directory(os.path.join(self.directory, "missing")))
+
+    def test_find_artefacts(self):
+        progress = Mock()
+
+        artefacts = list(collect_size_information(self.directory, jobs=2, progress=progress))
+
+        self.assertEqual(
+            [
+                ("user", "index1", "delete_me", "0.1", 100),
+                ("user", "index1", "delete_me", "0.2.dev1", 200),
+                ("user", "index2", "keep_me", "1.0", 300),
+            ],
+            sorted((a.user, a.index, a.name, a.version, a.size) for a in artefacts),
+        )
+        self.assertEqual(3, sum(call.args[0] for call in progress.call_args_list))
+
+    def test_unknown_package_type_is_ignored(self):
+        _add_file(self.directory, "user", "index1", "delete_me-0.3.rpm", 10)
+
+        with self.assertLogs(level="ERROR"):
+            artefacts = list(find_artefacts(os.path.join(self.directory, "+files")))
+
+        self.assertEqual(3, len(artefacts))
+
+
+class SizeAggregatorTests(unittest.TestCase):
+    def setUp(self):
+        self.sizes = [(("a",), 1), (("b",), 5), (("a",), 3), (("c",), 2), (("d",), 1), (("b",), 1)]
+
+    def _largest(self, max_keys, count):
+        with contextlib.closing(SizeAggregator(max_keys)) as aggregator:
+            for key, size in self.sizes:
+                aggregator.add(key, size)
+            return list(aggregator.largest(count))
+
+    def test_largest_in_memory(self):
+        self.assertEqual([(("b",), 6), (("a",), 4)], self._largest(100, 2))
+        self.assertEqual(4, len(self._largest(100, None)))
+
+    def test_largest_spilled_to_disk(self):
+        self.assertEqual([(("b",), 6), (("a",), 4)], self._largest(1, 2))
+        self.assertEqual([(("b",), 6), (("a",), 4), (("c",), 2)], self._largest(1, None)[:3])
+
+
+class ReportTests(DevpiDirectoryTestCase):
+    def _report(self, **kwargs):
+        stream = io.StringIO()
+        generate_report(collect_size_information(self.directory), stream=stream, **kwargs)
+        return stream.getvalue()
+
+    def test_text_report(self):
+        self.assertEqual(
+            [
+                "delete_me on user                                           :     300.0 B",
+                "keep_me on user                                             :     300.0 B",
+            ],
+            sorted(self._report().splitlines()),
+        )
+
+    def test_json_report_by_version(self):
+        report = json.loads(self._report(group_by="version", top=2, output_format="json"))
+
+        self.assertEqual(
+            [
+                {"user": "user", "name": "keep_me", "version": "1.0", "size": 300},
+                {"user": "user", "name": "delete_me", "version": "0.2.dev1", "size": 200},
+            ],
+            report,
+        )
+
+    def test_ndjson_report_by_index(self):
+        report = [json.loads(line) for line in self._report(group_by="index", output_format="ndjson").splitlines()]
+
+        self.assertEqual(
+            [{"user": "user", "index": "index1", "size": 300}, {"user": "user", "index": "index2", "size": 300}],
+            sorted(report, key=lambda row: row["index"]),
+        )
+
+    def test_csv_report_by_type(self):
+        report = list(csv.DictReader(io.StringIO(self._report(group_by="type", output_format="csv", max_keys=1))))
+
+        self.assertEqual([{"type": "sdist", "size": "400"}, {"type": "wheel", "size": "200"}], report)
+
+
+class DuplicatesTests(DevpiDirectoryTestCase):
+    def _find_duplicates(self):
+        return dict(find_duplicates(collect_size_information(self.directory, jobs=2), jobs=2))
+
+    def test_copies_are_found_by_hash_directory(self):
+        _add_file(self.directory, "user", "index2", "delete_me-0.1.tar.gz", 100)
+        _add_file(self.directory, "other", "index3", "delete_me-0.1.tar.gz", 100)
+
+        with patch.object(find_heavy_packages, "hash_file") as hash_file_mock:
+            duplicates = self._find_duplicates()
+
+        self.assertEqual({"delete_me": 200}, duplicates)
+        hash_file_mock.assert_not_called()
+
+    def test_copies_outside_hash_directories_are_hashed(self):
+        _add_file(self.directory, "user", "index1", "other-1.0.zip", 400, ("+e", "files.example.org", "a"))
+        _add_file(self.directory, "user", "index2", "other-1.0.zip", 400, ("+e", "files.example.org", "b"))
+        _add_file(self.directory, "user", "index3", "other-2.0.zip", 10, ("+e", "files.example.org", "c"))
+
+        with patch.object(find_heavy_packages, "hash_file", wraps=hash_file) as hash_file_mock:
+            duplicates = self._find_duplicates()
+
+        self.assertEqual({"other": 400}, duplicates)
+        self.assertEqual(2, hash_file_mock.call_count)
+
+    def test_copies_of_hash_addressed_files_are_hashed(self):
+        _add_file(self.directory, "user", "index3", "keep_me-1.0.zip", 300)
+        _add_file(self.directory, "user", "index3", "keep_me-1.0.zip", 300, ("+e", "files.example.org", "a"))
+
+        with patch.object(find_heavy_packages, "hash_file", wraps=hash_file) as hash_file_mock:
+            duplicates = self._find_duplicates()
+
+        self.assertEqual({"keep_me": 600}, duplicates)
+        self.assertEqual(2, hash_file_mock.call_count)
+
+    def test_duplicates_are_not_grouped(self):
+        result = CliRunner().invoke(get_devpi_package_stats, [self.directory, "--duplicates", "--group-by", "index"])
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--duplicates cannot be combined with --group-by", result.output)
+
+    def test_hash_file(self):
+        filename = os.path.join(self.directory, "empty")
+        open(filename, "wb").close()
+
+        self.assertEqual("e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855", hash_file(filename))
+
+
+class SizeIndexTests(DevpiDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        # Trust the modification times of the directories created just now.
+        patcher = patch.object(SizeIndex, "_RACY_NS", -(10**10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index_file = os.path.join(self.directory, "size-index.sqlite")
+
+    def _collect(self):
+        with SizeIndex(self.index_file) as size_index:
+            return sorted(
+                (a.index, a.name, a.version, a.size)
+                for a in collect_size_information(self.directory, 2, None, size_index)
+            )
+
+    def test_unchanged_directories_are_not_listed_again(self):
+        first = self._collect()
+
+        with patch.object(find_heavy_packages, "scan_directory", wraps=find_heavy_packages.scan_directory) as scan:
+            second = self._collect()
+
+        self.assertEqual(first, second)
+        scan.assert_not_called()
+
+    def test_changed_directories_are_listed_again(self):
+        self._collect()
+        _add_file(self.directory, "user", "index2", "keep_me-1.1.zip", 50, ("+f", "c03", "d04"))
+
+        with patch.object(find_heavy_packages, "scan_directory", wraps=find_heavy_packages.scan_directory) as scan:
+            artefacts = self._collect()
+
+        self.assertIn(("index2", "keep_me", "1.1", 50), artefacts)
+        self.assertEqual(4, len(artefacts))
+        self.assertEqual({"+f", "c03", "d04"}, {os.path.basename(call.args[0]) for call in scan.call_args_list})
+
+    def test_vanished_directories_are_forgotten(self):
+        self._collect()
+        shutil.rmtree(os.path.join(self.directory, "+files", "user", "index2"))
+
+        artefacts = self._collect()
+
+        self.assertEqual(["index1", "index1"], [artefact[0] for artefact in artefacts])
+        with sqlite3.connect(self.index_file) as connection:
+            paths = [row[0] for row in connection.execute("SELECT path FROM directories")]
+        self.assertFalse([p for p in paths if "index2" in p])
+
+    def test_recently_modified_directories_are_not_trusted(self):
+        with patch.object(SizeIndex, "_RACY_NS", 10**10):
+            self._collect()
+
+        with patch.object(find_heavy_packages, "scan_directory", wraps=find_heavy_packages.scan_directory) as scan:
+            self._collect()
+
+        self.assertTrue(scan.called)
+
+
+class DevpiDatabaseTestCase(DevpiDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.directory, ".serverversion"), "w") as file:
+            file.write("2.5.3")
+        # Changelog entries are encoded as JSON instead of Devpi's own format, see `_loads`.
+        changelog = [
+            {
+                "user/index1/+f/45b/301745c6d8bbf/delete_me-0.1.tar.gz": [
+                    "STAGEFILE",
+                    -1,
+                    {"project": "delete_me", "version": "0.1"},
+                ],
+                "user/index1/delete_me/.versions": ["PROJVERSIONS", -1, ["0.1"]],
+            },
+            {
+                "user/index2/+f/45b/301745c6d8bbf/keep_me-1.0.zip": [
+                    "STAGEFILE",
+                    -1,
+                    {"project": "keep-me", "version": "1.0"},
+                ],
+                "user/index1/+f/a01/b02/delete_me-0.2.dev1-py3-none-any.whl": ["STAGEFILE", -1, {}],
+            },
+            {"user/index1/+f/a01/b02/delete_me-0.2.dev1-py3-none-any.whl": ["STAGEFILE", 1, None]},
+        ]
+        with contextlib.closing(sqlite3.connect(os.path.join(self.directory, ".sqlite"))) as connection, connection:
+            connection.execute("CREATE TABLE changelog (serial INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+            connection.execute("CREATE TABLE kv (key TEXT NOT NULL PRIMARY KEY, keyname TEXT, serial INTEGER)")
+            for serial, changes in enumerate(changelog):
+                connection.execute(
+                    "INSERT INTO changelog VALUES (?, ?)", (serial, json.dumps([changes, None]).encode())
+                )
+                for key, (keyname, _, _) in changes.items():
+                    connection.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, keyname, serial))
+
+    @staticmethod
+    def _loads(data):
+        return json.loads(data)
+
+
+class DatabaseArtefactsTests(DevpiDatabaseTestCase):
+    def test_find_database_artefacts(self):
+        progress = Mock()
+
+        artefacts = list(find_database_artefacts(self.directory, jobs=2, progress=progress, loads=self._loads))
+
+        self.assertEqual(
+            [("user", "index1", "delete_me", "0.1", 100), ("user", "index2", "keep-me", "1.0", 300)],
+            sorted((a.user, a.index, a.name, a.version, a.size) for a in artefacts),
+        )
+        self.assertEqual(2, sum(call.args[0] for call in progress.call_args_list))
+
+    def test_missing_files_are_ignored(self):
+        os.remove(
+            os.path.join(self.directory, "+files", "user", "index2", "+f", "45b", "301745c6d8bbf", "keep_me-1.0.zip")
+        )
+
+        with self.assertLogs(level="WARNING"):
+            artefacts = list(find_database_artefacts(self.directory, loads=self._loads))
+
+        self.assertEqual(["delete_me"], [artefact.name for artefact in artefacts])
+
+
+class OrphansTests(DevpiDatabaseTestCase):
+    orphan = "user/index1/+f/a01/b02/delete_me-0.2.dev1-py3-none-any.whl"
+
+    def setUp(self):
+        super().setUp()
+        self.quarantine_directory = os.path.join(self.directory, "quarantine")
+
+    def test_find_orphans(self):
+        orphans = list(find_orphans(self.directory, jobs=2, loads=self._loads, min_age=0))
+
+        self.assertEqual([(self.orphan, 200)], orphans)
+
+    def test_recent_files_are_not_orphans(self):
+        self.assertEqual([], list(find_orphans(self.directory, loads=self._loads)))
+
+    def test_quarantine(self):
+        orphans = find_orphans(self.directory, loads=self._loads, min_age=0)
+
+        self.assertEqual(
+            [(self.orphan, 200)],
+            list(quarantine(self.directory, orphans, self.quarantine_directory, loads=self._loads, min_age=0)),
+        )
+
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "+files", *self.orphan.split("/"))))
+        self.assertTrue(os.path.isfile(os.path.join(self.quarantine_directory, *self.orphan.split("/"))))
+
+    def test_quarantine_skips_files_referred_to_again(self):
+        with contextlib.closing(sqlite3.connect(os.path.join(self.directory, ".sqlite"))) as connection, connection:
+            changes = {self.orphan: ["STAGEFILE", 2, {"project": "delete_me", "version": "0.2.dev1"}]}
+            connection.execute("INSERT INTO changelog VALUES (3, ?)", (json.dumps([changes, None]).encode(),))
+            connection.execute("UPDATE kv SET serial = 3 WHERE key = ?", (self.orphan,))
+
+        moved = list(
+            quarantine(self.directory, [(self.orphan, 200)], self.quarantine_directory, loads=self._loads, min_age=0)
+        )
+
+        self.assertEqual([], moved)
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, "+files", *self.orphan.split("/"))))
+
+    def test_quarantine_skips_missing_files(self):
+        missing = "user/index1/+f/a01/b02/missing-1.0.zip"
+
+        with self.assertLogs(level="WARNING") as logs:
+            moved = list(
+                quarantine(
+                    self.directory,
+                    [(missing, 10), (self.orphan, 200)],
+                    self.quarantine_directory,
+                    loads=self._loads,
+                    min_age=0,
+                )
+            )
+
+        self.assertEqual([(self.orphan, 200)], moved)
+        self.assertIn(missing, logs.output[0])
+
+    def test_report_and_quarantine_orphans(self):
+        orphan = os.path.join(self.directory, "+files", *self.orphan.split("/"))
+        os.utime(orphan, (0, 0))
+
+        with patch.object(find_heavy_packages, "_devpi_server_loads", return_value=self._loads):
+            result = CliRunner().invoke(
+                get_devpi_package_stats,
+                [self.directory, "--orphans", "--quarantine", self.quarantine_directory, "--format", "csv"],
+            )
+
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(["path,size", self.orphan + ",200"], result.output.splitlines())
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_quarantine_inside_file_store(self):
+        with patch.object(find_heavy_packages, "_devpi_server_loads", return_value=self._loads):
+            result = CliRunner().invoke(
+                get_devpi_package_stats,
+                [self.directory, "--orphans", "--quarantine", os.path.join(self.directory, "+files", "quarantine")],
+            )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("outside of Devpi's file store", result.output)
+
+    def test_quarantine_of_top_orphans(self):
+        with patch.object(find_heavy_packages, "_devpi_server_loads", return_value=self._loads):
+            result = CliRunner().invoke(
+                get_devpi_package_stats,
+                [self.directory, "--orphans", "--quarantine", self.quarantine_directory, "--top", "1"],
+            )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--quarantine and --top cannot be combined", result.output)
+
+    def test_orphans_reject_options_they_would_ignore(self):
+        result = CliRunner().invoke(
+            get_devpi_package_stats, [self.directory, "--orphans", "--only-dev", "--group-by", "package"]
+        )
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--orphans cannot be combined with --only-dev, --group-by", result.output)
+
+    def test_orphans_require_devpi_server(self):
+        # Importing a module that is None in sys.modules fails, whether devpi-server is installed or not.
+        with patch.dict(sys.modules, {"devpi_server": None, "devpi_server.fileutil": None}):
+            result = CliRunner().invoke(get_devpi_package_stats, [self.directory, "--orphans"])
+
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("--orphans requires devpi-server", result.output)
+
+
+class RemoteArtefactsTests(unittest.TestCase):
+    def setUp(self):
+        self.session = FakeDevpiSession()
+        self.session.indices["root/pypi"] = {"type": "mirror"}
+        patcher = patch("httpx.AsyncClient", functools.partial(httpx.AsyncClient, transport=_transport(self.session)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_find_remote_artefacts(self):
+        progress = Mock()
+
+        artefacts = list(find_remote_artefacts(SERVER, "user", "secret", jobs=2, progress=progress))
+
+        self.assertEqual(
+            [
+                ("user", "index1", "delete_me", "0.1", "delete_me-0.1.tar.gz"),
+                ("user", "index1", "delete_me", "0.2", "delete_me-0.2-py2.py3-none-any.whl"),
+                ("user", "index1", "delete_me", "0.2", "delete_me-0.2.tar.gz"),
+                ("user", "index2", "delete-me-too", "1.0", "delete_me_too-1.0.tar.gz"),
+                ("user", "index2", "delete_me", "0.3.dev1", "delete_me-0.3.dev1.tar.gz"),
+                ("user", "index2", "keep_me", "1.0", "keep_me-1.0.tar.gz"),
+            ],
+            sorted((a.user, a.index, a.name, a.version, a.filename) for a in artefacts),
+        )
+        self.assertTrue(all(artefact.size for artefact in artefacts))
+        self.assertEqual(6, progress.call_count)
+        self.assertNotIn("/root/pypi", {urlsplit(url).path for _, url in self.session.requests})
+
+    def test_errors_are_raised(self):
+        with self.assertRaises(DevpiClientError):
+            list(find_remote_artefacts(SERVER, "user", "wrong"))
+
+    def test_listing_stops_with_consumer(self):
+        artefacts = find_remote_artefacts(SERVER, "user", "secret", jobs=2, buffer_size=1)
+
+        next(artefacts)
+        artefacts.close()
+
+        self.assertNotIn("devpi-listing", {thread.name for thread in threading.enumerate()})
+
+    def test_report_from_server(self):
+        result = CliRunner().invoke(
+            get_devpi_package_stats, [SERVER, "--source", "server", "--group-by", "index", "--format", "ndjson"]
+        )
+
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(
+            ["user/index1", "user/index2"],
+            sorted("{user}/{index}".format(**json.loads(line)) for line in result.output.splitlines()),
+        )
@@ -0,0 +1,309 @@
+# coding=utf-8
+
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from devpi_plumber.client import DevpiClientError
+from devpi_plumber.client import volatile_index
+
+from devpi_cleaner.cache import CachedListing
+from devpi_cleaner.cache import ListingCache
+from devpi_cleaner.client import Package
+from devpi_cleaner.client import list_packages_by_index
+from devpi_cleaner.client import remove_packages
+from devpi_cleaner.http_client import DevpiHttpClient
+
+SERVER = "http://localhost:2414"
+
+
+def _link(index: str, filename: str) -> dict:
+    return {"rel": "releasefile", "href": f"{SERVER}/{index}/+f/45b/301745c6d8bbf/{filename}"}
+
+
+class FakeResponse:
+    def __init__(self, url: str, status_code: int, payload: dict):
+        self.url = url
+        self.status_code = status_code
+        self.reason = "OK" if status_code < 400 else "Error"
+        self.text = str(payload)
+        self.headers = {}
+        self._payload = payload
+
+    def json(self) -> dict:
+        return self._payload
+
+
+class FakeDevpiSession:
+    """Minimal in-memory stand-in for the parts of the Devpi REST API the HTTP client uses."""
+
+    def __init__(self):
+        self.headers = {}
+        self.requests = []
+        self.serial = 42
+        self.indices = {
+            "user/index1": {"type": "stage", "bases": [], "volatile": False},
+            "user/index2": {"type": "stage", "bases": ["user/index1"], "volatile": True},
+        }
+        self.projects = {
+            "user/index1": {
+                "delete_me": {
+                    "0.1": {"+links": [_link("user/index1", "delete_me-0.1.tar.gz")]},
+                    "0.2": {
+                        "+links": [
+                            _link("user/index1", "delete_me-0.2.tar.gz"),
+                            _link("user/index1", "delete_me-0.2-py2.py3-none-any.whl"),
+                        ]
+                    },
+                }
+            },
+            "user/index2": {
+                "delete_me": {"0.3.dev1": {"+links": [_link("user/index2", "delete_me-0.3.dev1.tar.gz")]}},
+                "delete-me-too": {"1.0": {"+links": [_link("user/index2", "delete_me_too-1.0.tar.gz")]}},
+                "keep_me": {"1.0": {"+links": [_link("user/index2", "keep_me-1.0.tar.gz")]}},
+            },
+        }
+
+    def _respond(self, url: str, status_code: int, result=None, message: str = "") -> FakeResponse:
+        return FakeResponse(url, status_code, {"result": result, "message": message})
+
+    def request(self, method: str, url: str, json=None, **kwargs) -> FakeResponse:
+        self.requests.append((method, url))
+        response = self._route(method, url, json)
+        response.headers["X-Devpi-Serial"] = str(self.serial)
+        return response
+
+    def _route(self, method: str, url: str, json) -> FakeResponse:
+        parts = urlsplit(url)
+        path = parts.path.strip("/").split("/")
+        if method == "POST" and path == ["+login"]:
+            return self._login(url, json)
+        if method == "HEAD":
+            response = self._respond(url, 200)
+            response.headers["Content-Length"] = str(len(url))
+            return response
+        if path == ["+status"]:
+            return self._respond(url, 200, {"metrics": []})
+        if path == [""]:
+            indexes = {index.split("/")[1]: config for index, config in self.indices.items()}
+            return self._respond(url, 200, {"user": {"username": "user", "indexes": indexes}})
+        if path == ["user"]:
+            return self._respond(url, 200, {"indexes": {index.split("/")[1]: {} for index in self.indices}})
+        index = "/".join(path[:2])
+        if len(path) == 2:
+            return self._index(method, url, index, parts.query, json)
+        return self._project(method, url, index, path[2:], parts.query)
+
+    def _login(self, url: str, json) -> FakeResponse:
+        if json != {"user": "user", "password": "secret"}:
+            return self._respond(url, 401, message="unauthorized")
+        return self._respond(url, 200, {"password": "token", "expiration": 36000})
+
+    def _index(self, method: str, url: str, index: str, query: str, json) -> FakeResponse:
+        if method == "PATCH":
+            for change in json:
+                key, value = change.split("=", 1)
+                self.indices[index][key] = value == "True"
+        if "no_projects" in query:
+            return self._respond(url, 200, self.indices[index])
+        return self._respond(url, 200, dict(self.indices[index], projects=sorted(self.projects[index])))
+
+    def _project(self, method: str, url: str, index: str, path: list, query: str) -> FakeResponse:
+        if "X-Devpi-Auth" not in self.headers and method == "DELETE":
+            return self._respond(url, 403, message="forbidden")
+        versions = self.projects[index].get(path[0])
+        if versions is None:
+            return self._respond(url, 404, message="not found")
+        if method == "DELETE":
+            if len(path) == 1:
+                del self.projects[index][path[0]]
+            else:
+                del versions[path[1]]
+            self.serial += 1
+            return self._respond(url, 200)
+        if "ignore_bases" in query or not self.indices[index]["bases"]:
+            return self._respond(url, 200, versions)
+        inherited = dict(self.projects[self.indices[index]["bases"][0]].get(path[0], {}))
+        inherited.update(versions)
+        return self._respond(url, 200, inherited)
+
+    def close(self):
+        pass
+
+
+class DevpiHttpClientTests(unittest.TestCase):
+    def setUp(self):
+        self.session = FakeDevpiSession()
+        self.client = DevpiHttpClient(SERVER, "user", "secret", session=self.session)
+
+    def test_login_authenticates_session(self):
+        with self.client as client:
+            self.assertEqual("user", client.user)
+            self.assertEqual("dXNlcjp0b2tlbg==", self.session.headers["X-Devpi-Auth"])
+        self.assertNotIn("X-Devpi-Auth", self.session.headers)
+
+    def test_login_failure(self):
+        client = DevpiHttpClient(SERVER, "user", "wrong", session=self.session)
+        with self.assertRaises(DevpiClientError):
+            client.__enter__()
+
+    def test_list_indices(self):
+        self.assertListEqual(["user/index1", "user/index2"], self.client.list_indices(user="user"))
+
+    def test_list_includes_inherited_files(self):
+        files = self.client.list("--index", "user/index2", "--all", "delete_me>=0.2")
+        self.assertListEqual(
+            [
+                f"{SERVER}/user/index1/+f/45b/301745c6d8bbf/delete_me-0.2.tar.gz",
+                f"{SERVER}/user/index1/+f/45b/301745c6d8bbf/delete_me-0.2-py2.py3-none-any.whl",
+                f"{SERVER}/user/index2/+f/45b/301745c6d8bbf/delete_me-0.3.dev1.tar.gz",
+            ],
+            files,
+        )
+
+    def test_list_ignoring_bases(self):
+        files = self.client.list("--index", "user/index2", "--all", "--ignore-bases", "delete_me")
+        self.assertListEqual([f"{SERVER}/user/index2/+f/45b/301745c6d8bbf/delete_me-0.3.dev1.tar.gz"], files)
+
+    def test_list_unknown_project(self):
+        self.assertListEqual([], self.client.list("--index", "user/index1", "--all", "unknown"))
+
+    def test_volatile_index(self):
+        self.assertIn("volatile=False", self.client.modify_index("user/index1"))
+        with volatile_index(self.client, "user/index1", True):
+            self.assertTrue(self.session.indices["user/index1"]["volatile"])
+        self.assertFalse(self.session.indices["user/index1"]["volatile"])
+
+    def test_lists_releases_with_sizes(self):
+        releases = list_packages_by_index(self.client, "user/index1", "delete_me==0.2", False, None)["user/index1"]
+        (release,) = releases
+        self.assertEqual(2, release.file_count)
+        self.assertEqual(sum(len(url) for url in release.files), release.size)
+
+    def test_asks_for_file_sizes_concurrently(self):
+        # Both HEAD requests have to be in flight at the same time to pass the barrier.
+        barrier = threading.Barrier(2, timeout=5)
+        route = self.session._route
+
+        def route_after_barrier(method: str, url: str, json) -> FakeResponse:
+            if method == "HEAD":
+                barrier.wait()
+            return route(method, url, json)
+
+        self.session._route = route_after_barrier
+        urls = [_link("user/index1", f"delete_me-0.{minor}.tar.gz")["href"] for minor in (1, 2)]
+
+        self.assertDictEqual({url: len(url) for url in urls}, self.client.file_sizes(urls))
+
+    def test_resolves_project_pattern_against_index(self):
+        packages = list_packages_by_index(self.client, "user/index2", "delete_*", False, None)["user/index2"]
+
+        self.assertSetEqual({"delete_me", "delete_me_too"}, {package.name for package in packages})
+        project_requests = [url for method, url in self.session.requests if method == "GET" and "/user/index2/" in url]
+        self.assertEqual(2, len(project_requests))
+
+    def test_lists_indices_concurrently(self):
+        serial = list_packages_by_index(self.client, "user", "delete_me", False, None)
+        concurrent = list_packages_by_index(self.client, "user", "delete_me", False, None, jobs=2)
+        self.assertDictEqual(serial, concurrent)
+
+    def test_list_and_remove_packages(self):
+        with self.client as client:
+            packages_by_index = list_packages_by_index(client, "user", "delete_me", False, None)
+            self.assertDictEqual(
+                {
+                    "user/index1": {
+                        Package(f"{SERVER}/user/index1/+f/45b/301745c6d8bbf/delete_me-0.1.tar.gz"),
+                        Package(f"{SERVER}/user/index1/+f/45b/301745c6d8bbf/delete_me-0.2.tar.gz"),
+                    },
+                    "user/index2": {Package(f"{SERVER}/user/index2/+f/45b/301745c6d8bbf/delete_me-0.3.dev1.tar.gz")},
+                },
+                packages_by_index,
+            )
+
+            for index, packages in packages_by_index.items():
+                remove_packages(client, index, packages, True)
+
+        # All versions of delete_me on user/index1 are removed, so the project is removed as a whole.
+        self.assertNotIn("delete_me", self.session.projects["user/index1"])
+        self.assertDictEqual({}, self.session.projects["user/index2"]["delete_me"])
+        self.assertFalse(self.session.indices["user/index1"]["volatile"])
+        deletions = [url for method, url in self.session.requests if method == "DELETE"]
+        self.assertListEqual([f"{SERVER}/user/index1/delete_me", f"{SERVER}/user/index2/delete_me/0.3.dev1"], deletions)
+
+
+class ListingCacheTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_path = os.path.join(directory.name, "listings.sqlite")
+        self.session = FakeDevpiSession()
+
+    def _list(self) -> dict:
+        with DevpiHttpClient(
+            SERVER, "user", "secret", session=self.session, cache=ListingCache(self.cache_path)
+        ) as client:
+            return list_packages_by_index(client, "user", "delete_me", False, None)
+
+    def _project_requests(self) -> int:
+        return sum(
+            1 for method, url in self.session.requests if method == "GET" and urlsplit(url).path.endswith("/delete_me")
+        )
+
+    def test_reuses_listings_while_serial_is_unchanged(self):
+        first = self._list()
+        self.assertEqual(2, self._project_requests())
+
+        self.assertDictEqual(first, self._list())
+        self.assertEqual(2, self._project_requests())
+
+    def test_stores_listings_with_the_serial_they_were_fetched_at(self):
+        cache = ListingCache(self.cache_path)
+        request = self.session.request
+
+        def request_during_removal(method: str, url: str, **kwargs) -> FakeResponse:
+            response = request(method, url, **kwargs)
+            if method == "GET" and urlsplit(url).path == "/user/index1/delete_me":
+                # Another thread removes a release and learns the new serial before this listing is stored.
+                self.session.serial += 1
+                client.get_json("/+status")
+            return response
+
+        self.session.request = request_during_removal
+        with DevpiHttpClient(SERVER, "user", "secret", session=self.session, cache=cache) as client:
+            list_packages_by_index(client, "user", "delete_me", False, None)
+            cached = cache.get(f"{SERVER}/user/index1/delete_me?ignore_bases", "user")
+
+        self.assertEqual(42, cached.serial)
+
+    def test_listings_are_cached_per_user(self):
+        listing = CachedListing("etag", 1, {"result": {}})
+
+        with ListingCache(self.cache_path) as cache:
+            cache.put(f"{SERVER}/user/index1", listing, "user")
+
+            self.assertIsNone(cache.get(f"{SERVER}/user/index1"))
+            self.assertEqual(listing, cache.get(f"{SERVER}/user/index1", "user"))
+
+    def test_caches_of_several_servers_share_a_file(self):
+        listing = CachedListing("etag", 1, {"result": {}})
+
+        def fill(cache: ListingCache) -> None:
+            for number in range(100):
+                cache.put(f"{SERVER}/{number}", listing)
+
+        with ListingCache(self.cache_path) as first, ListingCache(self.cache_path) as second:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(fill, (first, second)))
+            self.assertEqual(listing, second.get(f"{SERVER}/99"))
+
+    def test_refetches_listings_after_serial_changed(self):
+        self._list()
+        del self.session.projects["user/index2"]["delete_me"]["0.3.dev1"]
+        self.session.serial += 1
+
+        self.assertSetEqual(set(), self._list()["user/index2"])
+        self.assertEqual(4, self._project_requests())
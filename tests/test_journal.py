@@ -0,0 +1,120 @@
+# coding=utf-8
+
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+from unittest.mock import call
+
+from devpi_plumber.client import DevpiClientError
+from devpi_plumber.client import DevpiCommandWrapper
+
+from devpi_cleaner.client import Release
+from devpi_cleaner.client import remove_packages
+from devpi_cleaner.journal import RemovalJournal
+from devpi_cleaner.journal import load_journal
+
+
+def _release(index: str, version: str) -> Release:
+    release = Release(index, "delete_me", version)
+    release.add_file(f"http://localhost:2414/{index}/+f/45b/301745c6d8bbf/delete_me-{version}.tar.gz", 1024)
+    return release
+
+
+class RemovalJournalTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "journal.jsonl")
+        self.plan = [
+            ("user/index1", {_release("user/index1", "0.1"), _release("user/index1", "0.2")}),
+            ("user/index2", {_release("user/index2", "0.1")}),
+        ]
+
+    def test_remaining_plan_excludes_removed_releases(self):
+        with RemovalJournal(self.path) as journal:
+            self.assertListEqual(self.plan, list(journal.record_plan(self.plan)))
+            journal.made_volatile("user/index1", True)
+            journal.removed(_release("user/index1", "0.1"))
+            journal.removed(_release("user/index1", "0.2"))
+            journal.restored("user/index1")
+            journal.made_volatile("user/index2", False)
+
+        state = load_journal(self.path)
+        self.assertListEqual([("user/index2", {_release("user/index2", "0.1")})], state.plan)
+        self.assertDictEqual({"user/index2": False}, state.volatility)
+        self.assertDictEqual(_release("user/index2", "0.1").files, next(iter(state.plan[0][1])).files)
+
+    def test_plan_is_complete_once_recorded_to_its_end(self):
+        with RemovalJournal(self.path) as journal:
+            recorded = journal.record_plan(self.plan)
+            next(recorded)
+
+        self.assertFalse(load_journal(self.path).complete)
+
+        with RemovalJournal(self.path) as journal:
+            list(journal.record_plan(self.plan))
+
+        self.assertTrue(load_journal(self.path).complete)
+
+    def test_keeps_indices_left_volatile(self):
+        with RemovalJournal(self.path) as journal:
+            list(journal.record_plan(self.plan[1:]))
+            journal.made_volatile("user/index2", False)
+            journal.removed(_release("user/index2", "0.1"))
+
+        self.assertListEqual([("user/index2", set())], load_journal(self.path).plan)
+
+    def test_ignores_truncated_last_entry(self):
+        with RemovalJournal(self.path) as journal:
+            list(journal.record_plan(self.plan[1:]))
+        with open(self.path, "a") as journal_file:
+            journal_file.write('{"event": "removed", "ind')
+
+        self.assertListEqual(self.plan[1:], load_journal(self.path).plan)
+
+    def test_resume_restores_original_volatility(self):
+        with RemovalJournal(self.path) as journal:
+            list(journal.record_plan(self.plan[1:]))
+            devpi_client = Mock(spec=DevpiCommandWrapper)
+            devpi_client.modify_index.return_value = "volatile=False"
+            devpi_client.get_json.return_value = {"result": {}}
+            devpi_client.remove.side_effect = DevpiClientError("interrupted")
+            with self.assertRaises(DevpiClientError):
+                remove_packages(devpi_client, "user/index2", self.plan[1][1], True, journal=journal)
+
+        # Simulate an interrupted run, which could not restore the volatility.
+        with open(self.path) as journal_file:
+            entries = [line for line in journal_file if '"restored"' not in line]
+        with open(self.path, "w") as journal_file:
+            journal_file.writelines(entries)
+
+        ((index, releases),) = load_journal(self.path).plan
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.modify_index.return_value = "volatile=True"
+        devpi_client.get_json.return_value = {"result": {}}
+        with RemovalJournal(self.path, resume=True) as journal:
+            # Not forced, as the index has only been made volatile by the interrupted run.
+            remove_packages(devpi_client, index, releases, False, journal=journal)
+
+        devpi_client.remove.assert_called_once_with("--index", "user/index2", "delete_me==0.1")
+        self.assertEqual(call("user/index2", volatile=False), devpi_client.modify_index.call_args)
+        self.assertListEqual([], load_journal(self.path).plan)
+
+    def test_records_original_volatility_before_changing_it(self):
+        devpi_client = Mock(spec=DevpiCommandWrapper)
+        devpi_client.modify_index.return_value = "volatile=False"
+
+        with RemovalJournal(self.path) as journal, journal.volatile_index(devpi_client, "user/index1", True):
+            self.assertDictEqual({"user/index1": False}, load_journal(self.path).volatility)
+            devpi_client.modify_index.assert_called_with("user/index1", volatile=True)
+
+        devpi_client.modify_index.assert_called_with("user/index1", volatile=False)
+        self.assertDictEqual({}, load_journal(self.path).volatility)
+
+    def test_must_be_opened_before_use(self):
+        journal = RemovalJournal(self.path)
+
+        with self.assertRaises(RuntimeError):
+            journal.removed(_release("user/index1", "0.1"))
+        self.assertFalse(os.path.exists(self.path))
@@ -0,0 +1,51 @@
+# coding=utf-8
+
+import io
+import unittest
+
+from devpi_cleaner.client import Release
+from devpi_cleaner.plan import read_plan
+from devpi_cleaner.plan import record_plan
+
+
+def _release(index: str, version: str) -> Release:
+    release = Release(index, "delete_me", version)
+    release.add_file(f"http://localhost:2414/{index}/+f/45b/301745c6d8bbf/delete_me-{version}.tar.gz", 1024)
+    release.add_file(f"http://localhost:2414/{index}/+f/45b/301745c6d8bbe/delete_me-{version}-py3-none-any.whl")
+    return release
+
+
+class PlanTests(unittest.TestCase):
+    def test_round_trip(self):
+        plan = [
+            ("user/index1", {_release("user/index1", "0.1"), _release("user/index1", "0.2")}),
+            ("user/index2", {_release("user/index2", "0.1")}),
+        ]
+        stream = io.StringIO()
+
+        self.assertListEqual(plan, list(record_plan(plan, stream)))
+        self.assertEqual(3, len(stream.getvalue().splitlines()))
+
+        stream.seek(0)
+        replayed = list(read_plan(stream))
+        self.assertListEqual(plan, replayed)
+        replayed_release = next(iter(replayed[1][1]))
+        self.assertDictEqual(_release("user/index2", "0.1").files, replayed_release.files)
+
+    def test_combines_interleaved_indices(self):
+        plan = [
+            ("user/index1", {_release("user/index1", "0.1")}),
+            ("user/index2", {_release("user/index2", "0.1")}),
+            ("user/index1", {_release("user/index1", "0.2")}),
+        ]
+        stream = io.StringIO()
+        list(record_plan(plan, stream))
+
+        stream.seek(0)
+        self.assertListEqual(
+            [
+                ("user/index1", {_release("user/index1", "0.1"), _release("user/index1", "0.2")}),
+                ("user/index2", {_release("user/index2", "0.1")}),
+            ],
+            list(read_plan(stream)),
+        )